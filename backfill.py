@@ -0,0 +1,236 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import argparse
+import configparser
+import io
+import time
+import numpy as np
+import pandas as pd
+import pytz
+import psycopg2
+import logging
+
+from volatility_index import BVIX
+
+
+""" Rebuilds bvix history from stored derbbo snapshots, e.g. after the surface
+methodology or grid changed. Run with: python3 backfill.py --help """
+
+
+def read_db_settings(path="settings.txt"):
+    config = configparser.RawConfigParser()
+    config.read_file(open(path))
+    settings = dict(config.items("PostgreSQL"))
+    return {key:settings[key] for key in ["database", "user", "password", "host", "port"]}
+
+
+def rebuild_chunk(task):
+    """ Rebuilds the surfaces of every snapshot in one time range. Runs in the
+    worker processes, each with its own database connection. """
+
+    db_settings, schema, source, chunk_start, chunk_end = task
+    conn = psycopg2.connect(**db_settings)
+    c = conn.cursor()
+    c.execute("SELECT timestamp, btcusd_price::float8, ttmyears::float8, strike::float8, typ, "
+              "bid::float8, ask::float8, bid_iv::float8, ask_iv::float8 "
+              "FROM {}.{} WHERE timestamp >= %s AND timestamp < %s "
+              "ORDER BY timestamp".format(schema, source), (chunk_start, chunk_end))
+    df = pd.DataFrame(c.fetchall(), columns=["timestamp", "btcusd_price", "ttmyears", "strike", "typ",
+                                             "bid", "ask", "bid_iv", "ask_iv"])
+    conn.close()
+
+    df = df.astype({"btcusd_price":float, "ttmyears":float, "strike":float, "typ":str,
+                    "bid":float, "ask":float, "bid_iv":float, "ask_iv":float})
+    bvix = BVIX()
+    surfaces = []
+    for ts, snapshot in df.groupby("timestamp", sort=True):
+        surfaces.append((ts, bvix.build_surface(snapshot)))
+    return surfaces, len(df)
+
+
+class BVIXBackfill:
+
+    def __init__(self, db_settings, source="derbbo_dense", target="bvix_backfill",
+                 chunk_hours=24, workers=None):
+        self.logger = logging.getLogger("deribit")
+        self.db_settings = db_settings
+        self.schema = "obot"
+        self.source = source
+        self.target = target
+        self.progress_table = "bvix_backfill_progress"
+        self.chunk = timedelta(hours=chunk_hours)
+        self.workers = workers
+
+        self.conn = psycopg2.connect(**db_settings)
+        self.c = self.conn.cursor()
+        self.bvix = BVIX()
+        self.prepare_db()
+
+
+    def prepare_db(self):
+        self.bvix.schema = self.schema
+        self.bvix.table = self.target
+        self.bvix.c = self.c
+        self.bvix.conn = self.conn
+        self.bvix.prepare_db()
+        self.c.execute("CREATE TABLE IF NOT EXISTS {}.{}("
+                       "target TEXT, chunk_start TIMESTAMPTZ, chunk_end TIMESTAMPTZ, "
+                       "surfaces INTEGER, finished TIMESTAMPTZ)".format(self.schema, self.progress_table))
+        # rows of a chunk are replaced when it is rebuilt
+        self.c.execute("CREATE INDEX IF NOT EXISTS {1}_timestamp_idx ON {0}.{1} (timestamp)"
+                       .format(self.schema, self.target))
+        self.conn.commit()
+
+
+    def chunks(self, start=None, end=None):
+        """ Time-ordered chunks between start and end which have not been
+        rebuilt into the target table yet. Chunks are aligned to multiples of
+        the chunk length since the epoch, so runs with another start split the
+        range the same way, and a chunk is only skipped if finished chunks
+        cover all of it (a chunk cut short by an earlier end is rebuilt). """
+
+        if start is None or end is None:
+            self.c.execute("SELECT min(timestamp), max(timestamp) FROM {}.{}".format(self.schema, self.source))
+            first, last = self.c.fetchone()
+            if first is None:
+                return []
+            start = start or first
+            end = end or last + timedelta(seconds=1)
+
+        self.c.execute("SELECT chunk_start, chunk_end FROM {}.{} WHERE target = %s "
+                       "ORDER BY chunk_start".format(self.schema, self.progress_table), (self.target,))
+        covered = [] # finished ranges, merged
+        for done_start, done_end in self.c.fetchall():
+            if len(covered) > 0 and done_start <= covered[-1][1]:
+                covered[-1][1] = max(covered[-1][1], done_end)
+            else:
+                covered.append([done_start, done_end])
+
+        epoch = datetime(1970, 1, 1, tzinfo=pytz.UTC)
+        chunks = []
+        chunk_start = start
+        while chunk_start < end:
+            chunk_end = min(epoch + ((chunk_start - epoch) // self.chunk + 1) * self.chunk, end)
+            if not any(done_start <= chunk_start and chunk_end <= done_end for done_start, done_end in covered):
+                chunks.append((chunk_start, chunk_end))
+            chunk_start = chunk_end
+        return chunks
+
+
+    def run(self, start=None, end=None):
+        chunks = self.chunks(start, end)
+        self.logger.info("Backfilling {} chunks from {}.{} into {}.{}.".format(len(chunks), self.schema, self.source,
+                                                                             self.schema, self.target))
+        tasks = [(self.db_settings, self.schema, self.source, s, e) for s, e in chunks]
+        started = time.perf_counter()
+        total_surfaces = 0
+        total_rows = 0
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            results = pool.map(rebuild_chunk, tasks) # in chunk order
+            for done, ((chunk_start, chunk_end), (surfaces, rows)) in enumerate(zip(chunks, results), 1):
+                self.write(chunk_start, chunk_end, surfaces)
+                total_surfaces += len(surfaces)
+                total_rows += rows
+                elapsed = time.perf_counter() - started
+                self.logger.info("{}/{} chunks ({} - {}): {} surfaces, {:.1f} surfaces/s, {:.0f} rows/s, "
+                                 "{:.0f}s remaining.".format(done, len(chunks), chunk_start, chunk_end,
+                                                             len(surfaces), total_surfaces / elapsed,
+                                                             total_rows / elapsed,
+                                                             elapsed / done * (len(chunks) - done)))
+
+        self.logger.info("Backfill finished: {} surfaces in {:.0f}s.".format(total_surfaces,
+                                                                         time.perf_counter() - started))
+
+
+    def compare(self, start, end, live_table="bvix"):
+        """ Rebuilds the snapshots between start and end without writing them and
+        compares every surface with the live one of the same snapshot. Live
+        surfaces are stamped when they were built, after the snapshot, so each
+        snapshot is matched with the first live surface within a minute of it.
+        Returns the largest absolute IV difference and the grid nodes only one
+        of the two has, per snapshot. """
+
+        surfaces, rows = rebuild_chunk((self.db_settings, self.schema, self.source, start, end))
+        days = ", ".join("d{}::float8".format(i) for i in self.bvix.days_til_maturity)
+        self.c.execute("SELECT timestamp, moneyness::float8, {} FROM {}.{} WHERE timestamp >= %s AND timestamp < %s "
+                       "ORDER BY timestamp, moneyness".format(days, self.schema, live_table),
+                       (start, end + timedelta(minutes=1)))
+        live = pd.DataFrame(self.c.fetchall())
+        if len(live) == 0:
+            return pd.DataFrame(columns=["timestamp", "live_timestamp", "max_abs_diff", "nodes_missing"])
+        live_timestamps = live[0].drop_duplicates().tolist()
+        live_surfaces = {ts:frame.iloc[:, 2:].to_numpy(dtype=float) for ts, frame in live.groupby(0)}
+
+        results = []
+        for ts, surface in surfaces:
+            matches = [t for t in live_timestamps if ts <= t < ts + timedelta(minutes=1)]
+            if len(matches) == 0:
+                continue
+            rebuilt = np.round(surface, 4) # as written
+            live_surface = live_surfaces[matches[0]]
+            both = ~np.isnan(rebuilt) & ~np.isnan(live_surface)
+            difference = np.abs(rebuilt - live_surface)[both]
+            results.append([ts, matches[0], difference.max() if len(difference) > 0 else np.nan,
+                            int((np.isnan(rebuilt) != np.isnan(live_surface)).sum())])
+        return pd.DataFrame(results, columns=["timestamp", "live_timestamp", "max_abs_diff", "nodes_missing"])
+
+
+    def write(self, chunk_start, chunk_end, surfaces):
+        """ Replaces the target rows of one chunk and marks it as done in the
+        same transaction, so an interrupted backfill resumes at the first
+        unfinished chunk and a rebuilt chunk leaves no duplicates """
+
+        self.c.execute("DELETE FROM {}.{} WHERE timestamp >= %s AND timestamp < %s".format(self.schema, self.target),
+                       (chunk_start, chunk_end))
+        if len(surfaces) > 0:
+            frames = [self.bvix.surface_to_frame(surface, ts) for ts, surface in surfaces]
+            df = pd.concat(frames)
+            buffer = io.StringIO()
+            df.to_csv(buffer, header=False, index=False)
+            buffer.seek(0)
+            self.c.copy_expert("COPY {}.{} ({}) FROM STDIN WITH CSV".format(self.schema, self.target,
+                                                                           ", ".join(df.columns)), buffer)
+
+        self.c.execute("INSERT INTO {}.{} VALUES (%s, %s, %s, %s, %s)".format(self.schema, self.progress_table),
+                       (self.target, chunk_start, chunk_end, len(surfaces), datetime.now(pytz.UTC)))
+        self.conn.commit()
+
+
+def parse_time(value):
+    return pytz.UTC.localize(datetime.fromisoformat(value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild bvix surfaces from stored derbbo snapshots.")
+    parser.add_argument("--start", type=parse_time, help="first snapshot (UTC, ISO format), default: oldest")
+    parser.add_argument("--end", type=parse_time, help="end of the range (UTC, exclusive), default: newest")
+    parser.add_argument("--source", default="derbbo_dense", help="table or view with the snapshots")
+    parser.add_argument("--target", default="bvix_backfill", help="table to write the surfaces to")
+    parser.add_argument("--chunk-hours", type=float, default=24, help="hours of snapshots per task")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default: CPU count")
+    parser.add_argument("--compare", action="store_true",
+                        help="compare the rebuilt surfaces between --start and --end with the live bvix instead "
+                             "of writing them")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("deribit")
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(module)s - %(message)s'))
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    backfill = BVIXBackfill(read_db_settings(), args.source, args.target, args.chunk_hours, args.workers)
+    if args.compare:
+        if args.start is None or args.end is None:
+            parser.error("--compare needs --start and --end")
+        result = backfill.compare(args.start, args.end)
+        logger.info("{} snapshots compared with the live bvix: largest IV difference {:.4f}, "
+                    "{} nodes in only one of them.".format(len(result), result["max_abs_diff"].max(),
+                                                           result["nodes_missing"].sum()))
+        return
+    backfill.run(args.start, args.end)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,772 @@
+from datetime import datetime, timedelta
+import argparse
+import gc
+import json
+import os
+import platform
+import subprocess
+import time
+import numpy as np
+import pandas as pd
+import pytz
+from scipy.stats import norm
+
+from py_vollib_vectorized import vectorized_implied_volatility as viv
+
+from data_feed import DataFeed
+from save_top_of_book import SaveBBO
+from hedger import DeltaHedge
+from ws_client import WSClient
+from iv_cache import IVCache
+from trade_bars import TradeBars
+from volatility_index import BVIX
+from svi import SVIFitter
+from portfolio_greeks import PortfolioGreeks
+from risk_grid import ScenarioRisk
+from hedge_optimizer import GreekHedgeOptimizer
+import black_scholes
+from instruments import MONTHS, parse_option
+import iv_solver
+
+
+""" Latency benchmarks for the feed handlers and analytics modules, on
+synthetic option universes, book messages and portfolios. Run with:
+python3 benchmark.py --help. Timings are written as JSON and can be compared
+against an earlier run to catch regressions. """
+
+
+RESULTS = [] # every named timing of this run
+
+
+def synthetic_bbo_snapshot(n_expiries=12, strikes_per_expiry=40, spot=30000, seed=0):
+    """ Builds a top-of-book snapshot shaped like the frame SaveBBO hands to
+    BVIX, with quotes priced off a simple smile """
+
+    rng = np.random.default_rng(seed)
+    ts = datetime.now(pytz.UTC).replace(microsecond=0)
+    days = np.unique(np.round(np.geomspace(1, 365, n_expiries)).astype(int))
+    rows = []
+    for d in days:
+        expiration = (ts + timedelta(days=int(d))).replace(hour=8, minute=0, second=0)
+        ttm = (expiration - ts).total_seconds() / (60*60*24*365)
+        width = 0.25 + 1.5 * np.sqrt(ttm)
+        strikes = np.unique(np.round(spot * np.exp(np.linspace(-width, width, strikes_per_expiry)), -2))
+        for strike in strikes:
+            k = np.log(strike / spot)
+            iv = 0.55 + 0.25 * k**2 / max(ttm, 0.05) ** 0.5 - 0.05 * k
+            for typ in ["C", "P"]:
+                spread = rng.uniform(0.005, 0.04)
+                bid_iv, ask_iv = iv - spread, iv + spread
+                bid = black_scholes_price(spot, strike, bid_iv, ttm, typ) / spot
+                ask = black_scholes_price(spot, strike, ask_iv, ttm, typ) / spot
+                bid = np.floor(bid / 0.0005) * 0.0005
+                ask = np.ceil(ask / 0.0005) * 0.0005
+                rows.append([ts, float(spot), round(ttm, 6), expiration, float(strike), typ,
+                             rng.integers(0, 500), bid, bid * spot, rng.uniform(1, 50),
+                             bid_iv if bid > 0 else np.nan, ask, ask * spot,
+                             rng.uniform(1, 50), ask_iv])
+
+    columns = ["timestamp", "btcusd_price", "ttmyears", "expiration", "strike",
+               "typ", "oi", "bid", "bid_usd", "bid_size", "bid_iv", "ask",
+               "ask_usd", "ask_size", "ask_iv"]
+    df = pd.DataFrame(rows, columns=columns)
+    df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True)
+    df["expiration"] = pd.to_datetime(df["expiration"], utc=True)
+    return df
+
+
+def instrument_name(expiration, strike, typ):
+    month_names = {number:name for name, number in MONTHS.items()}
+    return "BTC-{}{}{}-{}-{}".format(expiration.day, month_names[expiration.month], expiration.year % 100,
+                                     int(strike), typ)
+
+
+def black_scholes_price(S, X, sigma, ttm, typ):
+    d1 = (np.log(S/X) + (sigma**2)/2*ttm) / (sigma * np.sqrt(ttm))
+    d2 = d1 - sigma * np.sqrt(ttm)
+    if typ == "C":
+        return S * norm.cdf(d1) - X * norm.cdf(d2)
+    return X * norm.cdf(-d2) - S * norm.cdf(-d1)
+
+
+def legacy_surface(bvix, df):
+    """ The per-expiry / per-moneyness pandas loop BVIX used before the grid
+    interpolation engine, kept as a reference for the benchmark """
+
+    df = df.astype({"btcusd_price":float, "strike":float, "ttmyears":float,
+                    "bid":float, "ask":float, "bid_iv":float, "ask_iv":float, "typ":str})
+    df["ttmdays"] = df["ttmyears"] * 365
+    df["moneyness"] = (np.log(df["strike"] / df["btcusd_price"]))
+    df["mid_iv"] = (df["bid_iv"] + df["ask_iv"]) / 2
+    df.loc[df["ask"] >= 0.6, "ask"] = 0
+    df.loc[df["bid"] >= 0.6, "bid"] = 0
+    df = df[df["ask"] != 0.0005].copy()
+    df["bid"] = df["bid"].fillna(0)
+    df["ask"] = df["ask"].fillna(0)
+    df.loc[df["bid"] == 0, "bid_iv"] = 0
+    df.loc[df["ask"] == 0, "ask_iv"] = 0
+    df = df[(df["bid"] > 0) | (df["ask"] > 0)]
+    df = df[(df["bid_iv"] > 0) | (df["ask_iv"] > 0)].copy()
+    itm_max = np.log(1.1)
+    df = df[((df["moneyness"] < itm_max) & (df["typ"] == "P")) |
+            ((df["moneyness"] > -1*itm_max) & (df["typ"] == "C"))].copy()
+    only_ask = (df["ask_iv"] > 0) & (df["bid_iv"] == 0)
+    only_bid = (df["bid_iv"] > 0) & (df["ask_iv"] == 0)
+    df.loc[only_ask, "mid_iv"] = df.loc[only_ask, "ask_iv"]
+    df.loc[only_bid, "mid_iv"] = df.loc[only_bid, "bid_iv"]
+    df_grouped = df.groupby(["strike", "expiration"],
+                            as_index=False).agg({"ttmdays":"first", "moneyness":"first", "mid_iv":"mean"})
+    df_grouped = df_grouped.sort_values(by=["ttmdays", "moneyness"]).drop(["strike", "expiration"], axis=1)
+
+    df_atm_intervals = []
+    for ttm in df_grouped["ttmdays"].unique():
+        df2 = df_grouped[df_grouped["ttmdays"] == ttm]
+        df_moneyness = pd.DataFrame(bvix.log_moneyness_intervals, columns=["moneyness"])
+        df2 = df2.merge(df_moneyness, on="moneyness", how="outer").replace([np.inf, -np.inf], 0)
+        df2["ttmdays"] = df2["ttmdays"].ffill().bfill()
+        df2 = df2.sort_values(by="moneyness", ascending=True).set_index("moneyness")
+        df2 = df2.interpolate(method='slinear', limit_direction='forward', axis=0).reset_index()
+        df_atm_intervals.append(df2)
+    df_atm_intervals = pd.concat(df_atm_intervals)
+
+    dfy = pd.DataFrame([[i, m] for i in bvix.days_til_maturity for m in bvix.log_moneyness_intervals],
+                       columns=["ttmdays", "moneyness"])
+    df_atm_intervals = df_atm_intervals[df_atm_intervals["moneyness"].isin(bvix.log_moneyness_intervals)]
+    df_atm_intervals = pd.concat([df_atm_intervals, dfy])
+
+    df_ttm_intervals = []
+    for m in df_atm_intervals["moneyness"].unique():
+        df2 = df_atm_intervals[df_atm_intervals["moneyness"] == m].set_index("ttmdays")
+        df2 = df2.interpolate(method='slinear', limit_direction='forward', axis=0)
+        df_ttm_intervals.append(df2.reset_index())
+    df_ttm_intervals = pd.concat(df_ttm_intervals)
+
+    df_ttm_intervals = df_ttm_intervals[df_ttm_intervals["ttmdays"].isin(bvix.days_til_maturity)]
+    surface = df_ttm_intervals.pivot(index="moneyness", columns="ttmdays", values="mid_iv")
+    return surface.to_numpy()
+
+
+def timeit(function, repeats, name=None, setup=None, **params):
+    """ Median milliseconds per call. setup runs untimed before every call,
+    the garbage collector is off while timing (as in the timeit module).
+    Named timings are kept in RESULTS with their params. """
+
+    timings = []
+    for i in range(repeats):
+        if setup is not None:
+            setup()
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            function()
+            timings.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+    timings = np.array(timings) * 1000
+    if name is not None:
+        RESULTS.append({"name":name, "params":params, "repeats":repeats,
+                        "median_ms":float(np.median(timings)), "mean_ms":float(timings.mean()),
+                        "min_ms":float(timings.min()), "p95_ms":float(np.percentile(timings, 95))})
+    return float(np.median(timings))
+
+
+def benchmark_volsurf(repeats=20):
+    bvix = BVIX()
+    bvix.fit_svi = False # timed separately in benchmark_svi
+    for n_expiries, strikes_per_expiry in [(8, 20), (12, 40), (16, 80)]:
+        df = synthetic_bbo_snapshot(n_expiries, strikes_per_expiry)
+        surface = bvix.build_surface(df)
+        reference = legacy_surface(bvix, df)
+        identical = np.allclose(surface.round(4), reference.round(4), equal_nan=True, atol=1e-4)
+
+        nodes = bvix.prepare_surface_nodes(df)
+        grid_ms = timeit(lambda: bvix.interpolate_surface(*nodes), repeats, "volsurf_grid", options=len(df))
+        vectorized_ms = timeit(lambda: bvix.build_surface(df), repeats, "volsurf", options=len(df))
+        snapshot_ms = timeit(lambda: bvix.create_volsurf_snapshot(df), repeats, "create_volsurf_snapshot",
+                             options=len(df))
+        legacy_ms = timeit(lambda: legacy_surface(bvix, df), max(repeats // 4, 1), "volsurf_legacy", options=len(df))
+        print("volsurf  {:>5} options  vectorized {:8.2f} ms (grid {:6.2f} ms, create_volsurf_snapshot {:6.2f} ms)  "
+              "legacy {:8.2f} ms  identical: {}".format(len(df), vectorized_ms, grid_ms, snapshot_ms,
+                                                       legacy_ms, identical))
+
+
+def benchmark_iv_solver(repeats=20):
+    """ Validates the in-project solver against py_vollib and compares cold
+    and warm-started solves on full-universe batches """
+
+    for n_expiries, strikes_per_expiry in [(12, 40), (16, 80)]:
+        df = synthetic_bbo_snapshot(n_expiries, strikes_per_expiry)
+        spot = df["btcusd_price"].iloc[0]
+        prices = df["ask"].to_numpy()
+        types = df["typ"].to_numpy()
+
+        ivs, status = iv_solver.implied_vol(prices, spot, df["strike"], df["ttmyears"], types, inverse=True)
+        reference = viv(prices * spot, spot, df["strike"], df["ttmyears"], 0, df["typ"].str.lower(), 0,
+                        on_error="ignore", model='black_scholes_merton', return_as='numpy')
+        intrinsic = np.where(types == "C", np.maximum(spot - df["strike"], 0),
+                             np.maximum(df["strike"] - spot, 0)) / spot
+        comparable = (status == iv_solver.CONVERGED) & (prices - intrinsic >= 0.0005) # at least one tick of time value
+        max_error = np.max(np.abs(ivs - reference)[comparable])
+
+        moved = prices * 1.01
+        cold_ms = timeit(lambda: iv_solver.implied_vol(moved, spot, df["strike"], df["ttmyears"], types,
+                                                       inverse=True), repeats, "iv_cold", options=len(df))
+        warm_ms = timeit(lambda: iv_solver.implied_vol(moved, spot, df["strike"], df["ttmyears"], types,
+                                                       initial_vol=ivs, inverse=True), repeats,
+                         "iv_warm", options=len(df))
+        py_vollib_ms = timeit(lambda: viv(moved * spot, spot, df["strike"], df["ttmyears"], 0,
+                                          df["typ"].str.lower(), 0, on_error="ignore",
+                                          model='black_scholes_merton', return_as='numpy'), repeats,
+                              "iv_py_vollib", options=len(df))
+        print("iv       {:>5} options  cold {:8.2f} ms  warm {:8.2f} ms  py_vollib {:8.2f} ms  "
+              "not converged: {}  max |iv - py_vollib|: {:.2e}".format(len(df), cold_ms, warm_ms, py_vollib_ms,
+                                                                      int((status == iv_solver.NOT_CONVERGED).sum()),
+                                                                      max_error))
+
+
+def benchmark_svi(repeats=5):
+    """ Cold and warm-started SVI / SSVI fits of the full universe in the process pool """
+
+    bvix = BVIX()
+    fitter = SVIFitter()
+    for n_expiries, strikes_per_expiry in [(12, 40), (16, 80)]:
+        nodes = bvix.prepare_surface_nodes(synthetic_bbo_snapshot(n_expiries, strikes_per_expiry))
+        fitter.previous_slices, fitter.previous_ssvi = [], None
+        slices, ssvi = fitter.fit(*nodes) # also starts the pool
+        fitter.previous_slices, fitter.previous_ssvi = [], None
+        cold_ms = timeit(lambda: fitter.fit(*nodes), 1, "svi_cold", nodes=len(nodes[0]))
+        warm_ms = timeit(lambda: fitter.fit(*nodes), repeats, "svi_warm", nodes=len(nodes[0]))
+        print("svi      {:>5} nodes    cold {:8.2f} ms  warm {:8.2f} ms  slices {:>3}  "
+              "max slice rmse {:.4f}  ssvi rmse {:.4f}".format(len(nodes[0]), cold_ms, warm_ms, len(slices),
+                                                             slices["rmse"].max(), ssvi["rmse"]))
+    fitter.shutdown()
+
+
+def synthetic_positions(n_legs, spot=30000, seed=0):
+    """ Options positions shaped like DataFeed.positions """
+
+    rng = np.random.default_rng(seed)
+    today = datetime.now(pytz.UTC)
+    positions = {}
+    while len(positions) < n_legs:
+        expiration = today + timedelta(days=int(rng.integers(2, 180)))
+        strike = int(round(spot * np.exp(rng.normal(0, 0.3)), -3))
+        typ = rng.choice(["C", "P"])
+        name = instrument_name(expiration, strike, typ)
+        expiration, strike, typ = parse_option(name)
+        ttm = (expiration - today).total_seconds() / (60*60*24*365)
+        mark_price = black_scholes_price(spot, strike, 0.6, ttm, typ) / spot
+        positions[name] = {"instrument_name":name, "size":float(rng.choice([-1, 1]) * rng.integers(1, 20) / 10),
+                           "mark_price":round(max(mark_price, 0.0005), 4), "direction":"buy"}
+    return positions
+
+
+def legacy_option_delta(positions, spot):
+    """ The per-position loop DeltaHedge used before the portfolio greeks engine """
+
+    option_delta = 0
+    for name, position in positions.items():
+        expiration, strike, typ = parse_option(name)
+        ttmyears = (expiration - datetime.now(pytz.UTC)).total_seconds() / (60*60*24*365)
+        iv = viv(position["mark_price"] * spot, spot, strike, ttmyears, 0, typ.lower(), 0, on_error="ignore",
+                 model='black_scholes_merton', return_as='numpy').round(4)
+        delta = reference_bsm(spot, strike, iv, 0, 0, ttmyears, typ.lower(), "delta")
+        option_delta += delta * position["size"] * spot
+    return option_delta
+
+
+def reference_bsm(S, X, sigma, r, q, ttm, otype, greek):
+    """ Scalar, one greek per call generalized Black-Scholes with scipy.stats.norm,
+    as DeltaHedge.bsm computed them (with the vega formula corrected) """
+
+    t = float(ttm)
+    b = r - q
+    d1 = (np.log(S/X) + (b + (sigma**2)/2)*t) / (sigma * np.sqrt(t))
+    d2 = d1 - sigma * np.sqrt(t)
+    call = otype == "c"
+    if greek == "price":
+        if call:
+            return S * np.exp((b-r)*t) * norm.cdf(d1) - X * np.exp(-r*t) * norm.cdf(d2)
+        return X * np.exp(-r*t) * norm.cdf(-d2) - S * np.exp((b-r)*t) * norm.cdf(-d1)
+    elif greek == "delta":
+        return np.exp((b-r)*t) * norm.cdf(d1) if call else -np.exp((b-r)*t) * norm.cdf(-d1)
+    elif greek == "gamma":
+        return np.exp((b-r)*t) * norm.pdf(d1) / (S*sigma*np.sqrt(t))
+    elif greek == "vega":
+        return 0.01 * S * np.exp((b-r)*t) * norm.pdf(d1) * np.sqrt(t)
+    elif greek == "vanna":
+        return -np.exp((b-r)*t) * d2 / sigma * norm.pdf(d1) / 100
+    elif greek == "charm":
+        if call:
+            return -np.exp((b-r)*t) * (norm.pdf(d1)*(b/(sigma*np.sqrt(t)) - d2/(2*t)) + (b-r)*norm.cdf(d1))
+        return -np.exp((b-r)*t) * (norm.pdf(d1)*(b/(sigma*np.sqrt(t)) - d2/(2*t)) - (b-r)*norm.cdf(-d1))
+    elif greek == "rho":
+        if call:
+            return 0.01 * X * t * np.exp(-r*t) * norm.cdf(d2)
+        return -0.01 * X * t * np.exp(-r*t) * norm.cdf(-d2)
+
+
+def validate_black_scholes(n_options=2000, seed=0):
+    """ Checks the batch kernel against the scalar reference and finite differences,
+    including the inverse (BTC-priced) adjustments, and times both """
+
+    rng = np.random.default_rng(seed)
+    S = 30000.0
+    X = S * np.exp(rng.normal(0, 0.3, n_options))
+    sigma = rng.uniform(0.3, 1.5, n_options)
+    ttm = rng.uniform(2, 365, n_options) / 365
+    otype = rng.choice(["c", "p"], n_options)
+    r, q = 0.02, 0.01
+
+    kernel = black_scholes.greeks(S, X, sigma, ttm, otype, r=r, q=q)
+    errors = {}
+    for greek in ["price", "delta", "gamma", "vega", "vanna", "charm", "rho"]:
+        reference = np.array([reference_bsm(S, X[i], sigma[i], r, q, ttm[i], otype[i], greek) for i in range(n_options)])
+        errors[greek] = np.max(np.abs(kernel[greek] - reference))
+
+    # finite differences of the price in USD and in BTC
+    h = 0.01
+    def price(S=S, sigma=sigma, ttm=ttm, inverse=False):
+        return black_scholes.greeks(S, X, sigma, ttm, otype, ["price"], r=r, q=q, inverse=inverse)["price"]
+    def delta(S=S, sigma=sigma, ttm=ttm, inverse=False):
+        return black_scholes.greeks(S, X, sigma, ttm, otype, ["delta"], r=r, q=q, inverse=inverse)["delta"]
+    errors["theta (fd)"] = np.max(np.abs(kernel["theta"] - (price(ttm=ttm - 1e-6) - price()) / 1e-6 / 365))
+    inverse = black_scholes.greeks(S, X, sigma, ttm, otype, r=r, q=q, inverse=True)
+    errors["inverse delta (fd)"] = np.max(np.abs(inverse["delta"] -
+                                                 S * (price(S + h, inverse=True) - price(S - h, inverse=True)) / (2*h)))
+    errors["inverse gamma (fd)"] = np.max(np.abs(inverse["gamma"] -
+                                                 (delta(S + h, inverse=True) - delta(S - h, inverse=True)) / (2*h)))
+    errors["inverse vanna (fd)"] = np.max(np.abs(inverse["vanna"] -
+                                                 (delta(sigma=sigma + 1e-4, inverse=True) -
+                                                  delta(sigma=sigma - 1e-4, inverse=True)) / 2e-4 / 100))
+
+    kernel_ms = timeit(lambda: black_scholes.greeks(S, X, sigma, ttm, otype, r=r, q=q), 20,
+                       "bs_kernel", options=n_options)
+    scalar_ms = timeit(lambda: [reference_bsm(S, X[i], sigma[i], r, q, ttm[i], otype[i], greek)
+                                for i in range(200) for greek in ["price", "delta", "gamma", "vega"]], 3,
+                       "bs_scalar", options=200)
+    print("bs       {:>5} options  kernel (all greeks) {:8.2f} ms  scalar per greek {:8.2f} ms "
+          "(extrapolated)".format(n_options, kernel_ms, scalar_ms * n_options / 200))
+    print("bs       max abs errors: {}".format(", ".join("{} {:.1e}".format(g, e) for g, e in errors.items())))
+
+
+def benchmark_portfolio_greeks(repeats=20):
+    spot = 30000
+    for n_legs in [10, 100, 1000]:
+        positions = synthetic_positions(n_legs)
+        engine = PortfolioGreeks()
+        engine.sync(positions)
+        delta = engine.compute(spot)["delta"] * spot
+        reference = legacy_option_delta(positions, spot)
+
+        def full():
+            engine.stale[:] = True
+            engine.compute(spot)
+
+        def one_position_changed():
+            name = engine.names[0]
+            positions[name]["mark_price"] += 0.0005
+            engine.sync(positions)
+            engine.compute(spot)
+
+        engine_ms = timeit(full, repeats, "greeks_full", legs=n_legs)
+        incremental_ms = timeit(one_position_changed, repeats, "greeks_one_leg_changed", legs=n_legs)
+        legacy_ms = timeit(lambda: legacy_option_delta(positions, spot), max(repeats // 4, 1),
+                           "greeks_legacy", legs=n_legs)
+
+        # the hedger's entry point, on a feed holding the same book and a perpetual position
+        book = dict(positions)
+        book["BTC-PERPETUAL"] = {"size":abs(round(delta, -1)), "direction":"sell" if delta > 0 else "buy"}
+        hedger = DeltaHedge(SyntheticFeed(positions=book, spot=spot), run_threads=False)
+        hedger.determine_option_delta()
+        unchanged_ms = timeit(hedger.determine_option_delta, repeats, "determine_option_delta", legs=n_legs)
+
+        def mark_changed():
+            hedger.feed.positions[engine.names[0]]["mark_price"] += 0.0005
+            hedger.determine_option_delta()
+
+        changed_ms = timeit(mark_changed, repeats, "determine_option_delta_one_leg_changed", legs=n_legs)
+        print("greeks   {:>5} legs     engine {:8.2f} ms  one leg changed {:8.2f} ms  legacy {:8.2f} ms  "
+              "delta {:.1f} vs legacy {:.1f}".format(n_legs, engine_ms, incremental_ms, legacy_ms,
+                                                      delta, float(np.squeeze(reference))))
+        print("hedger   {:>5} legs     determine_option_delta {:8.2f} ms  one leg changed {:8.2f} ms".format(
+              n_legs, unchanged_ms, changed_ms))
+
+
+def benchmark_risk_grid(repeats=20):
+    """ Scenario grid in one pass against revaluing one scenario at a time """
+
+    spot = 30000
+    for n_legs in [10, 100, 1000]:
+        positions = synthetic_positions(n_legs)
+        positions["BTC-PERPETUAL"] = {"size":50000.0, "direction":"sell"}
+        risk = ScenarioRisk(feed=None)
+        now = time.time()
+        state = risk.refresh(spot, positions, now)
+        p = risk.greeks
+        ttm = (p.expiration - now) / (60*60*24*365)
+        base = black_scholes.greeks(spot, p.strike, p.iv, ttm, p.is_call, ["price"], inverse=True)["price"]
+
+        def one_scenario_at_a_time():
+            pnl = np.empty(state["pnl"].shape)
+            for i, S in enumerate(state["spots"]):
+                for j, shift in enumerate(state["vol_shifts"]):
+                    for k, days in enumerate(state["time_shifts"]):
+                        shocked = black_scholes.greeks(S, p.strike, np.maximum(p.iv + shift, iv_solver.MIN_VOL),
+                                                       np.maximum(ttm - days / 365, 1e-8), p.is_call,
+                                                       ["price", "delta", "gamma", "vega"], inverse=True)
+                        pnl[i, j, k] = np.sum((shocked["price"] * S - base * spot) * p.size) - 50000 * (S / spot - 1)
+            return pnl
+
+        grid_ms = timeit(lambda: risk.revalue(spot, -50000.0, now), repeats, "risk_grid", legs=n_legs)
+        loop_ms = timeit(one_scenario_at_a_time, max(repeats // 4, 1), "risk_per_scenario_loop", legs=n_legs)
+        error = np.max(np.abs(state["pnl"] - one_scenario_at_a_time()))
+        unshocked = state["pnl"][list(state["spot_shocks"]).index(0), list(state["vol_shifts"]).index(0), 0]
+        print("risk     {:>5} legs     grid {:>3} scenarios {:8.2f} ms  per scenario loop {:8.2f} ms  "
+              "max diff {:.1e}  unshocked pnl {:.1e}".format(n_legs, state["pnl"].size, grid_ms, loop_ms,
+                                                              error, unshocked))
+
+class SyntheticFeed:
+
+    """ The DataFeed attributes the analytics modules read, filled from a
+    synthetic top-of-book snapshot """
+
+    def __init__(self, df=None, positions=None, spot=30000):
+        self.ob = {}
+        self.contracts = []
+        if df is not None:
+            for row in df.itertuples():
+                name = instrument_name(row.expiration, row.strike, row.typ)
+                bids = {row.bid:row.bid_size} if row.bid > 0 else {}
+                self.ob[name] = {"bids":bids, "asks":{row.ask:row.ask_size}}
+                self.contracts.append(name)
+            spot = df["btcusd_price"].iloc[0]
+        self.btcusd_best_bid = spot - 0.25
+        self.btcusd_best_ask = spot + 0.25
+        self.positions = positions or {}
+        self.book_version = {}
+        self.oi = {name:0 for name in self.contracts}
+
+    def spot(self):
+        return self.btcusd_best_bid, self.btcusd_best_ask
+
+
+def benchmark_hedge_optimizer(repeats=10):
+    """ Multi-greek hedge over the whole option universe, LP and least squares """
+
+    for n_expiries, strikes in [(6, 20), (12, 40), (16, 60)]:
+        df = synthetic_bbo_snapshot(n_expiries, strikes)
+        feed = SyntheticFeed(df, synthetic_positions(20))
+        optimizer = GreekHedgeOptimizer(feed)
+        optimizer.max_log_moneyness = np.inf
+        spot = (feed.btcusd_best_bid + feed.btcusd_best_ask) / 2
+        current = optimizer.book_exposures(spot)
+        targets = {greek:0 for greek in ["delta", "gamma", "vega", "theta", "vanna"]}
+        optimizer.tolerances = {"delta":100, "gamma":20, "vega":5, "theta":2, "vanna":20}
+
+        candidates_ms = timeit(lambda: optimizer.candidates(spot), repeats, "hedge_candidates",
+                               options=len(feed.contracts))
+        for method in ["lp", "lsq"]:
+            plan = optimizer.optimize(targets, current=current, method=method)
+            solve_ms = timeit(lambda: optimizer.optimize(targets, current=current, method=method), repeats,
+                              "hedge_" + method, options=len(feed.contracts))
+            if plan is None:
+                print("hedge    {:>5} options  {:>3}: no solution".format(len(feed.contracts), method))
+                continue
+            misses = ", ".join("{} {:.0f}->{:.0f}".format(g, plan["before"][g], plan["after"][g]) for g in targets)
+            print("hedge    {:>5} options  {:>3} {:8.2f} ms (candidates {:6.2f} ms, {} liquid)  {} trades  "
+                  "cost {:.0f} USD  {}".format(len(feed.contracts), method, solve_ms, candidates_ms,
+                                               plan["candidates"], len(plan["orders"]), plan["cost_usd"], misses))
+
+
+def synthetic_book_snapshots(df, depth=5, seed=0):
+    """ book.<instrument>.raw snapshot messages (the "data" part) for every
+    option of a top-of-book frame, depth levels per side one tick apart """
+
+    rng = np.random.default_rng(seed)
+    tick = 0.0005
+    timestamp = int(df["timestamp"].iloc[0].timestamp() * 1000)
+    snapshots = []
+    for i, row in enumerate(df.itertuples()):
+        bids = [["new", round(row.bid - level * tick, 4), round(float(rng.uniform(0.1, 50)), 1)]
+                for level in range(depth) if row.bid - level * tick > 0]
+        asks = [["new", round(row.ask + level * tick, 4), round(float(rng.uniform(0.1, 50)), 1)]
+                for level in range(depth)]
+        snapshots.append({"type":"snapshot", "timestamp":timestamp, "instrument_name":instrument_name(
+                          row.expiration, row.strike, row.typ), "change_id":i * 1000000, "bids":bids, "asks":asks})
+    return snapshots
+
+
+def synthetic_change_stream(snapshots, n_messages, seed=0):
+    """ book.<instrument>.raw change messages continuing the snapshots. Levels
+    are only changed or deleted where they exist, so the stream can be applied
+    to the books in order. Activity is concentrated in a few instruments, as
+    in the live feed. """
+
+    rng = np.random.default_rng(seed)
+    tick = 0.0005
+    books = {s["instrument_name"]:{"bids":{level[1] for level in s["bids"]},
+                                   "asks":{level[1] for level in s["asks"]}} for s in snapshots}
+    change_ids = {s["instrument_name"]:s["change_id"] for s in snapshots}
+    names = list(books)
+    activity = rng.pareto(1.2, len(names)) + 0.1
+    timestamp = snapshots[0]["timestamp"]
+    changes = []
+    for i, name in enumerate(np.array(names)[rng.choice(len(names), n_messages, p=activity / activity.sum())]):
+        side = "bids" if rng.random() < 0.5 else "asks"
+        levels = books[name][side]
+        action = rng.choice(["change", "new", "delete"], p=[0.6, 0.2, 0.2])
+        if action == "delete" and len(levels) > 1:
+            price = sorted(levels)[rng.integers(len(levels))]
+            levels.discard(price)
+            update = ["delete", price, 0.0]
+        elif action == "change" and len(levels) > 0:
+            update = ["change", sorted(levels)[rng.integers(len(levels))], round(float(rng.uniform(0.1, 50)), 1)]
+        else:
+            if side == "bids":
+                price = round(min(levels) - tick, 4) if len(levels) > 0 and min(levels) > tick else tick
+            else:
+                price = round(max(levels, default=0) + tick, 4)
+            levels.add(price)
+            update = ["new", price, round(float(rng.uniform(0.1, 50)), 1)]
+        message = {"type":"change", "timestamp":timestamp + i, "instrument_name":name,
+                   "prev_change_id":change_ids[name], "change_id":change_ids[name] + 1, "bids":[], "asks":[]}
+        message[side].append(update)
+        change_ids[name] += 1
+        changes.append(message)
+    return changes
+
+
+def synthetic_ws_messages(df, snapshots, changes, ticker_share=0.3, perp_share=0.05, trades_share=0.02, seed=0):
+    """ Raw websocket frames as WSClient receives them: the book snapshots,
+    then the changes interleaved with option tickers, BTC-PERPETUAL book and
+    trade messages. Returns (snapshot frames, stream frames). """
+
+    rng = np.random.default_rng(seed)
+    spot = float(df["btcusd_price"].iloc[0])
+    timestamp = snapshots[0]["timestamp"]
+
+    def frame(channel, data):
+        return json.dumps({"jsonrpc":"2.0", "method":"subscription", "params":{"channel":channel, "data":data}})
+
+    def ticker(i):
+        row = df.iloc[i]
+        name = snapshots[i]["instrument_name"]
+        mid_iv = float(np.nanmean([row["bid_iv"], row["ask_iv"]])) * 100
+        return frame("ticker.{}.raw".format(name), {
+            "timestamp":timestamp, "instrument_name":name, "state":"open", "underlying_price":spot,
+            "underlying_index":"BTC-USD", "index_price":spot, "open_interest":float(row["oi"]),
+            "mark_price":float(row["ask"] + row["bid"]) / 2, "mark_iv":round(mid_iv, 2),
+            "best_bid_price":float(row["bid"]), "best_bid_amount":float(row["bid_size"]),
+            "best_ask_price":float(row["ask"]), "best_ask_amount":float(row["ask_size"]),
+            "bid_iv":float(row["bid_iv"]) * 100 if row["bid"] > 0 else 0, "ask_iv":float(row["ask_iv"]) * 100,
+            "interest_rate":0, "last_price":None, "settlement_price":float(row["ask"]),
+            "greeks":{"delta":0.5, "gamma":0.00005, "vega":10.0, "theta":-20.0, "rho":1.0},
+            "stats":{"volume":0, "price_change":None, "low":None, "high":None}})
+
+    def perp_book(i):
+        return frame("book.BTC-PERPETUAL.none.1.100ms", {
+            "timestamp":timestamp + i, "instrument_name":"BTC-PERPETUAL", "change_id":i,
+            "bids":[[spot - 0.5, float(rng.integers(1, 100) * 10)]], "asks":[[spot, float(rng.integers(1, 100) * 10)]]})
+
+    def perp_trades(i):
+        return frame("trades.BTC-PERPETUAL.raw", [{
+            "trade_seq":i, "trade_id":str(i), "timestamp":timestamp + i, "tick_direction":0, "price":spot,
+            "mark_price":spot, "instrument_name":"BTC-PERPETUAL", "index_price":spot,
+            "direction":"buy" if rng.random() < 0.5 else "sell", "amount":float(rng.integers(1, 100) * 10)}])
+
+    snapshot_frames = [frame("book.{}.raw".format(s["instrument_name"]), s) for s in snapshots]
+    stream = []
+    kinds = rng.choice(4, len(changes), p=[1 - ticker_share - perp_share - trades_share,
+                                          ticker_share, perp_share, trades_share])
+    changes = iter(changes)
+    for i, kind in enumerate(kinds):
+        if kind == 0:
+            change = next(changes)
+            stream.append(frame("book.{}.raw".format(change["instrument_name"]), change))
+        elif kind == 1:
+            stream.append(ticker(int(rng.integers(len(snapshots)))))
+        elif kind == 2:
+            stream.append(perp_book(i))
+        else:
+            stream.append(perp_trades(i))
+    return snapshot_frames, stream
+
+
+def benchmark_order_book(repeats=20, n_messages=100000):
+    """ DataFeed book building and incremental updates """
+
+    for n_expiries, strikes_per_expiry in [(12, 40), (16, 80)]:
+        snapshots = synthetic_book_snapshots(synthetic_bbo_snapshot(n_expiries, strikes_per_expiry))
+        changes = synthetic_change_stream(snapshots, n_messages)
+        feed = DataFeed()
+
+        def build():
+            for snapshot in snapshots:
+                feed.build_ob_from_snapshots(snapshot)
+
+        def replay():
+            for change in changes:
+                feed.update_ob(change)
+
+        build_ms = timeit(build, repeats, "build_ob_from_snapshots", books=len(snapshots))
+        replay_ms = timeit(replay, repeats, "update_ob", books=len(snapshots), messages=n_messages, setup=build)
+        print("book     {:>5} books    snapshots {:8.2f} ms ({:5.2f} us each)  {} changes {:8.2f} ms "
+              "({:5.2f} us each, {:,.0f}/s)".format(len(snapshots), build_ms, build_ms * 1000 / len(snapshots),
+                                                    n_messages, replay_ms, replay_ms * 1000 / n_messages,
+                                                    n_messages / replay_ms * 1000))
+
+
+def benchmark_message_distribution(repeats=10, n_messages=100000):
+    """ WSClient's parsing and dispatch of a realistic message mix, including the book updates """
+
+    for n_expiries, strikes_per_expiry in [(12, 40), (16, 80)]:
+        df = synthetic_bbo_snapshot(n_expiries, strikes_per_expiry)
+        snapshots = synthetic_book_snapshots(df)
+        snapshot_frames, stream = synthetic_ws_messages(df, snapshots, synthetic_change_stream(snapshots, n_messages))
+        feed = DataFeed()
+        client = WSClient(feed, DeltaHedge(feed, run_threads=False), "", "")
+        client.trade_bars = TradeBars()
+
+        def build():
+            for message in snapshot_frames:
+                client.message_distribution(message)
+
+        def replay():
+            for message in stream:
+                client.message_distribution(message)
+
+        replay_ms = timeit(replay, repeats, "message_distribution", books=len(snapshots),
+                           messages=len(stream), setup=build)
+        print("ws       {:>5} books    {} messages {:8.2f} ms ({:5.2f} us each, {:,.0f}/s)".format(
+              len(snapshots), len(stream), replay_ms, replay_ms * 1000 / len(stream),
+              len(stream) / replay_ms * 1000))
+
+
+def benchmark_snapshot(repeats=5):
+    """ SaveBBO's periodic snapshot from the live books, without the database
+    writes and the SVI fit; IVs solved from scratch or from the cache """
+
+    for n_expiries, strikes_per_expiry in [(12, 40), (16, 80)]:
+        df = synthetic_bbo_snapshot(n_expiries, strikes_per_expiry)
+        feed = DataFeed()
+        for snapshot in synthetic_book_snapshots(df):
+            feed.build_ob_from_snapshots(snapshot)
+            feed.oi[snapshot["instrument_name"]] = 0
+        feed.btcusd_best_bid = df["btcusd_price"].iloc[0] - 0.25
+        feed.btcusd_best_ask = df["btcusd_price"].iloc[0] + 0.25
+        save_bbo = SaveBBO(feed)
+        save_bbo.bvix.fit_svi = False
+        ts = df["timestamp"].iloc[0].to_pydatetime()
+
+        # the frame take_snapshot collects from the books, as input for options_calculations
+        collected = []
+        save_bbo.options_calculations = lambda frame: collected.append(frame.copy())
+        save_bbo.take_snapshot(ts)
+        del save_bbo.options_calculations
+
+        def clear_cache():
+            save_bbo.iv_cache = IVCache()
+
+        snapshot_ms = timeit(lambda: save_bbo.take_snapshot(ts), repeats, "take_snapshot",
+                             options=len(df), setup=clear_cache)
+        cold_ms = timeit(lambda: save_bbo.options_calculations(collected[0].copy()), repeats,
+                         "options_calculations_cold", options=len(df), setup=clear_cache)
+        warm_ms = timeit(lambda: save_bbo.options_calculations(collected[0].copy()), repeats,
+                         "options_calculations_cached", options=len(df))
+        print("snapshot {:>5} options  take_snapshot {:8.2f} ms  options_calculations {:8.2f} ms  "
+              "cached IVs {:8.2f} ms".format(len(df), snapshot_ms, cold_ms, warm_ms))
+
+
+BENCHMARKS = {"volsurf":benchmark_volsurf, "iv":benchmark_iv_solver, "svi":benchmark_svi,
+              "bs":validate_black_scholes, "greeks":benchmark_portfolio_greeks, "risk":benchmark_risk_grid,
+              "hedge":benchmark_hedge_optimizer, "book":benchmark_order_book,
+              "ws":benchmark_message_distribution, "snapshot":benchmark_snapshot}
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"time":datetime.now(pytz.UTC).isoformat(timespec="seconds"), "commit":commit,
+            "python":platform.python_version(), "numpy":np.__version__, "pandas":pd.__version__,
+            "machine":platform.machine(), "cpus":os.cpu_count()}
+
+
+def result_key(result):
+    return result["name"], json.dumps(result["params"], sort_keys=True)
+
+
+def spread(result):
+    """ Range of a timing's repeats, without the slowest 5% """
+    return result["p95_ms"] - result["min_ms"]
+
+
+def compare(results, baseline, threshold):
+    """ Prints every timing against the baseline run and returns the
+    regressions: the median got slower by more than threshold (relative) and
+    by more than the spreads of both runs together, so the timings of the two
+    runs barely overlap """
+
+    previous = {result_key(r):r for r in baseline["results"]}
+    regressions = []
+    print("\nAgainst {} ({}), median (spread min to p95):".format(baseline["environment"].get("commit"),
+                                                                  baseline["environment"].get("time")))
+    for result in results:
+        old = previous.get(result_key(result))
+        if old is None:
+            continue
+        ratio = result["median_ms"] / old["median_ms"] if old["median_ms"] > 0 else np.inf
+        regressed = (ratio > 1 + threshold
+                     and result["median_ms"] - old["median_ms"] > spread(old) + spread(result))
+        if regressed:
+            regressions.append(dict(result, baseline_median_ms=old["median_ms"], ratio=ratio))
+        print("  {:<40} {:>10.3f} ms ({:>8.3f}) -> {:>10.3f} ms ({:>8.3f})  {:>6.2f}x{}".format(
+              "{} {}".format(result["name"], " ".join("{}={}".format(k, v) for k, v in result["params"].items())),
+              old["median_ms"], spread(old), result["median_ms"], spread(result), ratio,
+              "  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the feed handlers and analytics on synthetic data.")
+    parser.add_argument("--only", help="comma separated subset of: {}".format(", ".join(BENCHMARKS)))
+    parser.add_argument("--output", help="JSON file for the results, "
+                                         "default: benchmark_results/<time>-<commit>.json")
+    parser.add_argument("--compare", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2,
+                        help="relative slowdown of the median reported as regression, if it also exceeds "
+                             "the spreads of both runs (default 0.2)")
+    args = parser.parse_args()
+
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if len(unknown) > 0:
+        parser.error("unknown benchmarks: {}".format(", ".join(unknown)))
+    for name in names:
+        BENCHMARKS[name]()
+
+    env = environment()
+    output = args.output
+    if output is None:
+        output = os.path.join("benchmark_results", "{}-{}.json".format(
+                              datetime.now().strftime("%Y%m%d-%H%M%S"), env["commit"] or "unknown"))
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"environment":env, "results":RESULTS}, f, indent=1)
+    print("\n{} timings written to {}.".format(len(RESULTS), output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(RESULTS, json.load(f), args.threshold)
+        if len(regressions) > 0:
+            print("{} regression(s) above {:.0%}.".format(len(regressions), args.threshold))
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
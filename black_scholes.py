@@ -0,0 +1,104 @@
+import numpy as np
+from scipy.special import ndtr
+
+
+""" Vectorized generalized Black-Scholes kernel. Every requested greek of
+arrays of options comes out of one shared d1/d2 evaluation. """
+
+
+SQRT_2PI = np.sqrt(2 * np.pi)
+ALL_GREEKS = ["price", "delta", "gamma", "vega", "theta", "vanna", "charm", "rho", "d1", "d2"]
+
+
+def greeks(S, X, sigma, ttm, otype, requested=ALL_GREEKS, r=0, q=0, inverse=False):
+    """
+    S, X, sigma, ttm: spot, strike, volatility and time to maturity in years
+    otype: "c"/"p" (any case) or booleans, True for calls
+    requested: names out of ALL_GREEKS
+    inverse: adjust for Deribit's BTC-settled options. The price, vega, theta
+        and rho are returned in BTC, delta is the premium-adjusted delta
+        (BS delta minus the premium in BTC) and gamma, vanna and charm are
+        the derivatives of that delta.
+
+    vega, vanna and rho are per vol / rate point, theta per day and charm per year.
+    Returns a dict of arrays.
+    """
+
+    S, X, sigma, ttm, r, q = np.broadcast_arrays(*[np.asarray(a, dtype=float) for a in (S, X, sigma, ttm, r, q)])
+    otype = np.asarray(otype)
+    if otype.dtype.kind in ("U", "S", "O"):
+        is_call = np.char.lower(otype.astype(str)) == "c"
+    else:
+        is_call = otype.astype(bool)
+
+    wanted = set(requested)
+    requested = set(requested)
+    if inverse:
+        # the premium adjustment needs the USD values these are derived from
+        requested |= {"price", "delta"} if "delta" in requested else set()
+        requested |= {"price", "delta", "gamma"} if "gamma" in requested else set()
+        requested |= {"vega", "vanna"} if "vanna" in requested else set()
+        requested |= {"theta", "charm"} if "charm" in requested else set()
+
+    b = r - q
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sqrt_t = np.sqrt(ttm)
+        vol_sqrt_t = sigma * sqrt_t
+        d1 = (np.log(S / X) + (b + sigma**2 / 2) * ttm) / vol_sqrt_t
+        d2 = d1 - vol_sqrt_t
+        carry = np.exp((b - r) * ttm)
+        discount = np.exp(-r * ttm)
+        pdf_d1 = np.exp(-d1**2 / 2) / SQRT_2PI
+        # N(d) for calls, N(-d) for puts, with the matching sign
+        sign = np.where(is_call, 1.0, -1.0)
+        cdf_d1 = ndtr(sign * d1)
+        cdf_d2 = ndtr(sign * d2)
+
+        result = {}
+        if "d1" in requested:
+            result["d1"] = d1
+        if "d2" in requested:
+            result["d2"] = d2
+        if "price" in requested:
+            result["price"] = sign * (S * carry * cdf_d1 - X * discount * cdf_d2)
+        if "delta" in requested:
+            result["delta"] = sign * carry * cdf_d1
+        if "gamma" in requested:
+            result["gamma"] = carry * pdf_d1 / (S * vol_sqrt_t)
+        if "vega" in requested:
+            result["vega"] = 0.01 * S * carry * pdf_d1 * sqrt_t
+        if "theta" in requested:
+            result["theta"] = (-S * carry * pdf_d1 * sigma / (2 * sqrt_t)
+                               - sign * (b - r) * S * carry * cdf_d1
+                               - sign * r * X * discount * cdf_d2) / 365
+        if "vanna" in requested:
+            result["vanna"] = -carry * d2 / sigma * pdf_d1 / 100
+        if "charm" in requested:
+            result["charm"] = -carry * (pdf_d1 * (b / vol_sqrt_t - d2 / (2 * ttm)) + sign * (b - r) * cdf_d1)
+        if "rho" in requested:
+            result["rho"] = sign * 0.01 * X * ttm * discount * cdf_d2
+
+        if inverse:
+            result = inverse_adjustment(result, S)
+
+    return {greek:values for greek, values in result.items() if greek in wanted}
+
+
+def inverse_adjustment(result, S):
+    """ Converts USD greeks into those of an option priced in BTC (price / S) """
+
+    usd = dict(result)
+    if "price" in usd:
+        result["price"] = usd["price"] / S
+    if "delta" in usd:
+        result["delta"] = usd["delta"] - usd["price"] / S
+    if "gamma" in usd:
+        result["gamma"] = usd["gamma"] - usd["delta"] / S + usd["price"] / S**2
+    if "vanna" in usd:
+        result["vanna"] = usd["vanna"] - usd["vega"] / S
+    if "charm" in usd:
+        result["charm"] = usd["charm"] - usd["theta"] * 365 / S
+    for greek in ["vega", "theta", "rho"]:
+        if greek in usd:
+            result[greek] = usd[greek] / S
+    return result
@@ -1,4 +1,5 @@
 from datetime import datetime
+import multiprocessing
 import pytz
 import psycopg2
 import threading
@@ -10,6 +11,21 @@ from ws_client import WSClient
 from save_top_of_book import SaveBBO
 from data_feed import DataFeed
 from hedger import DeltaHedge
+from live_surface import LiveVolSurface
+from risk_grid import ScenarioRisk
+from execution import ExecutionManager
+from hedge_optimizer import GreekHedgeOptimizer
+from volatility_index import BVIX
+from shared_book import SharedBook, SharedFeed, OrderChannel, RemoteHedger, serve_orders, run_hedger
+from metrics import MetricsServer
+from profiler import SamplingProfiler, set_timing
+from checkpoint import Checkpoint
+from trade_bars import TradeBars
+from option_flow import OptionFlow
+from subscription_tiers import SubscriptionTiers
+from standby import StandbyClient
+from timeseries import TimeSeriesStore
+import profiler
 import configparser
 
 
@@ -25,58 +41,196 @@ class Bot:
         self.api_information = dict(config.items("API"))
         self.database_information = dict(config.items("PostgreSQL"))
         
-        database = self.database_information["database"]
-        user = self.database_information["user"]
-        password = self.database_information["password"]
-        host = self.database_information["host"]
-        port = self.database_information["port"]
-        if host == "localhost":
-            host_numeric = "127.0.0.1"
-        else:
-            host_numeric = host
-        
-        self.conn = psycopg2.connect(database=database, 
-                                     user=user, 
-                                     password=password, 
-                                     host=host, 
-                                     port=port)
-        
-        self.c = self.conn.cursor()
-        self.db_connection_url = "postgresql://{}:{}@{}:{}/{}".format(database, 
-                                                                      password, 
-                                                                      host_numeric, 
-                                                                      port,
-                                                                      user)
-        self.engine = create_engine(self.db_connection_url)
-        
-        db_connection = {"c":self.c, "conn":self.conn, "engine":self.engine}
+        db_connection = connect_database(self.database_information)
+        self.c, self.conn, self.engine = db_connection["c"], db_connection["conn"], db_connection["engine"]
         
         self.api_key = self.api_information["api_key"]
         self.api_secret = self.api_information["api_secret"]
         
+        self.snapshot_settings = dict()
+        if config.has_section("Snapshots"):
+            price, size, oi, iv = [config.getfloat("Snapshots", option) for option in
+                                   ["price_tolerance", "size_tolerance", "oi_tolerance", "iv_tolerance"]]
+            self.snapshot_settings = {"change_only":config.getboolean("Snapshots", "change_only"), 
+                                      "keyframe_interval":config.getint("Snapshots", "keyframe_interval"),
+                                      "change_tolerance":{"bid":price, "bid_size":size, "ask":price, 
+                                                          "ask_size":size, "oi":oi, "bid_iv":iv, "ask_iv":iv}}
+        
         self.feed = DataFeed()
         
-        self.delta_hedger = DeltaHedge(self.feed)
+        """ In multi-process mode, SaveBBO / BVIX and DeltaHedge run in their own 
+        processes and read the feed from shared memory, so surface building and 
+        IV solving do not hold the GIL of the websocket thread """
+        
+        self.multi_process = config.has_section("Processes") and config.getboolean("Processes", "multi_process")
+        if self.multi_process:
+            self.context = multiprocessing.get_context("spawn")
+            self.shared_book = SharedBook(create=True)
+            self.feed.shared = self.shared_book
+            self.hedger_control = self.context.Queue()
+            self.order_requests = self.context.Queue()
+            self.order_updates = self.context.Queue()
+            self.stop_processes = self.context.Event()
+            self.delta_hedger = RemoteHedger(self.feed, self.hedger_control)
+        else:
+            self.delta_hedger = DeltaHedge(self.feed)
         
         self.client = WSClient(self.feed, self.delta_hedger, 
                                self.api_key, self.api_secret)
         
-        self.save_bbo = SaveBBO(self.feed, db_connection)
+        """ Tiered subscriptions: only near-ATM, short-dated, high-OI and held 
+        options get raw books, the rest grouped top-of-book channels """
+        
+        self.tiers = None
+        if config.has_section("Subscriptions") and config.getboolean("Subscriptions", "tiered"):
+            self.tiers = SubscriptionTiers(self.feed)
+            for option in ["raw_moneyness", "raw_max_days", "raw_min_oi", "hysteresis", "evaluation_interval"]:
+                setattr(self.tiers, option, config.getfloat("Subscriptions", option))
+            self.tiers.depth = config.getint("Subscriptions", "depth")
+            self.tiers.interval = config.get("Subscriptions", "interval")
+            self.tiers.send_to_ws = self.client.send_to_ws
+            self.client.tiers = self.tiers
+            self.delta_hedger.commands["tiers"] = lambda: self.tiers.report()
+        
+        # hot standby: a second connection for the perpetual book, user channels and held options
+        self.standby = None
+        if config.has_section("Standby") and config.getboolean("Standby", "enabled"):
+            self.standby = StandbyClient(self.client)
+            self.client.standby = self.standby
+        
+        self.execution = ExecutionManager()
+        if config.has_section("Execution"):
+            self.execution.matching_engine.refill_per_second = config.getfloat("Execution", "orders_per_second")
+            self.execution.matching_engine.max_credits = config.getfloat("Execution", "order_burst")
+        self.execution.send_to_ws = self.client.send_to_ws
+        self.client.execution = self.execution
+        self.delta_hedger.execution = self.execution
+        self.delta_hedger.commands["orders"] = lambda: self.execution.report()
+        
+        if self.multi_process:
+            self.save_bbo = None
+            bvix = BVIX() # grid definition for the live surface, the snapshot process writes bvix
+        else:
+            self.save_bbo = SaveBBO(self.feed, db_connection)
+            for option, value in self.snapshot_settings.items():
+                setattr(self.save_bbo, option, value)
+            bvix = self.save_bbo.bvix
+        
+        self.live_surface = LiveVolSurface(self.feed, bvix)
+        self.delta_hedger.surface = self.live_surface
+        
+        self.risk = ScenarioRisk(self.feed)
+        if config.has_section("Scenarios"):
+            for option in ["spot_shocks", "vol_shifts", "time_shifts"]:
+                setattr(self.risk, option, [float(x) for x in config.get("Scenarios", option).split(",")])
+        self.delta_hedger.commands["risk"] = lambda: self.risk.report()
         
+        self.trade_bars = TradeBars(db_connection)
+        self.client.trade_bars = self.trade_bars
+        self.delta_hedger.trade_bars = self.trade_bars
+        self.delta_hedger.commands["bars"] = lambda: self.trade_bars.report()
+        
+        # option trade flow per surface bucket, opt-in since it adds the busiest public channel
+        self.option_flow = None
+        if config.has_section("OptionFlow") and config.getboolean("OptionFlow", "enabled"):
+            self.option_flow = OptionFlow(bvix, db_connection, 
+                                          [int(x) for x in config.get("OptionFlow", "horizons").split(",")])
+            self.client.option_flow = self.option_flow
+            self.delta_hedger.option_flow = self.option_flow
+            self.delta_hedger.commands["flow"] = lambda: self.option_flow.report()
+        
+        # lookbacks of the surface, mid IVs and greeks without the database
+        resolutions, max_instruments = None, 2500
+        if config.has_section("TimeSeries"):
+            resolutions = {1:config.getint("TimeSeries", "seconds"), 60:config.getint("TimeSeries", "minutes"), 
+                           3600:config.getint("TimeSeries", "hours")}
+            max_instruments = config.getint("TimeSeries", "max_instruments")
+        self.timeseries = TimeSeriesStore(self.live_surface, self.risk, resolutions, max_instruments)
+        if config.has_section("TimeSeries"):
+            self.timeseries.interval = config.getfloat("TimeSeries", "interval")
+        self.delta_hedger.timeseries = self.timeseries
+        self.delta_hedger.commands["history"] = lambda: self.timeseries.report()
+        
+        self.hedge_optimizer = GreekHedgeOptimizer(self.feed)
+        self.delta_hedger.commands["optimize"] = lambda: self.hedge_optimizer.report()
+        
+        self.profiler = SamplingProfiler()
+        self.profiler.install_signal()
+        if config.has_section("Profiling"):
+            self.profiler.interval = config.getfloat("Profiling", "interval")
+            self.profiler.output_dir = config.get("Profiling", "output_dir")
+            set_timing(config.getboolean("Profiling", "timing"))
+        self.delta_hedger.commands["profile"] = lambda: self.profiler.toggle()
+        self.delta_hedger.commands["timing"] = lambda: self.toggle_timing()
+        
+        self.metrics_server = MetricsServer()
+        if config.has_section("Metrics"):
+            self.metrics_server.host = config.get("Metrics", "host")
+            self.metrics_server.port = config.getint("Metrics", "port")
+        
+        """ Warm restart: the last checkpoint is served as stale until the 
+        exchange's snapshots and positions replace it """
+        
+        self.checkpoint = Checkpoint(self.feed, self.live_surface, self.save_bbo)
+        if config.has_section("Checkpoint"):
+            self.checkpoint.path = config.get("Checkpoint", "path")
+            self.checkpoint.interval = config.getfloat("Checkpoint", "interval")
+            self.checkpoint.max_age = config.getfloat("Checkpoint", "max_age")
+        self.checkpoint.restore()
+        
+        
+        
+    def toggle_timing(self):
+        set_timing(not profiler.timing_enabled)
+        return "Hot path timing {}, see function_seconds in the metrics.".format(
+            "enabled" if profiler.timing_enabled else "disabled")
         
         
     def run(self):
         
+        self.metrics_server.start()
+        
+        if self.multi_process:
+            self.start_processes()
+        
         if not self.client.connected:
             self.logger.info("Starting websocket-client.")
             self.client.create_ws_connection()
             
+        if self.standby is not None:
+            self.logger.info("Starting standby websocket.")
+            self.standby.start()
+            
         """ Create separate thread to periodically store top-of-the-book 
         snapshots to a local database"""
         
-        self.logger.info("Starting BBO scheduling thread.")
-        self.save_bbo_thread = threading.Thread(target=lambda: self.save_bbo.schedule_snapshot())
-        self.save_bbo_thread.start()
+        if not self.multi_process:
+            self.logger.info("Starting BBO scheduling thread.")
+            self.save_bbo_thread = threading.Thread(target=lambda: self.save_bbo.schedule_snapshot())
+            self.save_bbo_thread.start()
+        
+        self.logger.info("Starting live volatility surface thread.")
+        self.live_surface.start()
+        
+        self.logger.info("Starting scenario risk thread.")
+        self.risk.start()
+        
+        self.logger.info("Starting time-series store thread.")
+        self.timeseries.start()
+        
+        self.logger.info("Starting checkpoint thread.")
+        self.checkpoint.start()
+        
+        self.logger.info("Starting perpetual trade bars thread.")
+        self.trade_bars.start()
+        
+        if self.option_flow is not None:
+            self.logger.info("Starting option trade flow thread.")
+            self.option_flow.start()
+        
+        if self.tiers is not None:
+            self.logger.info("Starting subscription tier thread.")
+            self.tiers.start()
         
         """ Reconnect every day at around 8:00 AM UTC 
         in order to subscribe to newly introduced contracts """
@@ -93,10 +247,135 @@ class Bot:
                     
             except KeyboardInterrupt:
                 self.logger.info("KeyboardInterrupt - Shutting down.")
-                self.save_bbo.stop_taking_snapshots = True
+                if self.multi_process:
+                    self.stop_all_processes()
+                else:
+                    self.save_bbo.stop_taking_snapshots = True
+                    self.save_bbo.bvix.svi.shutdown()
+                self.live_surface.stop_surface = True
+                self.risk.stop_risk = True
+                self.timeseries.stop_store = True
+                self.execution.stop_execution = True
+                self.checkpoint.stop_checkpoint = True
+                self.checkpoint.save()
+                self.trade_bars.stop_bars = True
+                self.trade_bars.save()
+                if self.option_flow is not None:
+                    self.option_flow.stop_flow = True
+                    self.option_flow.save()
+                if self.tiers is not None:
+                    self.tiers.stop_tiers = True
+                self.metrics_server.shutdown()
+                self.profiler.stop()
+                if self.standby is not None:
+                    self.standby.stop()
                 self.client.do_not_reconnect = True
                 self.client.shutdown()
                 time.sleep(2)
                 break
+                
+                
+    def start_processes(self):
+        self.logger.info("Starting snapshot and hedger processes.")
+        self.order_thread = threading.Thread(target=lambda: serve_orders(self.execution, self.order_requests, 
+                                                                         self.order_updates), daemon=True)
+        self.order_thread.start()
+        
+        # child processes serve their metrics on the next ports
+        port = self.metrics_server.port
+        self.snapshot_process = self.context.Process(target=run_snapshot_process, name="snapshots", 
+                                                     args=(self.shared_book.name, self.database_information, 
+                                                           self.snapshot_settings, self.stop_processes, port + 1))
+        self.hedger_process = self.context.Process(target=run_hedger_process, name="hedger", 
+                                                   args=(self.shared_book.name, self.hedger_control, 
+                                                         self.order_requests, self.order_updates, port + 2))
+        self.snapshot_process.start()
+        self.hedger_process.start()
+        
+        
+    def stop_all_processes(self):
+        self.stop_processes.set()
+        self.delta_hedger.stop()
+        self.order_requests.put(None)
+        for process in [self.snapshot_process, self.hedger_process]:
+            process.join(timeout=10)
+            if process.is_alive():
+                self.logger.info("{} process did not stop, terminating it.".format(process.name))
+                process.terminate()
+        self.shared_book.close()
+            
+            
+def connect_database(database_information):
+    """ Cursor, connection and SQLAlchemy engine, as SaveBBO and BVIX take them """
+    
+    database = database_information["database"]
+    user = database_information["user"]
+    password = database_information["password"]
+    host = database_information["host"]
+    port = database_information["port"]
+    if host == "localhost":
+        host_numeric = "127.0.0.1"
+    else:
+        host_numeric = host
+    
+    conn = psycopg2.connect(database=database, 
+                            user=user, 
+                            password=password, 
+                            host=host, 
+                            port=port)
+    
+    db_connection_url = "postgresql://{}:{}@{}:{}/{}".format(database, 
+                                                             password, 
+                                                             host_numeric, 
+                                                             port,
+                                                             user)
+    return {"c":conn.cursor(), "conn":conn, "engine":create_engine(db_connection_url)}
+
+
+def setup_process_logger():
+    formatter = logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(processName)s - %(module)s - %(message)s')
+    handler = logging.StreamHandler()
+    handler.setFormatter(formatter)
+    logger = logging.getLogger("deribit")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+    return logger
+
+
+def run_snapshot_process(shared_book_name, database_information, snapshot_settings, stop, metrics_port):
+    """ SaveBBO and BVIX on the feed published by the ingest process """
+    
+    logger = setup_process_logger()
+    book = SharedBook(shared_book_name)
+    save_bbo = SaveBBO(SharedFeed(book), connect_database(database_information))
+    for option, value in snapshot_settings.items():
+        setattr(save_bbo, option, value)
+    MetricsServer(port=metrics_port).start()
+    
+    snapshot_thread = threading.Thread(target=lambda: save_bbo.schedule_snapshot())
+    snapshot_thread.start()
+    stop.wait()
+    logger.info("Stopping snapshots.")
+    save_bbo.stop_taking_snapshots = True
+    snapshot_thread.join()
+    save_bbo.bvix.svi.shutdown()
+    book.close()
+    
+    
+def run_hedger_process(shared_book_name, control, order_requests, order_updates, metrics_port):
+    """ DeltaHedge on the feed published by the ingest process, controlled by 
+    its RemoteHedger; orders are sent through the ingest process """
+    
+    setup_process_logger()
+    book = SharedBook(shared_book_name)
+    hedger = DeltaHedge(SharedFeed(book), run_threads=False)
+    hedger.execution = OrderChannel(order_requests, order_updates)
+    MetricsServer(port=metrics_port).start()
+    
+    hedger.evaluation_thread = threading.Thread(target=lambda: hedger.evaluation_loop())
+    hedger.evaluation_thread.start()
+    run_hedger(hedger, control)
+    hedger.evaluation_thread.join()
+    book.close()
             
             
@@ -0,0 +1,160 @@
+from datetime import datetime
+import json
+import os
+import threading
+import time
+import numpy as np
+import pytz
+import logging
+
+from instruments import is_option, parse_option
+
+
+class Checkpoint:
+
+    """
+    Writes the in-memory state (instrument list, order books, OI, BTC-PERPETUAL
+    quotes, positions, open orders, live surface, IV warm starts) to one
+    compressed .npz file periodically and on shutdown, and restores it at
+    startup. Restored books, positions and orders are marked stale in the
+    DataFeed until the exchange sends fresh data for them; the live surface
+    keeps its original refresh times, so it reads as old until recomputed.
+    Dynamic hedging is never re-activated from a checkpoint.
+    """
+
+    def __init__(self, feed, live_surface=None, save_bbo=None, path="state.npz"):
+        self.feed = feed
+        self.live_surface = live_surface
+        self.save_bbo = save_bbo
+        self.logger = logging.getLogger("deribit")
+
+        self.path = path
+        self.interval = 60 # seconds between checkpoints
+        self.max_age = 3600 # older checkpoints are ignored at startup (seconds)
+        self.max_stale_time = 60 # restored books without a fresh snapshot after this are dropped (seconds)
+        self.stop_checkpoint = False
+
+        self.restored_at = None
+        self.last_save = 0
+        self.last_save_time = 0 # seconds taken by the last save
+
+
+    def start(self):
+        self.stop_checkpoint = False
+        self.checkpoint_thread = threading.Thread(target=lambda: self.run())
+        self.checkpoint_thread.start()
+
+
+    def run(self):
+        while not self.stop_checkpoint:
+            time.sleep(1)
+            if self.restored_at is not None and time.time() - self.restored_at > self.max_stale_time:
+                dropped = self.feed.drop_stale()
+                if dropped > 0:
+                    self.logger.info("Dropped {} restored books without a fresh snapshot.".format(dropped))
+                self.restored_at = None
+            if time.time() - self.last_save >= self.interval:
+                self.save()
+
+
+    def collect(self):
+        """ State as arrays; the books are flattened into one row per price level """
+
+        feed = self.feed
+        contracts = list(feed.contracts)
+        names, sides, prices, sizes = [], [], [], []
+        for name, book in list(feed.ob.items()):
+            for side, levels in [(0, book["bids"]), (1, book["asks"])]:
+                for price, size in list(levels.items()):
+                    names.append(name)
+                    sides.append(side)
+                    prices.append(price)
+                    sizes.append(size)
+        oi = list(feed.oi.items())
+        other = {"positions":dict(feed.positions), "orders":{i:dict(o) for i, o in list(feed.orders.items())}}
+
+        state = {"saved_at":np.array(time.time()), "contracts":np.array(contracts, dtype=str),
+                 "book_instrument":np.array(names, dtype=str), "book_side":np.array(sides, dtype=np.int8),
+                 "book_price":np.array(prices, dtype=float), "book_size":np.array(sizes, dtype=float),
+                 "oi_instrument":np.array([k for k, v in oi], dtype=str),
+                 "oi":np.array([v for k, v in oi], dtype=float),
+                 "btcusd":np.array([feed.btcusd_best_bid, feed.btcusd_best_ask], dtype=float),
+                 "json":np.frombuffer(json.dumps(other, default=str).encode(), dtype=np.uint8)}
+
+        if self.live_surface is not None:
+            surface, refreshed, updated = self.live_surface.grid()
+            state.update({"surface":surface, "surface_refreshed":refreshed, "surface_updated":np.array(updated)})
+
+        if self.save_bbo is not None:
+            previous_iv = list(self.save_bbo.iv_cache.previous_iv.items())
+            state.update({"iv_instrument":np.array([k[0] for k, v in previous_iv], dtype=str),
+                          "iv_side":np.array([k[1] for k, v in previous_iv], dtype=str),
+                          "iv":np.array([v for k, v in previous_iv], dtype=float)})
+        return state
+
+
+    def save(self):
+        start = time.perf_counter()
+        try:
+            state = self.collect()
+            # written next to the target and renamed, a crash never leaves a partial checkpoint
+            temporary = self.path + ".tmp"
+            with open(temporary, "wb") as f:
+                np.savez_compressed(f, **state)
+            os.replace(temporary, self.path)
+        except Exception as e:
+            self.logger.info("Error writing checkpoint: {}".format(e))
+        self.last_save = time.time()
+        self.last_save_time = time.perf_counter() - start
+
+
+    def restore(self):
+        """ Loads the checkpoint into the feed, the live surface and the IV
+        cache; returns False when there is none or it is too old """
+
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with np.load(self.path, allow_pickle=False) as state:
+                state = dict(state)
+        except Exception as e:
+            self.logger.info("Error reading checkpoint {}: {}".format(self.path, e))
+            return False
+
+        age = time.time() - float(state["saved_at"])
+        if age > self.max_age:
+            self.logger.info("Checkpoint is {:.0f}s old, starting cold.".format(age))
+            return False
+
+        # expired instruments are left out
+        now = datetime.now(pytz.UTC)
+        def live(name):
+            return not is_option(name) or parse_option(name)[0] > now
+
+        ob = dict()
+        for name, side, price, size in zip(state["book_instrument"].tolist(), state["book_side"].tolist(),
+                                           state["book_price"].tolist(), state["book_size"].tolist()):
+            if live(name):
+                book = ob.setdefault(name, {"bids":dict(), "asks":dict()})
+                book["bids" if side == 0 else "asks"][price] = size
+        other = json.loads(state["json"].tobytes().decode())
+        self.feed.restore(contracts=[c for c in state["contracts"].tolist() if live(c)], ob=ob,
+                          oi={k:v for k, v in zip(state["oi_instrument"].tolist(), state["oi"].tolist()) if live(k)},
+                          btcusd=state["btcusd"].tolist(),
+                          positions={k:v for k, v in other["positions"].items() if live(k)},
+                          orders={k:v for k, v in other["orders"].items() if live(k)})
+
+        if self.live_surface is not None and "surface" in state:
+            if state["surface"].shape == self.live_surface.state[0].shape:
+                self.live_surface.state = (state["surface"], state["surface_refreshed"],
+                                           float(state["surface_updated"]))
+
+        if self.save_bbo is not None and "iv" in state:
+            self.save_bbo.iv_cache.previous_iv.update({(k, s):v for k, s, v in zip(
+                state["iv_instrument"].tolist(), state["iv_side"].tolist(), state["iv"].tolist()) if live(k)})
+
+        self.restored_at = time.time()
+        self.logger.info("Restored {} books, {} positions and {} instruments with open orders from a {:.0f}s old "
+                         "checkpoint, marked stale until refreshed.".format(len(ob), len(other["positions"]),
+                                                                            len(other["orders"]), age))
+        return True
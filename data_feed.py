@@ -1,11 +1,18 @@
 from datetime import datetime
 import logging
 
+from metrics import REGISTRY
+from profiler import timed
+from instruments import is_option
+
 class DataFeed:
     
     def __init__(self):
         self.logger = logging.getLogger("deribit")
         self.ob = dict() # THE WHOLE ORDERBOOK
+        self.book_version = dict() # instrument -> number of book messages processed, to detect changed books
+        self.ticker_messages = dict() # instrument -> number of ticker messages processed
+        self.grouped = set() # instruments subscribed to grouped (top levels) instead of raw books, see SubscriptionTiers
         self.oi = dict()
         self.btcusd_best_bid = 0
         self.btcusd_best_ask = 0
@@ -14,11 +21,62 @@ class DataFeed:
         self.trades = {}
         self.positions = {}
         self.contracts = []
+        self.shared = None # SharedBook, in multi-process mode books, OI, spot and positions are published to it
+        
+        # restored from a checkpoint and not confirmed by the exchange yet
+        self.stale = set() # instruments whose book has not had a fresh snapshot
+        self.stale_positions = set()
+        self.stale_orders = False
+        
+        REGISTRY.gauge("books", "Order books held in memory").set_function(lambda: len(self.ob))
+        REGISTRY.gauge("contracts", "Active options contracts").set_function(lambda: len(self.contracts))
+        REGISTRY.gauge("positions", "Open positions").set_function(lambda: len(self.positions))
+        book_messages = REGISTRY.counter("book_messages_total", "Order book messages applied", ["type"])
+        self.book_snapshots = book_messages.labels("snapshot")
+        self.book_changes = book_messages.labels("change")
+        self.book_grouped = book_messages.labels("grouped")
+    
+    def spot(self):
+        """ (best bid, best ask) of BTC-PERPETUAL """
+        return self.btcusd_best_bid, self.btcusd_best_ask
+    
     
     def update_contracts(self, contracts):
         self.contracts = contracts
+        listed = set(contracts)
+        for instrument_name in [c for c in self.stale if c not in listed and is_option(c)]:
+            self.ob.pop(instrument_name, None)
+            self.stale.discard(instrument_name)
+    
+    
+    def restore(self, contracts, ob, oi, btcusd, positions, orders):
+        """ State from a checkpoint, kept as stale until fresh data replaces it """
+        
+        self.contracts = contracts
+        self.ob.update(ob)
+        self.stale = set(ob)
+        self.oi.update(oi)
+        self.btcusd_best_bid, self.btcusd_best_ask = btcusd
+        self.positions.update(positions)
+        self.stale_positions = set(positions)
+        self.orders.update(orders)
+        self.stale_orders = len(orders) > 0
+        
+        
+    def drop_stale(self):
+        """ Removes restored books that never got a fresh snapshot, returns how many """
+        
+        stale = list(self.stale)
+        for instrument_name in stale:
+            self.ob.pop(instrument_name, None)
+        self.stale = set()
+        return len(stale)
+    
     
     def initial_open_orders(self, data):
+        if self.stale_orders: # the exchange's list replaces the restored one
+            self.orders = {}
+            self.stale_orders = False
         for order in data:
             order["replaced"] = False
             order["original_order_type"] = "limit"
@@ -31,10 +89,17 @@ class DataFeed:
                 self.orders[instrument_name][order_id] = order
             
     
-    def initial_positions(self, data):
+    def initial_positions(self, data, kind=None):
+        if kind is not None:
+            # restored positions of this kind are replaced by the exchange's
+            for instrument_name in [p for p in self.stale_positions if is_option(p) == (kind == "option")]:
+                self.positions.pop(instrument_name, None)
+                self.stale_positions.discard(instrument_name)
         for position in data:
             instrument_name = position["instrument_name"]
             self.positions[instrument_name] = position
+        if self.shared is not None:
+            self.shared.publish_positions(self.positions)
         
         
     def update_positions(self, data):
@@ -68,6 +133,9 @@ class DataFeed:
                     
                 else:
                     self.positions[instrument_name]["size"] -= amount
+        
+        if self.shared is not None:
+            self.shared.publish_positions(self.positions)
             
     
     def manage_orders(self, data):
@@ -90,7 +158,7 @@ class DataFeed:
                         del self.orders[instrument_name][order_id]
                     
                     else: # partially filled, and generally open orders which are already in the system
-                        self.order[instrument_name][order_id] = data
+                        self.orders[instrument_name][order_id] = data
                         
                 else: # open orders which are not in the system yet
                     self.orders[instrument_name][order_id] = data
@@ -112,9 +180,15 @@ class DataFeed:
         
     def manage_option_oi(self, msg):
         self.oi[msg["instrument_name"]] = msg["open_interest"]
+        self.ticker_messages[msg["instrument_name"]] = self.ticker_messages.get(msg["instrument_name"], 0) + 1
+        if self.shared is not None:
+            self.shared.publish_oi(msg["instrument_name"], msg["open_interest"])
         
         
+    @timed("build_ob_from_snapshots")
     def build_ob_from_snapshots(self, snapshot):
+        if snapshot["instrument_name"] in self.grouped: # raw subscription being replaced
+            return
         bids = dict()
         for bid in snapshot["bids"]:
             bids[bid[1]] = bid[2]
@@ -122,10 +196,19 @@ class DataFeed:
         for ask in snapshot["asks"]:
             asks[ask[1]] = ask[2]
         self.ob[snapshot["instrument_name"]] = {"bids":bids, "asks":asks}
+        self.stale.discard(snapshot["instrument_name"])
+        self.book_snapshots.inc()
+        self.book_version[snapshot["instrument_name"]] = self.book_version.get(snapshot["instrument_name"], 0) + 1
+        if self.shared is not None:
+            self.shared.publish_top(snapshot["instrument_name"], self.ob[snapshot["instrument_name"]], 
+                                    self.book_version[snapshot["instrument_name"]])
         
         
+    @timed("update_ob")
     def update_ob(self, msg):
         contract = msg["instrument_name"]
+        if contract in self.grouped: # raw subscription being replaced
+            return
         for side in ["bids", "asks"]:
             if len(msg[side]) > 0:
                 for i in msg[side]:
@@ -135,6 +218,35 @@ class DataFeed:
                         self.ob[contract][side][i[1]] = i[2]
                     else:
                         pass        
+        self.book_changes.inc()
+        self.book_version[contract] = self.book_version.get(contract, 0) + 1
+        if self.shared is not None:
+            self.shared.publish_top(contract, self.ob[contract], self.book_version[contract])
+        
+    
+    @timed("update_ob_grouped")
+    def update_ob_grouped(self, msg):
+        """ book.<instrument>.none.<depth>.<interval> message, replaces the top levels """
+        
+        contract = msg["instrument_name"]
+        if contract not in self.grouped: # grouped subscription being replaced
+            return
+        self.ob[contract] = {"bids":{price:amount for price, amount in msg["bids"]}, 
+                             "asks":{price:amount for price, amount in msg["asks"]}}
+        self.stale.discard(contract)
+        self.book_grouped.inc()
+        self.book_version[contract] = self.book_version.get(contract, 0) + 1
+        if self.shared is not None:
+            self.shared.publish_top(contract, self.ob[contract], self.book_version[contract])
+            
+            
+    def message_counts(self):
+        """ Book and ticker messages per instrument so far """
+        
+        counts = dict(self.ticker_messages)
+        for instrument_name, count in list(self.book_version.items()):
+            counts[instrument_name] = counts.get(instrument_name, 0) + count
+        return counts
         
     
     def get_orders(self):
@@ -0,0 +1,358 @@
+from collections import deque
+import threading
+import time
+import numpy as np
+import logging
+
+from metrics import REGISTRY
+
+
+MATCHING_ENGINE_METHODS = ["private/buy", "private/sell", "private/edit", "private/cancel",
+                           "private/cancel_all", "private/cancel_all_by_instrument", "private/cancel_by_label",
+                           "private/close_position"]
+DONE_STATES = ["filled", "cancelled", "rejected"]
+TOO_MANY_REQUESTS = 10028
+
+
+class CreditBucket:
+
+    """ Deribit's rate limits: every request costs credits, which refill at a
+    constant rate up to a maximum (the burst) """
+
+    def __init__(self, max_credits, refill_per_second, cost):
+        self.max_credits = max_credits
+        self.refill_per_second = refill_per_second
+        self.cost = cost
+        self.credits = max_credits
+        self.updated = time.perf_counter()
+
+    def refill(self):
+        now = time.perf_counter()
+        self.credits = min(self.credits + (now - self.updated) * self.refill_per_second, self.max_credits)
+        self.updated = now
+
+    def take(self):
+        self.refill()
+        if self.credits >= self.cost:
+            self.credits -= self.cost
+            return True
+        return False
+
+    def wait_time(self):
+        """ Seconds until the next request can be sent """
+        self.refill()
+        return max(self.cost - self.credits, 0) / self.refill_per_second
+
+    def drain(self):
+        self.credits = 0
+        self.updated = time.perf_counter()
+
+
+class ExecutionManager:
+
+    """
+    Owns every outgoing order request. Requests are queued and sent as soon as
+    the credit budget allows, responses and user.orders updates are merged
+    into one order-state store indexed by order id, call id and label, and
+    order-to-ack latencies are recorded. Callers pass a callback that gets the
+    order dict on every state change, rejections included.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("deribit")
+        self.send_to_ws = None # WSClient.send_to_ws, set by Bot
+
+        # defaults of Deribit's lowest tier; matching engine requests count 1 each
+        self.matching_engine = CreditBucket(max_credits=20, refill_per_second=5, cost=1)
+        self.non_matching_engine = CreditBucket(max_credits=50000, refill_per_second=10000, cost=500)
+        self.max_queue_age = 5 # seconds, queued requests older than this are dropped as rejected
+        self.ack_timeout = 10 # seconds, sent requests without a response are resolved after this
+        self.max_history = 1000 # finished orders kept in the store
+        self.stop_execution = False
+
+        self.lock = threading.Lock()
+        self.queue = deque()
+        self.queued = threading.Event()
+        self.pending = dict() # call id -> order, sent but not acknowledged
+        self.orders = dict() # order id -> order
+        self.labels = dict() # label -> set of order ids
+        self.finished = deque()
+
+        self.sent = 0
+        self.rejected = 0
+        self.throttled = 0 # requests that had to wait for credits
+        self.ack_latencies = deque(maxlen=1000) # seconds from send to response
+        self.max_ack_latency = 0
+        
+        self.ack_latency_metric = REGISTRY.histogram("order_ack_seconds", "Time from sending an order request to its response")
+        orders = REGISTRY.counter("orders_total", "Order requests by outcome", ["outcome"])
+        self.sent_metric = orders.labels("sent")
+        self.rejected_metric = orders.labels("rejected")
+        self.throttled_metric = orders.labels("throttled")
+        REGISTRY.gauge("order_queue", "Order requests waiting for rate limit credits").set_function(lambda: len(self.queue))
+
+        self.execution_thread = threading.Thread(target=lambda: self.run())
+        self.execution_thread.start()
+
+
+    def submit(self, method, params, callback=None):
+        """ Queues a request (e.g. private/buy with the order params) and returns
+        its order dict, which is updated as responses and updates come in """
+
+        # the label of an order, not of e.g. the cancel_by_label request
+        label = params.get("label") if method in ["private/buy", "private/sell"] else None
+        order = {"method":method, "params":params, "label":label,
+                 "instrument_name":params.get("instrument_name"), "order_id":None, "order_state":"queued",
+                 "direction":method.split("/")[1] if method in ["private/buy", "private/sell"] else None,
+                 "amount":params.get("amount"), "price":params.get("price"),
+                 "queued":time.perf_counter(), "sent":None, "acknowledged":None, "error":None,
+                 "callback":callback}
+        self.queue.append(order)
+        self.queued.set()
+        return order
+
+
+    def run(self):
+        while not self.stop_execution:
+            self.expire_pending()
+            if not self.queued.wait(timeout=0.5):
+                continue
+            self.queued.clear()
+            while len(self.queue) > 0 and not self.stop_execution:
+                order = self.queue[0]
+                if time.perf_counter() - order["queued"] > self.max_queue_age:
+                    self.queue.popleft()
+                    self.reject(order, "queued for more than {}s".format(self.max_queue_age))
+                    continue
+                bucket = self.bucket(order["method"])
+                if not bucket.take():
+                    self.throttled += 1
+                    self.throttled_metric.inc()
+                    time.sleep(bucket.wait_time())
+                    continue
+                self.queue.popleft()
+                try:
+                    self.send(order)
+                except Exception as e:
+                    with self.lock:
+                        self.pending.pop(order.get("call_id"), None)
+                    self.reject(order, "not sent: {}".format(e))
+
+
+    def bucket(self, method):
+        if method in MATCHING_ENGINE_METHODS:
+            return self.matching_engine
+        return self.non_matching_engine
+
+
+    def send(self, order):
+        order["sent"] = time.perf_counter()
+        order["order_state"] = "sent"
+        # pending before the request goes out, so a fast response finds it
+        self.send_to_ws(order["params"], order["method"], register=lambda call_id: self.register(order, call_id))
+        self.sent += 1
+        self.sent_metric.inc()
+
+
+    def register(self, order, call_id):
+        with self.lock:
+            order["call_id"] = call_id
+            self.pending[call_id] = order
+
+
+    def owns(self, call_id):
+        with self.lock:
+            return call_id in self.pending
+
+
+    def expire_pending(self):
+        """ Resolves sent requests without a response after ack_timeout (e.g. lost
+        in a disconnect). A new order may still be live, so a labelled one goes
+        to the "unknown" state, which counts as open, stays pending for a late
+        response or user.orders update, and is resolved by cancelling its
+        label: once the cancel is answered, none of them can be live any more.
+        Other requests are rejected. """
+
+        now = time.perf_counter()
+        expired, labels = [], set()
+        with self.lock:
+            for call_id, order in list(self.pending.items()):
+                if now - order["sent"] <= self.ack_timeout:
+                    continue
+                if order["method"] in ["private/buy", "private/sell"] and order["label"]:
+                    if order["order_state"] != "unknown":
+                        order["order_state"] = "unknown"
+                        expired.append(order)
+                    if now - order.get("cancel_sent", 0) > self.ack_timeout:
+                        order["cancel_sent"] = now
+                        labels.add(order["label"])
+                else:
+                    expired.append(self.pending.pop(call_id))
+        for order in expired:
+            if order["order_state"] == "unknown":
+                self.logger.info("No response to order request ({} {}), state unknown.".format(order["method"],
+                                                                                               order["params"]))
+                self.notify(order)
+            else:
+                self.reject(order, "no response within {}s".format(self.ack_timeout))
+        for label in labels:
+            self.submit("private/cancel_by_label", {"label":label},
+                        callback=lambda cancel, label=label, sent=now: self.on_label_cancelled(cancel, label, sent))
+
+
+    def on_label_cancelled(self, cancel, label, sent):
+        """ Callback of the cancel_by_label request for orders in the unknown state """
+
+        if cancel["order_state"] == "rejected":
+            return # retried after the next ack_timeout
+        with self.lock:
+            resolved = [self.pending.pop(call_id) for call_id, order in list(self.pending.items())
+                        if order["order_state"] == "unknown" and order["label"] == label
+                        and order.get("cancel_sent", sent) <= sent]
+        for order in resolved:
+            order["order_state"] = "cancelled"
+            order["error"] = "no response, cancelled by label"
+            self.notify(order)
+
+
+    def match_unknown(self, data):
+        """ Pending order in the unknown state which a user.orders update of an
+        untracked order belongs to, if any; called with the lock held """
+
+        for call_id, order in self.pending.items():
+            if (order["order_state"] == "unknown" and order["label"] == data.get("label")
+                    and order["instrument_name"] == data["instrument_name"]
+                    and order["direction"] == data.get("direction")):
+                return self.pending.pop(call_id)
+        return None
+
+
+    def on_response(self, reply):
+        """ Response to a request sent by the manager, called by WSClient """
+
+        with self.lock:
+            order = self.pending.pop(reply["id"], None)
+        if order is None:
+            return
+
+        order["acknowledged"] = time.perf_counter()
+        latency = order["acknowledged"] - order["sent"]
+        self.ack_latencies.append(latency)
+        self.max_ack_latency = max(self.max_ack_latency, latency)
+        self.ack_latency_metric.observe(latency)
+
+        if "error" in reply:
+            if reply["error"].get("code") == TOO_MANY_REQUESTS:
+                self.matching_engine.drain()
+            self.reject(order, reply["error"])
+            return
+
+        result = reply.get("result")
+        if isinstance(result, dict) and "order" in result:
+            self.apply(order, result["order"])
+        else:
+            # cancels and edits without an order in the result
+            self.notify(order)
+
+
+    def on_order_update(self, data):
+        """ user.orders message, called by WSClient """
+
+        with self.lock:
+            order = self.orders.get(data["order_id"])
+            if order is None:
+                order = self.match_unknown(data)
+        if order is None:
+            # not sent through the manager (e.g. manually on the website), tracked from here on
+            order = {"method":None, "params":None, "label":data.get("label"),
+                     "instrument_name":data["instrument_name"], "order_id":None, "order_state":None,
+                     "queued":None, "sent":None, "acknowledged":None, "error":None, "callback":None}
+        self.apply(order, data)
+
+
+    def apply(self, order, data):
+        with self.lock:
+            if order["order_id"] is None:
+                order["order_id"] = data["order_id"]
+                self.orders[data["order_id"]] = order
+                if order["label"]:
+                    self.labels.setdefault(order["label"], set()).add(data["order_id"])
+            for key in ["order_state", "filled_amount", "average_price", "amount", "price", "direction"]:
+                if key in data:
+                    order[key] = data[key]
+            if order["order_state"] in DONE_STATES:
+                self.finish(order)
+        self.notify(order)
+
+
+    def reject(self, order, error):
+        self.rejected += 1
+        self.rejected_metric.inc()
+        order["order_state"] = "rejected"
+        order["error"] = error
+        self.logger.info("Order rejected ({} {}): {}".format(order["method"], order["params"], error))
+        self.notify(order)
+
+
+    def finish(self, order):
+        """ Keeps the last max_history finished orders, called with the lock held """
+
+        if order.get("finished"):
+            return
+        order["finished"] = True
+        self.finished.append(order["order_id"])
+        while len(self.finished) > self.max_history:
+            order_id = self.finished.popleft()
+            old = self.orders.pop(order_id, None)
+            if old is not None and old["label"] in self.labels:
+                self.labels[old["label"]].discard(order_id)
+
+
+    def notify(self, order):
+        if order["callback"] is not None:
+            try:
+                order["callback"](order)
+            except Exception as e:
+                self.logger.info("Error in order callback: {}".format(e))
+
+
+    def open_orders(self, label=None, instrument_name=None):
+        """ Orders not filled, cancelled or rejected yet, including those still queued or in flight """
+
+        with self.lock:
+            if label is not None:
+                orders = [self.orders[i] for i in self.labels.get(label, ()) if i in self.orders]
+            else:
+                orders = list(self.orders.values())
+            orders += [o for o in list(self.queue) + list(self.pending.values())
+                       if label is None or o["label"] == label]
+        return [o for o in orders if o["order_state"] not in DONE_STATES
+                and (instrument_name is None or o["instrument_name"] == instrument_name)]
+
+
+    def latency_stats(self):
+        latencies = np.array(self.ack_latencies) * 1000
+        if len(latencies) == 0:
+            return {"count":0}
+        return {"count":len(latencies), "mean_ms":latencies.mean(), "p50_ms":np.percentile(latencies, 50),
+                "p99_ms":np.percentile(latencies, 99), "max_ms":self.max_ack_latency * 1000}
+
+
+    def report(self):
+        """ Order and rate limit summary for the CLI """
+
+        stats = self.latency_stats()
+        lines = ["Orders sent {}, rejected {}, throttled {}, queued {}, awaiting ack {}.".format(
+                 self.sent, self.rejected, self.throttled, len(self.queue), len(self.pending))]
+        if stats["count"] > 0:
+            lines.append("Order-to-ack latency: mean {:.1f} ms, p50 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms "
+                         "({} orders).".format(stats["mean_ms"], stats["p50_ms"], stats["p99_ms"],
+                                               stats["max_ms"], stats["count"]))
+        lines.append("Matching engine credits {:.1f}/{}.".format(self.matching_engine.credits,
+                                                                self.matching_engine.max_credits))
+        for order in self.open_orders():
+            lines.append("  {} {} {} {} @ {} ({})".format(order["order_id"], order["instrument_name"],
+                                                          order.get("direction") or order["method"],
+                                                          order.get("amount"), order.get("price"),
+                                                          order["order_state"]))
+        return "\n".join(lines)
@@ -0,0 +1,227 @@
+import time
+import numpy as np
+import logging
+from scipy.optimize import linprog
+
+import iv_solver
+from black_scholes import greeks
+from instruments import is_option, parse_option
+from portfolio_greeks import PortfolioGreeks
+
+
+HEDGE_GREEKS = ["delta", "gamma", "vega", "theta", "vanna"]
+
+
+def usd_exposures(leg_greeks, spot):
+    """ Per-contract greeks as PortfolioGreeks computes them, in the units the
+    optimizer works in: delta USD, gamma USD of delta per 1% spot move, vega
+    USD per vol point, theta USD per day, vanna USD of delta per vol point """
+
+    return {"delta":leg_greeks["delta"] * spot, "gamma":leg_greeks["gamma"] * spot**2 / 100,
+            "vega":leg_greeks["vega"], "theta":leg_greeks["theta"], "vanna":leg_greeks["vanna"] * spot}
+
+
+class GreekHedgeOptimizer:
+
+    """
+    Picks the cheapest combination of liquid options and BTC-PERPETUAL that
+    brings the book's greeks to target exposures. Candidate greeks come from
+    the mid IVs of the live top-of-book; trading costs are the half spread plus
+    fees. Solved as a linear program (exposures within tolerance of their
+    targets, minimal cost) or as a bounded least-squares problem.
+    """
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.logger = logging.getLogger("deribit")
+
+        # candidate filter
+        self.max_relative_spread = 0.2 # (ask - bid) / mid
+        self.min_ttm_days = 1
+        self.max_ttm_days = 180
+        self.max_log_moneyness = 0.4 # |log(strike / spot)|
+
+        self.targets = {"delta":0, "vega":0} # used by report(), USD units as in usd_exposures
+        self.tolerances = {"delta":500, "gamma":500, "vega":50, "theta":50, "vanna":500}
+        self.option_fee = 0.0003 # BTC per contract
+        self.option_fee_cap = 0.125 # fee is at most this share of the option price
+        self.perp_fee = 0.0005 # taker
+        self.option_step = 0.1 # minimum option amount
+        self.perp_step = 10 # USD
+        self.cost_weight = 1e-6 # least squares: weight of the trading cost against the greek misses
+        self.reweighting_iterations = 10
+        self.max_solve_time = 0.1 # seconds, warn above this
+
+        self.greeks = PortfolioGreeks() # own instance for the current book
+        self.last_solve_time = 0
+
+
+    def candidates(self, spot, now=None):
+        """ Options with a two-sided book inside the filters, with their quotes
+        and per-contract greeks as arrays """
+
+        now = time.time() if now is None else now
+        ob = self.feed.ob
+        names, expiration, strike, is_call, bid, ask, bid_size, ask_size = [], [], [], [], [], [], [], []
+        for name in list(ob.keys()):
+            if not is_option(name):
+                continue
+            book = ob[name]
+            bids, asks = book["bids"], book["asks"]
+            if len(bids) == 0 or len(asks) == 0:
+                continue
+            e, k, typ = parse_option(name)
+            names.append(name)
+            expiration.append(e.timestamp())
+            strike.append(k)
+            is_call.append(typ == "C")
+            best_bid, best_ask = max(bids), min(asks)
+            bid.append(best_bid)
+            ask.append(best_ask)
+            bid_size.append(bids[best_bid])
+            ask_size.append(asks[best_ask])
+
+        c = {"names":np.array(names), "strike":np.array(strike, dtype=float), "is_call":np.array(is_call, dtype=bool),
+             "bid":np.array(bid, dtype=float), "ask":np.array(ask, dtype=float),
+             "bid_size":np.array(bid_size, dtype=float), "ask_size":np.array(ask_size, dtype=float)}
+        ttmdays = (np.array(expiration, dtype=float) - now) / (60*60*24)
+        mid = (c["bid"] + c["ask"]) / 2
+        liquid = ((ttmdays >= self.min_ttm_days) & (ttmdays <= self.max_ttm_days)
+                  & (np.abs(np.log(c["strike"] / spot)) <= self.max_log_moneyness)
+                  & ((c["ask"] - c["bid"]) / mid <= self.max_relative_spread))
+
+        c = {key:values[liquid] for key, values in c.items()}
+        c["ttm"] = ttmdays[liquid] / 365
+        c["mid"] = mid[liquid]
+        iv, status = iv_solver.implied_vol(c["mid"], spot, c["strike"], c["ttm"],
+                                           np.where(c["is_call"], "c", "p"), inverse=True)
+        solved = status == iv_solver.CONVERGED
+        c = {key:values[solved] for key, values in c.items()}
+        c["iv"] = iv[solved]
+        c["exposures"] = usd_exposures(greeks(spot, c["strike"], np.round(c["iv"], 4), c["ttm"], c["is_call"],
+                                              ["delta", "gamma", "vega", "theta", "vanna"]), spot)
+        return c
+
+
+    def book_exposures(self, spot, now=None):
+        """ Current exposures of the options and perpetual positions """
+
+        positions = self.feed.positions.copy()
+        self.greeks.sync(positions)
+        exposures = {greek:0.0 for greek in HEDGE_GREEKS}
+        if len(self.greeks.names) > 0:
+            self.greeks.compute(spot, now)
+            legs = usd_exposures(self.greeks.leg_greeks, spot)
+            exposures = {greek:float(np.nansum(legs[greek] * self.greeks.size)) for greek in HEDGE_GREEKS}
+        if "BTC-PERPETUAL" in positions:
+            perp = positions["BTC-PERPETUAL"]
+            exposures["delta"] += perp["size"] if perp["direction"] == "buy" else perp["size"] * -1
+        return exposures
+
+
+    def optimize(self, targets, tolerances=None, current=None, method="lp", now=None):
+        """
+        targets: greek -> target exposure of the whole book (USD units, see
+            usd_exposures); greeks left out are unconstrained
+        tolerances: greek -> allowed miss, defaults to self.tolerances
+        current: exposures before hedging, defaults to the live book
+        method: "lp" (cheapest trades within tolerance) or "lsq" (closest fit,
+            trading cost as penalty)
+
+        Returns a dict with the trades, their cost and the exposures before and
+        after, or None when no combination reaches the targets.
+        """
+
+        start = time.perf_counter()
+        tolerances = dict(self.tolerances, **(tolerances or {}))
+        best_bid, best_ask = self.feed.spot()
+        spot = (best_ask + best_bid) / 2
+        perp_half_spread = (best_ask - best_bid) / 2
+        current = self.book_exposures(spot, now) if current is None else current
+        c = self.candidates(spot, now)
+        hedged = [greek for greek in HEDGE_GREEKS if greek in targets]
+        n = len(c["names"])
+
+        # columns: every option, then the perpetual per USD (delta only)
+        G = np.zeros((len(hedged), n + 1))
+        for row, greek in enumerate(hedged):
+            G[row, :n] = c["exposures"][greek]
+        if "delta" in hedged:
+            G[hedged.index("delta"), n] = 1
+        needed = np.array([targets[greek] - current[greek] for greek in hedged], dtype=float)
+        tolerance = np.array([tolerances[greek] for greek in hedged], dtype=float)
+
+        fee = np.minimum(self.option_fee, self.option_fee_cap * c["mid"]) * spot
+        buy_cost = np.append((c["ask"] - c["mid"]) * spot + fee, perp_half_spread / spot + self.perp_fee)
+        sell_cost = np.append((c["mid"] - c["bid"]) * spot + fee, perp_half_spread / spot + self.perp_fee)
+        perp_limit = None if "delta" in hedged else 0
+        bounds = ([(0, size) for size in c["ask_size"]] + [(0, perp_limit)]
+                  + [(0, size) for size in c["bid_size"]] + [(0, perp_limit)])
+
+        if method == "lp":
+            # trades are buys minus sells, both non-negative
+            A = np.hstack([G, -G]) / tolerance[:, None]
+            d = needed / tolerance
+            result = linprog(np.concatenate([buy_cost, sell_cost]), A_ub=np.vstack([A, -A]),
+                             b_ub=np.concatenate([d + 1, 1 - d]), bounds=bounds, method="highs")
+            if result.status != 0:
+                self.logger.info("No hedge reaches the targets: {}".format(result.message))
+                self.last_solve_time = time.perf_counter() - start
+                return None
+            trades = result.x[:n + 1] - result.x[n + 1:]
+        else:
+            # cost-weighted ridge in closed form, only a (greeks x greeks) system is solved:
+            # min |A x - d|^2 + x' C x  =>  x = C^-1 A' (A C^-1 A' + I)^-1 d
+            # re-weighted by 1 / |x| a few times, which approximates a linear cost and
+            # concentrates the trades in few instruments
+            A = G / tolerance[:, None]
+            cost = self.cost_weight * (buy_cost + sell_cost) / 2
+            step = np.append(np.full(n, self.option_step), self.perp_step)
+            trades = np.ones(n + 1)
+            for i in range(self.reweighting_iterations):
+                inverse_cost = (np.abs(trades) + step * 1e-3) / cost
+                trades = inverse_cost * (A.T @ np.linalg.solve((A * inverse_cost) @ A.T + np.eye(len(hedged)),
+                                                                needed / tolerance))
+            trades[:n] = np.clip(trades[:n], -c["bid_size"], c["ask_size"])
+            if "delta" not in hedged:
+                trades[n] = 0
+
+        trades[:n] = np.round(trades[:n] / self.option_step) * self.option_step
+        if "delta" in hedged:
+            # the perpetual takes up the delta the rounded options leave
+            row = hedged.index("delta")
+            trades[n] = needed[row] - G[row, :n] @ trades[:n]
+        trades[n] = np.round(trades[n] / self.perp_step) * self.perp_step
+
+        after = {greek:float(current[greek] + G[row] @ trades) for row, greek in enumerate(hedged)}
+        cost = float(np.sum(np.where(trades > 0, buy_cost, sell_cost) * np.abs(trades)))
+        orders = []
+        for i in np.flatnonzero(trades):
+            if i == n:
+                orders.append({"instrument_name":"BTC-PERPETUAL", "side":"buy" if trades[i] > 0 else "sell",
+                               "amount":abs(trades[i]), "price":best_ask if trades[i] > 0 else best_bid})
+            else:
+                orders.append({"instrument_name":str(c["names"][i]), "side":"buy" if trades[i] > 0 else "sell",
+                               "amount":round(abs(trades[i]), 1), "price":c["ask"][i] if trades[i] > 0 else c["bid"][i]})
+
+        self.last_solve_time = time.perf_counter() - start
+        if self.last_solve_time > self.max_solve_time:
+            self.logger.info("Hedge optimization over {} candidates took {:.3f}s.".format(n, self.last_solve_time))
+        return {"orders":orders, "cost_usd":cost, "before":{greek:current[greek] for greek in hedged},
+                "after":after, "candidates":n, "solve_time":self.last_solve_time}
+
+
+    def report(self):
+        """ Proposed hedge for self.targets as text, for the CLI. Nothing is sent. """
+
+        plan = self.optimize(self.targets)
+        if plan is None:
+            return "No hedge reaches the targets {} within {}.".format(self.targets, self.tolerances)
+        lines = ["Hedge for {} from {} candidates, cost {:.2f} USD, solved in {:.1f} ms:".format(
+                 self.targets, plan["candidates"], plan["cost_usd"], plan["solve_time"] * 1000)]
+        for order in plan["orders"]:
+            lines.append("  {} {} {} @ {}".format(order["side"], order["amount"], order["instrument_name"],
+                                                 order["price"]))
+        lines.append("  " + ", ".join("{} {:.1f} -> {:.1f}".format(greek, plan["before"][greek], plan["after"][greek])
+                                      for greek in plan["before"]))
+        return "\n".join(lines)
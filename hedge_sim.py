@@ -0,0 +1,245 @@
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta
+import argparse
+import itertools
+import json
+import time
+import numpy as np
+import pandas as pd
+import pytz
+import psycopg2
+import logging
+
+import iv_solver
+from black_scholes import greeks
+from backfill import read_db_settings
+from hedger import DeltaHedge
+from instruments import MONTHS, parse_option
+
+
+""" Offline delta-hedging simulator. Replays recorded (derbbo snapshots) or
+synthetic perpetual prices and option quotes through DeltaHedge's decision
+logic and sweeps hedge thresholds and evaluation intervals across CPU cores.
+Run with: python3 hedge_sim.py --help """
+
+
+def synthetic_path(positions=None, hours=24, step=1, spot=30000, vol=0.6, iv=0.6, seed=0):
+    """ GBM perpetual prices every step seconds, option marks priced at a
+    constant IV. The default book is a short 30 day straddle with a long
+    7 day put. """
+
+    rng = np.random.default_rng(seed)
+    start = datetime.now(pytz.UTC).replace(microsecond=0)
+    steps = int(hours * 3600 / step)
+    dt = step / (60*60*24*365)
+    spots = spot * np.exp(np.cumsum(np.append(0, rng.normal(-vol**2 / 2 * dt, vol * np.sqrt(dt), steps - 1))))
+    times = start.timestamp() + np.arange(steps) * step
+
+    if positions is None:
+        month_names = {number:name for name, number in MONTHS.items()}
+        def name(days, strike, typ):
+            expiration = start + timedelta(days=days)
+            return "BTC-{}{}{}-{}-{}".format(expiration.day, month_names[expiration.month],
+                                             expiration.year % 100, strike, typ)
+        atm = int(round(spot, -3))
+        positions = {name(30, atm, "C"):-10, name(30, atm, "P"):-10, name(7, int(round(spot * 0.9, -3)), "P"):5}
+
+    names = list(positions)
+    legs = [parse_option(n) for n in names]
+    expiration = np.array([e.timestamp() for e, k, t in legs])
+    strike = np.array([k for e, k, t in legs], dtype=float)
+    is_call = np.array([t == "C" for e, k, t in legs])
+    ttm = np.maximum((expiration[None, :] - times[:, None]) / (60*60*24*365), 0)
+    marks = greeks(spots[:, None], strike, iv, ttm, is_call, ["price"], inverse=True)["price"]
+    return {"times":times, "spot":spots, "names":names, "size":np.array([positions[n] for n in names], dtype=float),
+            "marks":np.round(np.maximum(marks, 0.0001), 4)}
+
+
+def recorded_path(db_settings, positions, start, end, source="derbbo_dense"):
+    """ Perpetual prices and option mid prices of every stored snapshot
+    between start and end, for the instruments in positions. Spot is the
+    snapshot's own, from derbbo_snapshots: with change-only persistence, the
+    rows carried forward from earlier snapshots were written at other spots. """
+
+    conn = psycopg2.connect(**db_settings)
+    c = conn.cursor()
+    c.execute("SELECT timestamp, btcusd_price::float8 FROM obot.derbbo_snapshots "
+              "WHERE timestamp >= %s AND timestamp < %s AND btcusd_price IS NOT NULL "
+              "ORDER BY timestamp", (start, end))
+    spots = pd.DataFrame(c.fetchall(), columns=["timestamp", "btcusd_price"])
+    c.execute("SELECT timestamp, expiration, strike::float8, typ, bid::float8, ask::float8 "
+              "FROM obot.{} WHERE timestamp >= %s AND timestamp < %s ORDER BY timestamp".format(source), (start, end))
+    df = pd.DataFrame(c.fetchall(), columns=["timestamp", "expiration", "strike", "typ", "bid", "ask"])
+    conn.close()
+    if len(spots) == 0 or len(df) == 0:
+        raise ValueError("No snapshots in obot.{} between {} and {}.".format(source, start, end))
+
+    names = list(positions)
+    keys = {(pd.Timestamp(e), float(k), t):n for n, (e, k, t) in zip(names, map(parse_option, names))}
+    df["expiration"] = pd.to_datetime(df["expiration"], utc=True)
+    df["name"] = [keys.get(key) for key in zip(df["expiration"], df["strike"], df["typ"])]
+    df["mid"] = (df["bid"] + df["ask"]) / 2
+
+    spots["timestamp"] = pd.to_datetime(spots["timestamp"], utc=True)
+    spots = spots.set_index("timestamp")["btcusd_price"]
+    df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True)
+    marks = (df.dropna(subset=["name"]).pivot_table(index="timestamp", columns="name", values="mid")
+             .reindex(index=spots.index, columns=names).ffill().bfill())
+    times = np.array([ts.timestamp() for ts in spots.index])
+    return {"times":times, "spot":spots.to_numpy(), "names":names,
+            "size":np.array([positions[n] for n in names], dtype=float), "marks":marks.to_numpy()}
+
+
+def prepare_path(path):
+    """ Options delta (USD, as DeltaHedge computes it) and value (USD) of the
+    fixed options book at every step, in one vectorized pass """
+
+    legs = [parse_option(n) for n in path["names"]]
+    expiration = np.array([e.timestamp() for e, k, t in legs])
+    strike = np.array([k for e, k, t in legs], dtype=float)
+    is_call = np.array([t == "C" for e, k, t in legs])
+    spot = path["spot"]
+    ttm = (expiration[None, :] - path["times"][:, None]) / (60*60*24*365)
+    live = ttm > 0
+
+    shape = path["marks"].shape
+    S = np.broadcast_to(spot[:, None], shape)
+    ivs, status = iv_solver.implied_vol(path["marks"][live], S[live], np.broadcast_to(strike, shape)[live],
+                                        ttm[live], np.where(np.broadcast_to(is_call, shape)[live], "c", "p"),
+                                        inverse=True)
+    ivs[status == iv_solver.BELOW_INTRINSIC] = iv_solver.MIN_VOL
+    ivs[(status != iv_solver.CONVERGED) & (status != iv_solver.BELOW_INTRINSIC)] = np.nan
+    iv = np.full(shape, np.nan)
+    iv[live] = ivs
+    # like PortfolioGreeks, legs which cannot be solved keep their last IV
+    iv = pd.DataFrame(iv).ffill().to_numpy()
+
+    delta = greeks(S, strike, np.round(iv, 4), np.maximum(ttm, 1e-8), is_call, ["delta"], inverse=True)["delta"]
+    delta = np.where(live & np.isfinite(delta), delta, 0)
+    path["option_delta"] = np.sum(delta * path["size"], axis=1) * spot
+    path["option_value"] = np.sum(np.nan_to_num(path["marks"]) * path["size"], axis=1) * spot
+    return path
+
+
+def simulate(path, max_delta_mismatch, evaluation_interval, half_spread=0.25, taker_fee=0.0005):
+    """ Runs DeltaHedge's trigger and sizing over the path. Hedges are filled
+    immediately, crossing the half spread, and pay the taker fee. """
+
+    hedger = DeltaHedge(None, run_threads=False)
+    hedger.max_delta_mismatch = max_delta_mismatch
+    times, spot, option_delta = path["times"], path["spot"], path["option_delta"]
+
+    trades = np.zeros(len(times))
+    # starts fully hedged, so only the rebalancing is measured
+    initial = round(option_delta[0] * -1 / hedger.contract_size) * hedger.contract_size
+    perp = initial
+    last_evaluation = -np.inf
+    for i in range(1, len(times)):
+        if times[i] - last_evaluation < evaluation_interval:
+            continue
+        last_evaluation = times[i]
+        if hedger.hedge_needed(option_delta[i], perp):
+            side, amount = hedger.hedge_order(option_delta[i], perp)
+            signed = amount if side == "buy" else amount * -1
+            trades[i] = signed
+            perp += signed
+
+    perp_path = initial + np.cumsum(trades)
+    residual = option_delta + perp_path
+    traded = np.abs(trades)
+    costs = traded * (half_spread / spot + taker_fee)
+
+    # step PnL in USD: options revaluation plus the inverse perpetual held over the step
+    pnl = np.diff(path["option_value"]) + perp_path[:-1] * (spot[1:] / spot[:-1] - 1) - costs[1:]
+    return {"max_delta_mismatch":max_delta_mismatch, "evaluation_interval":evaluation_interval,
+            "hedges":int(np.count_nonzero(trades)), "traded_usd":float(traded.sum()),
+            "cost_usd":float(costs.sum()), "residual_mean_abs":float(np.mean(np.abs(residual))),
+            "residual_rms":float(np.sqrt(np.mean(residual**2))), "residual_max_abs":float(np.max(np.abs(residual))),
+            "pnl_usd":float(pnl.sum()), "pnl_std":float(pnl.std())}
+
+
+worker_path = None
+
+
+def set_worker_path(path):
+    global worker_path
+    worker_path = path
+
+
+def simulate_config(config):
+    """ Runs in the worker processes, which receive the path once """
+    return simulate(worker_path, *config)
+
+
+class HedgeSweep:
+
+    def __init__(self, path, workers=None):
+        self.logger = logging.getLogger("deribit")
+        self.path = prepare_path(path)
+        self.workers = workers
+        self.half_spread = 0.25 # USD, half the BTC-PERPETUAL tick
+        self.taker_fee = 0.0005
+
+
+    def run(self, thresholds, intervals):
+        configs = [(threshold, interval, self.half_spread, self.taker_fee)
+                   for threshold, interval in itertools.product(thresholds, intervals)]
+        self.logger.info("Simulating {} configurations over {} steps.".format(len(configs), len(self.path["times"])))
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=set_worker_path,
+                                 initargs=(self.path,)) as pool:
+            results = list(pool.map(simulate_config, configs, chunksize=max(len(configs) // 64, 1)))
+        self.logger.info("Sweep finished in {:.1f}s.".format(time.perf_counter() - started))
+        return pd.DataFrame(results).sort_values(["cost_usd", "residual_rms"]).reset_index(drop=True)
+
+
+def parse_list(value):
+    return [float(x) for x in value.split(",")]
+
+
+def parse_time(value):
+    return pytz.UTC.localize(datetime.fromisoformat(value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate delta hedging over recorded or synthetic data.")
+    parser.add_argument("--source", choices=["synthetic", "recorded"], default="synthetic")
+    parser.add_argument("--positions", help="JSON file with instrument_name: size (BTC, signed), "
+                                            "required for recorded data")
+    parser.add_argument("--start", type=parse_time, help="recorded data from (UTC, ISO format)")
+    parser.add_argument("--end", type=parse_time, help="recorded data until (UTC, exclusive)")
+    parser.add_argument("--hours", type=float, default=24, help="length of the synthetic path")
+    parser.add_argument("--step", type=float, default=1, help="seconds between synthetic prices")
+    parser.add_argument("--vol", type=float, default=0.6, help="realized vol of the synthetic path")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--thresholds", type=parse_list, default="0.005,0.01,0.025,0.05,0.1,0.2",
+                        help="max_delta_mismatch values, comma separated")
+    parser.add_argument("--intervals", type=parse_list, default="0.5,5,30,60,300,900",
+                        help="evaluation intervals in seconds, comma separated")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default: CPU count")
+    parser.add_argument("--output", help="write the results to this CSV file")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("deribit")
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(fmt='%(asctime)s - %(levelname)s - %(module)s - %(message)s'))
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+    positions = json.load(open(args.positions)) if args.positions else None
+    if args.source == "recorded":
+        if positions is None or args.start is None or args.end is None:
+            parser.error("recorded data needs --positions, --start and --end")
+        path = recorded_path(read_db_settings(), positions, args.start, args.end)
+    else:
+        path = synthetic_path(positions, args.hours, args.step, vol=args.vol, seed=args.seed)
+
+    results = HedgeSweep(path, args.workers).run(args.thresholds, args.intervals)
+    with pd.option_context("display.max_rows", None, "display.max_columns", None, "display.width", 250):
+        print(results.round(3))
+    if args.output:
+        results.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,107 @@
 import threading
-from py_vollib_vectorized import vectorized_implied_volatility as viv
-from datetime import datetime
-import pytz
-from scipy.stats import norm
-import numpy as np
 import logging
 import time
 
+from portfolio_greeks import PortfolioGreeks
+from metrics import REGISTRY
+from profiler import timed
+
 class DeltaHedge:
     
-    def __init__(self, feed):
+    evaluates = True # False for a stand-in that forwards evaluations to another process
+    
+    def __init__(self, feed, run_threads=True):
         
         self.feed = feed
         self.logger = logging.getLogger("deribit")
         self.delta_hedging_activated = False
         self.stop_hedger = False
-        self.hedging_thread = threading.Thread(target=lambda: self.wait_for_input())
-        self.hedging_thread.start()
-        self.months = {"JAN":1, "FEB":2, "MAR":3, "APR":4, "MAY":5, "JUN":6, 
-                       "JUL":7, "AUG":8, "SEP":9, "OCT":10, "NOV":11, "DEC":12}
         
         self.max_delta_mismatch = 0.025
+        self.contract_size = 10 # BTC-PERPETUAL amounts are multiples of 10 USD
         
         self.op_delta = 0
         self.btcperp_delta = 0
         self.send_to_ws = None
+        self.greeks = PortfolioGreeks() # IVs and greeks of the whole options book
+        self.surface = None # LiveVolSurface, set by Bot
+        self.execution = None # ExecutionManager, set by Bot, sends the hedge orders
+        self.trade_bars = None # TradeBars, set by Bot: VWAP, OHLCV and realized vol of the perpetual's trades
+        self.option_flow = None # OptionFlow, set by Bot when enabled: option trade flow per surface bucket
+        self.timeseries = None # TimeSeriesStore, set by Bot: history of the live surface, mid IVs and greeks
+        self.commands = dict() # further CLI commands, name -> function returning the text to print
+        
+        # hedge evaluations run on their own thread and always act on the latest state; 
+        # bursts of portfolio / trade messages are coalesced into one evaluation
+        self.min_evaluation_interval = 0.5 # seconds
+        self.in_flight_timeout = 10 # seconds before an unfilled hedge is cancelled (or, if none is open, released)
+        self.evaluation_requested = threading.Event()
+        self.requested_at = None
+        self.last_evaluation = 0
+        self.in_flight = None # hedge order sent but not yet filled / cancelled
+        
+        self.evaluation_requests = 0
+        self.evaluations = 0
+        self.decision_latency = 0 # seconds from the first coalesced request to the decision
+        self.max_decision_latency = 0
+        
+        self.decision_latency_metric = REGISTRY.histogram("hedge_decision_seconds", 
+                                                          "Time from the first coalesced request to the hedge decision")
+        self.evaluation_duration = REGISTRY.histogram("hedge_evaluation_seconds", "Duration of one hedge evaluation")
+        self.evaluation_requests_metric = REGISTRY.counter("hedge_evaluation_requests_total", "Hedge evaluation requests")
+        self.hedges_sent = REGISTRY.counter("hedges_sent_total", "Hedge orders sent", ["side"])
+        if self.evaluates:
+            REGISTRY.gauge("hedge_option_delta_usd", "Options delta").set_function(lambda: self.op_delta)
+            REGISTRY.gauge("hedge_perp_delta_usd", "BTC-PERPETUAL delta").set_function(lambda: self.btcperp_delta)
+        REGISTRY.gauge("hedging_active", "Dynamic delta-hedging activated").set_function(
+            lambda: int(self.delta_hedging_activated))
+        
+        # the hedge simulator only uses the decision logic, without CLI and evaluation threads
+        if run_threads:
+            self.hedging_thread = threading.Thread(target=lambda: self.wait_for_input())
+            self.hedging_thread.start()
+            self.evaluation_thread = threading.Thread(target=lambda: self.evaluation_loop())
+            self.evaluation_thread.start()
+        
+        
+    def request_evaluation(self, send_method):
+        """ Called from the websocket thread, returns immediately """
+        
+        self.send_to_ws = send_method
+        self.evaluation_requests += 1
+        self.evaluation_requests_metric.inc()
+        if self.requested_at is None:
+            self.requested_at = time.perf_counter()
+        self.evaluation_requested.set()
+        
+        
+    def evaluation_loop(self):
+        while not self.stop_hedger:
+            if not self.evaluation_requested.wait(timeout=0.5) and not self.hedge_timed_out():
+                continue
+            
+            wait = self.last_evaluation + self.min_evaluation_interval - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+            
+            self.evaluation_requested.clear()
+            requested_at, self.requested_at = self.requested_at, None
+            start = time.perf_counter()
+            try:
+                self.check_deltas(self.send_to_ws)
+            except Exception as e:
+                self.logger.info("Error evaluating hedge: {}".format(e))
+            
+            self.last_evaluation = time.perf_counter()
+            self.evaluation_duration.observe(self.last_evaluation - start)
+            self.evaluations += 1
+            if requested_at is not None:
+                self.decision_latency = self.last_evaluation - requested_at
+                self.max_decision_latency = max(self.max_decision_latency, self.decision_latency)
+                self.decision_latency_metric.observe(self.decision_latency)
+    
     
+    @timed("check_deltas")
     def check_deltas(self, send_method):
         
         self.send_to_ws = send_method
@@ -34,12 +110,63 @@ class DeltaHedge:
         if not self.delta_hedging_activated:
             pass
         
+        elif self.hedge_in_flight():
+            pass
+        
         else:
-            if abs(current_options_delta) > 0:
-                if (1 - self.max_delta_mismatch < ((current_perp_delta * -1) / current_options_delta) < 1 + self.max_delta_mismatch):
-                    self.rehedge(current_options_delta, current_perp_delta)
+            if self.hedge_needed(current_options_delta, current_perp_delta):
+                self.rehedge(current_options_delta, current_perp_delta)
+                
+                
+    def hedge_needed(self, option_delta, perp_delta):
+        """ True when the perpetual position deviates from offsetting the 
+        options delta by more than max_delta_mismatch """
+        
+        if abs(option_delta) > 0:
+            hedge_ratio = (perp_delta * -1) / option_delta
+            return not (1 - self.max_delta_mismatch < hedge_ratio < 1 + self.max_delta_mismatch)
+        return False
+    
+    
+    def hedge_timed_out(self):
+        in_flight = self.in_flight
+        return in_flight is not None and time.perf_counter() - in_flight["sent"] > self.in_flight_timeout
+    
+    
+    def hedge_in_flight(self):
+        if self.in_flight is None:
+            return False
+        
+        if self.hedge_timed_out():
+            open_hedges = self.execution.open_orders(label="delta_hedge")
+            if len(open_hedges) == 0:
+                self.logger.info("No update received for hedge order, none open. Resuming hedging.")
+                self.in_flight = None
+                return False
+            # resting at a touch the market moved away from: cancelled, and once the 
+            # cancel is confirmed on_order_update releases it and a new hedge is evaluated
+            now = time.perf_counter()
+            if now - self.in_flight.get("cancel_sent", 0) > self.in_flight_timeout:
+                resting = [order for order in open_hedges if order["order_id"] is not None]
+                self.logger.info("Hedge order not filled after {}s, cancelling {} order(s).".format(
+                    self.in_flight_timeout, len(resting)))
+                for order in resting:
+                    self.execution.submit("private/cancel", {"order_id":order["order_id"]})
+                self.in_flight["cancel_sent"] = now
+        return True
+    
+    
+    def on_order_update(self, order):
+        """ Called by the execution manager on every state change of a hedge 
+        order, releases the in-flight hedge once its order is done """
+        
+        if order.get("label") == "delta_hedge" and order["order_state"] in ["filled", "cancelled", "rejected"]:
+            if self.in_flight is not None:
+                self.in_flight = None
+                self.request_evaluation(self.send_to_ws)
 
     
+    @timed("determine_option_delta")
     def determine_option_delta(self):
         
         positions = self.feed.positions.copy()
@@ -55,47 +182,14 @@ class DeltaHedge:
             pass
         
         
-        keys_to_delete = []
-        
-        for key in positions.keys():
-            if (str(key)[-1] != "P" and str(key)[-1] != "C"):
-                keys_to_delete.append(key)
-            elif positions[key]["size"] == 0:
-                keys_to_delete.append(key)
-                
-        for key in keys_to_delete:
-            del positions[key]
-        
-        
         option_delta = 0
         
-        if len(positions) > 0:
-        
-            for key in positions.keys():
-                name = str(positions[key]["instrument_name"])
-                size = positions[key]["size"]
-                btcusd_price = (self.feed.btcusd_best_ask + self.feed.btcusd_best_bid) / 2
-                price = positions[key]["mark_price"] * btcusd_price
-                
-                first = name.find("-")
-                second = name.find("-", first+1)
-                third = name.find("-", second+1)
-                
-                typ = name[-1]
-                exp = name[first+1:second]
-                strike = int(name[second+1:third])
-                
-                year = int(exp[-2]) + 2000
-                month = self.months[exp[-5:-2]]
-                day = int(exp[:-5])
-                
-                expiration = datetime(year, month, day, 8, 0, 0, 0, pytz.UTC)
-                ttmyears = ((expiration - datetime.now(pytz.UTC)).total_seconds()) / (60*60*24*365)
-                
-                iv = viv(price, self.feed.btcusd_best_bid, strike, ttmyears, 0, typ.lower(), 0, on_error="ignore", model='black_scholes_merton', return_as = 'numpy').round(4)
-                delta = self.bsm(btcusd_price, strike, iv, 0, 0, ttmyears, typ.lower(), "delta")
-                delta = delta * size * btcusd_price
-                option_delta += delta
+        self.greeks.sync(positions)
+        if len(self.greeks.names) > 0:
+            best_bid, best_ask = self.feed.spot()
+            btcusd_price = (best_ask + best_bid) / 2
+            totals = self.greeks.compute(btcusd_price)
+            option_delta = totals["delta"] * btcusd_price
         
         self.op_delta = option_delta
         self.btcperp_delta = perp_delta
@@ -104,25 +198,42 @@ class DeltaHedge:
     
     
     
-    def rehedge(self, option_delta, perp_delta):
-        side = ""
+    def hedge_order(self, option_delta, perp_delta):
+        """ Side and amount (USD, in whole contracts) of the perpetual order 
+        that offsets the options delta """
+        
         target = option_delta * -1
         diff = perp_delta - target
+        side = "sell" if diff > 0 else "buy"
+        amount = round(abs(diff) / self.contract_size) * self.contract_size
+        return side, amount
+    
+    
+    def rehedge(self, option_delta, perp_delta):
+        side, amount = self.hedge_order(option_delta, perp_delta)
+        if amount == 0:
+            return
         
-        if diff > 0:
-            side = "sell"
-            price = self.feed.btcusd_best_bid
-        else:
-            side = "buy"
-            price = self.feed.btcusd_best_ask
+        best_bid, best_ask = self.feed.spot()
+        price = best_bid if side == "sell" else best_ask
             
         call_type = "private/{}".format(side)
         
-        self.logger.info("Rehedging. {} {} at market.".format(side, abs(diff)))
+        self.logger.info("Rehedging. {} {} at {} (limit at the touch).".format(side, amount, price))
         
-        message = {"instrument_name":"BTC-PERPETUAL", "amount":abs(diff), 
+        message = {"instrument_name":"BTC-PERPETUAL", "amount":amount, 
                    "type":"limit", "label":"delta_hedge", "price":price}
-        self.send_to_ws(message, call_type)
+        self.in_flight = {"side":side, "amount":amount, "sent":time.perf_counter()}
+        self.execution.submit(call_type, message, callback=self.on_order_update)
+        self.hedges_sent.labels(side).inc()
+        
+        
+    def run_command(self, x):
+        if x in self.commands:
+            try:
+                print(self.commands[x]())
+            except Exception as e:
+                self.logger.info("Error running command {}: {}".format(x, e))
         
         
     def wait_for_input(self):
@@ -131,76 +242,24 @@ class DeltaHedge:
             
             if not self.stop_hedger:
                 time.sleep(0.5)
+                others = "".join(", {}".format(c) for c in self.commands)
                 if not self.delta_hedging_activated:
-                    x = input("Activate dynamic Delta-Hedging? (y/n)\n")
+                    x = input("Activate dynamic Delta-Hedging? (y/n{})\n".format(others))
                     if x == "y":
                         self.delta_hedging_activated = True
                         self.logger.info("Dynamic delta-hedging activated: "
                                          "{}".format(self.delta_hedging_activated))
-                        self.check_deltas(self.send_to_ws)            
+                        self.request_evaluation(self.send_to_ws)
+                    else:
+                        self.run_command(x)
                 else:
-                    x = input("Deactivate dynamic Delta-Hedging? (y/n)\n")
+                    x = input("Deactivate dynamic Delta-Hedging? (y/n{})\n".format(others))
                     if x == "y":
                         self.delta_hedging_activated = False
                         self.logger.info("Dynamic delta-hedging activated: "
                                          "{}".format(self.delta_hedging_activated))
+                    else:
+                        self.run_command(x)
                         
             else:
                 break
-            
-            
-            
-    def bsm(self, S,X,sigma, r, q, ttm, otype, greek):
-        t = float(ttm)
-        X = float(X)
-        r = float(r)
-        b = float(r - q)
-        
-        d1 = (np.log(S/X) + (b + (sigma**2)/2)*t) / (sigma * np.sqrt(t))
-        d2 = d1 - sigma * np.sqrt(t)
-    
-        if greek == "vanna":
-            vanna = ((-np.exp((b-r)*t)*d2)/sigma)*norm.pdf(d1)
-            return vanna / 100
-        elif greek == "charm":
-            if(otype == "c"):
-                charm = -np.exp((b-r)*t)*((norm.pdf(d1)*(b/(sigma*np.sqrt(t))-(d2/(2*t)))) + (b-r)*norm.cdf(d1))
-            elif(otype == "p"):
-                charm = -np.exp((b-r)*t)*((norm.pdf(d1)*(b/(sigma*np.sqrt(t))-(d2/(2*t))) - (b-r)*norm.cdf(-d1)))
-            return charm 
-        elif greek == "price":
-            if(otype == "c"):
-                price = S * np.exp((b-r)*t) * norm.cdf(d1) - X * np.exp(-r *t)  * norm.cdf(d2)
-            elif (otype == "p"):
-                price = (X * np.exp(-r *t)  * norm.cdf(-d2) - S * np.exp((b-r)*t) * norm.cdf(-d1))
-            return price
-        elif greek == "delta":
-            if(otype == "c"):
-                delta = np.exp((b-r)*t)*norm.cdf(d1)
-            elif(otype == "p"):
-                delta = -np.exp((b-r)*t)*norm.cdf(-d1)
-            return delta 
-        elif greek == "gamma":
-            gamma = (np.exp((b-r)*t)*norm.pdf(d1)) / (S*sigma*np.sqrt(t))
-            return gamma
-        elif greek == "vega":
-            vega = 0.01*S*np.exp((b-r)*t)*((1/(2*np.pi))*((-d1**2)/2))
-            return vega
-            
-        elif greek == "rho":
-            if otype == "c":
-                rho = 0.01*X*t*np.exp((b-r)*t)*norm.cdf(d2)
-                return rho
-            if otype == "p":
-                rho = -0.01*X*t*np.exp((b-r)*t)*norm.cdf(-d2)    
-                return rho
-        elif greek == "d1":
-            return d1
-        elif greek == "d2":
-            return d2
-        
-        elif greek == "lm":
-            return (np.log(S/X) + (b + (sigma**2)/2)*t) / (sigma * np.sqrt(t))
-        
-        else:
-            print("No greek provided.")    
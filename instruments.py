@@ -0,0 +1,24 @@
+from datetime import datetime
+import pytz
+
+
+""" Helpers to read Deribit instrument names, e.g. BTC-25JUN21-30000-C """
+
+
+MONTHS = {"JAN":1, "FEB":2, "MAR":3, "APR":4, "MAY":5, "JUN":6, 
+          "JUL":7, "AUG":8, "SEP":9, "OCT":10, "NOV":11, "DEC":12}
+
+
+def is_option(instrument_name):
+    return instrument_name[-2:] in ("-C", "-P")
+
+
+def parse_option(instrument_name):
+    """ Returns expiration (08:00 UTC), strike and type ("C" or "P") of an option """
+    
+    underlying, expiry, strike, typ = instrument_name.split("-")
+    day = int(expiry[:-5])
+    month = MONTHS[expiry[-5:-2]]
+    year = int(expiry[-2:]) + 2000
+    expiration = datetime(year, month, day, 8, 0, 0, 0, pytz.UTC)
+    return expiration, int(strike), typ
@@ -0,0 +1,130 @@
+from collections import OrderedDict
+import time
+import numpy as np
+import logging
+
+import iv_solver
+from metrics import REGISTRY
+
+
+class IVCache:
+
+    """
+    Remembers solved implied volatilities per instrument and quote side, keyed
+    on (price, spot, strike, ttm bucket). Only quotes whose key changed since
+    the last snapshot are handed to the solver, warm-started from the previous
+    IV of the same instrument and side. The cache is bounded and evicts the
+    least recently used entries.
+    """
+
+    def __init__(self, max_size=20000, ttm_bucket_seconds=3600, spot_tick=1):
+        self.logger = logging.getLogger("deribit")
+        self.max_size = max_size
+        self.ttm_bucket = ttm_bucket_seconds / (60*60*24*365) # in years
+        self.spot_tick = spot_tick
+        self.cache = OrderedDict()
+        self.previous_iv = dict() # (contract, side) -> last solved IV, used as warm start
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.solve_time = 0 # seconds spent in the IV solver
+        self.last_solve_time = 0
+        self.not_converged = 0
+
+        lookups = REGISTRY.counter("iv_cache_lookups_total", "IV cache lookups by result", ["result"])
+        self.hits_metric = lookups.labels("hit")
+        self.misses_metric = lookups.labels("miss")
+        self.evictions_metric = REGISTRY.counter("iv_cache_evictions_total", "IV cache entries evicted").labels()
+        self.not_converged_metric = REGISTRY.counter("iv_not_converged_total",
+                                                     "IVs the solver did not converge on").labels()
+        self.solve_duration = REGISTRY.histogram("iv_solve_seconds",
+                                                 "Duration of solving one batch of IV cache misses").labels()
+
+
+    def implied_vols(self, contracts, side, prices, spot, strikes, ttmyears, types):
+        """ Returns the implied volatilities of one quote side (e.g. "bid") for
+        all contracts as a numpy array, solving only cache misses """
+
+        prices = np.asarray(prices, dtype=float)
+        strikes = np.asarray(strikes, dtype=float)
+        ttmyears = np.asarray(ttmyears, dtype=float)
+        types = np.asarray(types)
+        spot_key = round(spot / self.spot_tick)
+        ttm_keys = np.floor(ttmyears / self.ttm_bucket).astype(int)
+
+        ivs = np.full(len(prices), np.nan)
+        keys = []
+        missing = []
+        hits = 0
+
+        for i in range(len(prices)):
+            if np.isnan(prices[i]):
+                keys.append(None)
+                continue
+            key = (contracts[i], side, prices[i], spot_key, strikes[i], ttm_keys[i])
+            keys.append(key)
+            iv = self.cache.get(key)
+            if iv is None:
+                missing.append(i)
+            else:
+                self.cache.move_to_end(key)
+                ivs[i] = iv
+                hits += 1
+
+        self.hits += hits
+        self.misses += len(missing)
+        self.hits_metric.inc(hits)
+        self.misses_metric.inc(len(missing))
+
+        if len(missing) > 0:
+            start = time.perf_counter()
+            warm_start = [self.previous_iv.get((contracts[i], side), np.nan) for i in missing]
+            solved, status = iv_solver.implied_vol(prices[missing], spot, strikes[missing],
+                                                   ttmyears[missing], types[missing],
+                                                   initial_vol=warm_start)
+            self.last_solve_time = time.perf_counter() - start
+            self.solve_time += self.last_solve_time
+            self.solve_duration.observe(self.last_solve_time)
+            not_converged = int((status == iv_solver.NOT_CONVERGED).sum())
+            self.not_converged += not_converged
+            self.not_converged_metric.inc(not_converged)
+
+            # quotes without a valid IV are stored as 0, as downstream filters expect
+            solved[(status != iv_solver.CONVERGED) & (status != iv_solver.NOT_CONVERGED)] = 0
+
+            for i, iv in zip(missing, solved):
+                ivs[i] = iv
+                self.cache[keys[i]] = iv
+                if iv > 0:
+                    self.previous_iv[(contracts[i], side)] = iv
+        else:
+            self.last_solve_time = 0
+
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+            self.evictions_metric.inc()
+
+        if len(self.previous_iv) > self.max_size: # drop warm starts of expired contracts
+            self.previous_iv.clear()
+
+        return ivs
+
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0
+        return self.hits / lookups
+
+
+    def stats(self):
+        return {"size":len(self.cache), "hits":self.hits, "misses":self.misses,
+                "hit_rate":self.hit_rate(), "evictions":self.evictions,
+                "not_converged":self.not_converged, "solve_time":self.solve_time}
+
+
+    def clear(self):
+        self.cache.clear()
+        self.previous_iv.clear()
@@ -0,0 +1,121 @@
+import numpy as np
+from scipy.special import ndtr
+
+
+""" Vectorized Black-Scholes implied volatility solver (r = q = 0, as used
+throughout the project). Starts from the previous IV of an instrument when
+one is given, otherwise from the Corrado-Miller rational approximation, and
+refines with safeguarded Halley steps. """
+
+
+MIN_VOL = 1e-4
+MAX_VOL = 10.0
+
+# solver status codes, one per option
+CONVERGED = 0
+BELOW_INTRINSIC = 1 # price at or below intrinsic value, no IV exists
+ABOVE_MAXIMUM = 2 # call price at or above spot, no IV exists
+NOT_CONVERGED = 3 # iteration limit reached
+INVALID_INPUT = 4 # NaN / non-positive inputs
+
+
+def implied_vol(price, spot, strike, ttm, typ, initial_vol=None, inverse=False,
+                tol=1e-10, max_iter=20):
+    """
+    Solves implied volatilities for arrays of options in one pass.
+
+    price: option prices, in USD or in BTC if inverse is True (Deribit quotes)
+    spot: underlying price(s) in USD
+    strike, ttm: strikes in USD and times to maturity in years
+    typ: "c"/"C" or "p"/"P" per option
+    initial_vol: optional previous IVs to warm-start from, NaN where unknown
+
+    Returns the IVs (NaN where no IV was found) and a status array with one
+    of the status codes defined in this module for every option.
+    """
+
+    price = np.atleast_1d(np.asarray(price, dtype=float))
+    n = len(price)
+    spot = np.broadcast_to(np.asarray(spot, dtype=float), (n,))
+    strike = np.broadcast_to(np.asarray(strike, dtype=float), (n,))
+    ttm = np.broadcast_to(np.asarray(ttm, dtype=float), (n,))
+    is_call = np.char.lower(np.broadcast_to(np.asarray(typ), (n,)).astype(str)) == "c"
+
+    if inverse:
+        price = price * spot
+
+    # value everything as calls via put-call parity
+    call_price = np.where(is_call, price, price + spot - strike)
+    intrinsic = np.maximum(spot - strike, 0)
+
+    status = np.full(n, CONVERGED)
+    with np.errstate(invalid="ignore"):
+        invalid = ~((price > 0) & (spot > 0) & (strike > 0) & (ttm > 0))
+        status[call_price <= intrinsic] = BELOW_INTRINSIC
+        status[call_price >= spot] = ABOVE_MAXIMUM
+    status[invalid] = INVALID_INPUT
+    solvable = status == CONVERGED
+
+    sigma = initial_guess(call_price, spot, strike, ttm)
+    if initial_vol is not None:
+        warm = np.broadcast_to(np.asarray(initial_vol, dtype=float), (n,))
+        use_warm = np.isfinite(warm) & (warm > MIN_VOL) & (warm < MAX_VOL)
+        sigma = np.where(use_warm, warm, sigma)
+
+    ivs = np.full(n, np.nan)
+    idx = np.flatnonzero(solvable)
+    if len(idx) == 0:
+        return ivs, status
+
+    C, S, K = call_price[idx], spot[idx], strike[idx]
+    sig = sigma[idx]
+    lo = np.full(len(idx), MIN_VOL)
+    hi = np.full(len(idx), MAX_VOL)
+    sqrt_t = np.sqrt(ttm[idx])
+    log_sk = np.log(S / K)
+    active = np.arange(len(idx)) # options still iterating
+
+    for i in range(max_iter):
+        vol_sqrt_t = sig * sqrt_t
+        d1 = log_sk / vol_sqrt_t + vol_sqrt_t / 2
+        d2 = d1 - vol_sqrt_t
+        diff = S * ndtr(d1) - K * ndtr(d2) - C
+        vega = S * np.exp(-d1**2 / 2) / np.sqrt(2 * np.pi) * sqrt_t
+        volga = vega * d1 * d2 / sig
+
+        # keep a bracket around the root, price is increasing in volatility
+        hi = np.where(diff > 0, np.minimum(hi, sig), hi)
+        lo = np.where(diff < 0, np.maximum(lo, sig), lo)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            newton = diff / vega
+            step = newton / (1 - np.clip(newton * volga / (2 * vega), -0.5, 0.5))
+            new_sig = sig - step
+
+        outside = ~np.isfinite(new_sig) | (new_sig <= lo) | (new_sig >= hi)
+        new_sig = np.where(outside, (lo + hi) / 2, new_sig)
+
+        done = (np.abs(diff) <= tol * S) | (np.abs(new_sig - sig) <= tol)
+        ivs[idx[active[done]]] = np.where(np.abs(diff[done]) <= tol * S[done], sig[done], new_sig[done])
+
+        keep = ~done
+        active = active[keep]
+        if len(active) == 0:
+            break
+        C, S, K, sqrt_t, log_sk = C[keep], S[keep], K[keep], sqrt_t[keep], log_sk[keep]
+        sig, lo, hi = new_sig[keep], lo[keep], hi[keep]
+
+    status[idx[active]] = NOT_CONVERGED
+    return ivs, status
+
+
+def initial_guess(call_price, spot, strike, ttm):
+    """ Corrado-Miller approximation, falls back to 50% where it breaks down """
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        half_gap = (spot - strike) / 2
+        inner = (call_price - half_gap)**2 - (spot - strike)**2 / np.pi
+        guess = (np.sqrt(2 * np.pi / ttm) / (spot + strike) *
+                 (call_price - half_gap + np.sqrt(np.maximum(inner, 0))))
+
+    return np.where(np.isfinite(guess) & (guess > MIN_VOL) & (guess < MAX_VOL), guess, 0.5)
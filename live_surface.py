@@ -0,0 +1,196 @@
+import threading
+import time
+import numpy as np
+import logging
+
+import iv_solver
+from instruments import is_option, parse_option
+from volatility_index import interpolate_rows
+from metrics import REGISTRY
+from profiler import timed
+
+
+class LiveVolSurface:
+
+    """
+    Keeps an in-memory mid IV surface on the BVIX grid up to date while the
+    bot runs. Only options whose books changed since the last update get their
+    IVs re-solved (all of them when spot moved or periodically, as time to
+    maturity decays). The surface is replaced as a whole on every update, so
+    any thread can read it without locking.
+    """
+
+    def __init__(self, feed, bvix):
+        self.feed = feed
+        self.bvix = bvix
+        self.logger = logging.getLogger("deribit")
+
+        self.update_interval = 0.25 # seconds between updates, bounds the update latency
+        self.full_refresh_interval = 60 # re-solve every IV at least this often (seconds)
+        self.spot_tolerance = 0.0005 # re-solve every IV when spot moved by more than this
+        self.stop_surface = False
+
+        self.log_moneyness = np.asarray(bvix.log_moneyness_intervals, dtype=float)
+        self.days = np.asarray(bvix.days_til_maturity, dtype=float)
+        shape = (len(self.log_moneyness), len(self.days))
+
+        # (surface, time each node was last refreshed, time of last update), swapped atomically
+        self.state = (np.full(shape, np.nan), np.full(shape, np.nan), np.nan)
+
+        self.registered_contracts = None
+        self.contracts = []
+        # (registered contracts, options among them, bid IVs, ask IVs), swapped atomically
+        self.options = (None, [], np.empty(0), np.empty(0))
+        self.index = dict()
+        self.seen_versions = dict()
+        self.solve_spot = np.nan
+        self.last_full_refresh = 0
+
+        self.last_update_latency = 0
+        self.max_update_latency = 0
+        self.update_duration = REGISTRY.histogram("surface_update_seconds", "Duration of one live surface update")
+
+
+    def start(self):
+        self.stop_surface = False
+        self.surface_thread = threading.Thread(target=lambda: self.run())
+        self.surface_thread.start()
+
+
+    def run(self):
+        while not self.stop_surface:
+            start = time.perf_counter()
+            try:
+                self.update()
+            except Exception as e:
+                self.logger.info("Error updating live volatility surface: {}".format(e))
+
+            elapsed = time.perf_counter() - start
+            self.last_update_latency = elapsed
+            self.max_update_latency = max(self.max_update_latency, elapsed)
+            self.update_duration.observe(elapsed)
+            if elapsed > self.update_interval:
+                self.logger.debug("Live surface update took {:.3f}s.".format(elapsed))
+            time.sleep(max(self.update_interval - elapsed, 0))
+
+
+    def register_contracts(self, contracts):
+        self.contracts = [c for c in contracts if is_option(c)]
+        self.index = {c:i for i, c in enumerate(self.contracts)}
+        n = len(self.contracts)
+
+        self.expiration = np.empty(n)
+        self.strike = np.empty(n)
+        self.typ = np.empty(n, dtype="<U1")
+        for i, contract in enumerate(self.contracts):
+            expiration, strike, typ = parse_option(contract)
+            self.expiration[i] = expiration.timestamp()
+            self.strike[i] = strike
+            self.typ[i] = typ
+
+        self.bid = np.full(n, np.nan)
+        self.ask = np.full(n, np.nan)
+        self.bid_iv = np.full(n, np.nan)
+        self.ask_iv = np.full(n, np.nan)
+        self.seen_versions = dict()
+        self.solve_spot = np.nan
+        # published last, readers see either the old or the new contracts with their IVs
+        self.options = (contracts, self.contracts, self.bid_iv, self.ask_iv)
+        self.registered_contracts = contracts
+
+
+    @timed("live_surface_update")
+    def update(self):
+        now = time.time()
+        spot = (self.feed.btcusd_best_ask + self.feed.btcusd_best_bid) / 2
+        if spot <= 0:
+            return
+
+        if self.feed.contracts is not self.registered_contracts:
+            self.register_contracts(self.feed.contracts)
+        if len(self.contracts) == 0:
+            return
+        if len(self.feed.stale) > 0:
+            return # the restored surface is served until the books are fresh
+
+        versions = dict(self.feed.book_version)
+        full_refresh = (np.isnan(self.solve_spot)
+                        or abs(spot / self.solve_spot - 1) > self.spot_tolerance
+                        or now - self.last_full_refresh > self.full_refresh_interval)
+        if full_refresh:
+            dirty = np.arange(len(self.contracts))
+            self.solve_spot = spot
+            self.last_full_refresh = now
+        else:
+            dirty = np.array([self.index[c] for c, v in versions.items()
+                              if c in self.index and self.seen_versions.get(c) != v], dtype=int)
+        self.seen_versions = versions
+        if len(dirty) == 0:
+            return
+
+        ob = self.feed.ob
+        for i in dirty:
+            book = ob.get(self.contracts[i])
+            if book is None:
+                self.bid[i] = self.ask[i] = np.nan
+                continue
+            bids = book["bids"]
+            asks = book["asks"]
+            self.bid[i] = max(bids) if len(bids) > 0 else np.nan
+            self.ask[i] = min(asks) if len(asks) > 0 else np.nan
+
+        ttmyears = (self.expiration - now) / (60*60*24*365)
+        for prices, ivs in [(self.bid, self.bid_iv), (self.ask, self.ask_iv)]:
+            solved, status = iv_solver.implied_vol(prices[dirty], self.solve_spot, self.strike[dirty],
+                                                   ttmyears[dirty], self.typ[dirty],
+                                                   initial_vol=ivs[dirty], inverse=True)
+            # quotes without a valid IV count as 0, as in the stored snapshots
+            solved[(status != iv_solver.CONVERGED) & (status != iv_solver.NOT_CONVERGED)] = 0
+            ivs[dirty] = solved
+
+        live = ttmyears > 0
+        ttmdays, moneyness, mid_iv = self.bvix.surface_nodes(self.solve_spot, self.strike[live], ttmyears[live],
+                                                             self.typ[live], self.bid[live], self.ask[live],
+                                                             self.bid_iv[live], self.ask_iv[live])
+        surface = self.bvix.interpolate_surface(ttmdays, moneyness, mid_iv)
+
+        # a node is refreshed when one of the two expiries bracketing its maturity was
+        refreshed = self.state[1].copy()
+        if full_refresh:
+            refreshed[:] = now
+        else:
+            expiries = np.unique(ttmdays)
+            dirty_expiries = np.isin(expiries, ttmyears[dirty] * 365)
+            lo = np.searchsorted(expiries, self.days, side="right") - 1
+            hi = np.searchsorted(expiries, self.days, side="left")
+            touched = ((lo >= 0) & dirty_expiries[np.clip(lo, 0, len(expiries) - 1)] |
+                       (hi < len(expiries)) & dirty_expiries[np.clip(hi, 0, len(expiries) - 1)])
+            refreshed[:, touched] = now
+
+        self.state = (surface, refreshed, now)
+
+
+    def iv(self, moneyness, ttm):
+        """ Mid IV at moneyness (strike / spot) and time to maturity in days.
+        Accepts scalars or arrays, arrays return a (moneyness x ttm) grid. """
+
+        surface = self.state[0]
+        x = np.log(np.atleast_1d(np.asarray(moneyness, dtype=float)))
+        t = np.atleast_1d(np.asarray(ttm, dtype=float))
+
+        by_maturity = interpolate_rows(np.broadcast_to(self.log_moneyness, (len(self.days), len(self.log_moneyness))),
+                                       surface.T, x)
+        ivs = interpolate_rows(np.broadcast_to(self.days, (len(x), len(self.days))), by_maturity.T, t)
+
+        if np.ndim(moneyness) == 0 and np.ndim(ttm) == 0:
+            return ivs[0, 0]
+        return ivs
+
+
+    def grid(self):
+        """ Returns copies of the surface, the time each node was last refreshed
+        and the time of the last update (unix seconds) """
+
+        surface, refreshed, updated = self.state
+        return surface.copy(), refreshed.copy(), updated
+
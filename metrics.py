@@ -0,0 +1,216 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from bisect import bisect_left
+import threading
+import time
+import logging
+
+
+""" Counters, gauges and histograms for the running bot, served in the
+Prometheus text format. Updating a metric is a plain attribute increment
+(child objects per label value are created once and kept by the caller), so
+they can sit on the websocket hot path. Increments from several threads are
+not locked; a rare lost update is accepted for that. """
+
+
+DEFAULT_BUCKETS = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                   0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60] # seconds
+
+
+class Counter:
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+
+class Gauge:
+
+    def __init__(self):
+        self.value = 0
+        self.function = None
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set_function(self, function):
+        """ Evaluated on every scrape instead of the stored value """
+        self.function = function
+
+    def samples(self, name, labels):
+        yield name, labels, self.function() if self.function is not None else self.value
+
+
+class Histogram:
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return Timer(self)
+
+    def samples(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.bounds + ["+Inf"], self.counts):
+            cumulative += count
+            yield name + "_bucket", labels + [("le", str(bound))], cumulative
+        yield name + "_sum", labels, self.sum
+        yield name + "_count", labels, self.count
+
+
+class Timer:
+
+    """ with histogram.time(): ... observes the duration of the block """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metric:
+
+    """ One named metric, with a child per combination of label values """
+
+    def __init__(self, kind, name, documentation, label_names, **kwargs):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.label_names = list(label_names)
+        self.kwargs = kwargs
+        self.children = dict()
+        self.lock = threading.Lock()
+        if len(self.label_names) == 0:
+            self.children[()] = self.new_child()
+
+    def new_child(self):
+        return {"counter":Counter, "gauge":Gauge, "histogram":Histogram}[self.kind](**self.kwargs)
+
+    def labels(self, *values):
+        values = tuple(str(v) for v in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.new_child())
+        return child
+
+    # metrics without labels are used directly; on hot paths, keep labels() instead
+    def __getattr__(self, attribute):
+        if attribute in ("inc", "set", "set_function", "observe", "time", "value"):
+            return getattr(self.children[()], attribute)
+        raise AttributeError(attribute)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        for values, child in list(self.children.items()):
+            for name, labels, value in child.samples(self.name, list(zip(self.label_names, values))):
+                label_text = ",".join('{}="{}"'.format(k, v.replace("\\", "\\\\").replace('"', '\\"'))
+                                      for k, v in labels)
+                lines.append("{}{} {}".format(name, "{" + label_text + "}" if label_text else "", float(value)))
+        return lines
+
+
+class Registry:
+
+    def __init__(self, prefix="deribit_"):
+        self.prefix = prefix
+        self.metrics = dict()
+        self.lock = threading.Lock()
+
+    def get(self, kind, name, documentation, labels=(), **kwargs):
+        """ Returns the metric of that name, creating it on first use """
+
+        name = self.prefix + name
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = Metric(kind, name, documentation, labels, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, documentation, labels=()):
+        return self.get("counter", name, documentation, labels)
+
+    def gauge(self, name, documentation, labels=()):
+        return self.get("gauge", name, documentation, labels)
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.get("histogram", name, documentation, labels, buckets=buckets)
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            try:
+                lines += metric.render()
+            except Exception as e:
+                lines.append("# {} not rendered: {}".format(metric.name, e))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class MetricsServer:
+
+    """ Serves REGISTRY at http://host:port/metrics on a daemon thread. If the
+    port cannot be bound, start() logs it and the caller carries on without. """
+
+    def __init__(self, registry=REGISTRY, host="127.0.0.1", port=9108):
+        self.logger = logging.getLogger("deribit")
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self.server = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            # e.g. port in use; the bot keeps running without the endpoint
+            self.logger.info("Metrics not served on {}:{}: {}".format(self.host, self.port, e))
+            return
+        self.server.daemon_threads = True
+        self.server_thread = threading.Thread(target=lambda: self.server.serve_forever(), daemon=True)
+        self.server_thread.start()
+        self.logger.info("Serving metrics on http://{}:{}/metrics.".format(self.host, self.port))
+
+    def shutdown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server = None
@@ -0,0 +1,229 @@
+from collections import deque
+from bisect import bisect_left
+import math
+from datetime import datetime
+import threading
+import time
+import numpy as np
+import pandas as pd
+import pytz
+import logging
+
+from instruments import parse_option
+from metrics import REGISTRY
+
+
+FIELDS = ["volume", "signed_volume", "notional", "iv_volume", "trades"]
+
+
+class OptionFlow:
+
+    """
+    Rolling option trade flow per strike / expiry bucket of the BVIX grid,
+    from the trades.option.BTC.raw channel. Every trade goes to the nearest
+    grid node (log moneyness against the trade's index price, days to
+    expiry); trades beyond the grid count towards its edges. The open minute
+    is a flat list of (volume, signed volume, notional, IV x volume, trades)
+    per bucket, so a trade costs five additions. Closed minutes go to a ring
+    buffer and every window (horizon) keeps running sums, updated once per
+    minute. Windows cover the open minute and the horizon - 1 closed ones
+    before it. Volume is in contracts (BTC), signed by the aggressor side,
+    notional in USD of the underlying; finished minutes are stored in
+    obot.derbbo_flow, next to derbbo.
+    """
+
+    def __init__(self, bvix, db_connection=None, horizons=None):
+        self.logger = logging.getLogger("deribit")
+        self.schema = "obot"
+        self.table = "derbbo_flow"
+
+        self.log_moneyness = np.asarray(bvix.log_moneyness_intervals, dtype=float)
+        self.days = np.asarray(bvix.days_til_maturity, dtype=float)
+        self.moneyness_labels = np.round(np.exp(self.log_moneyness), 3) # as in bvix
+        # bucket boundaries halfway between grid nodes
+        self.moneyness_edges = ((self.log_moneyness[1:] + self.log_moneyness[:-1]) / 2).tolist()
+        self.day_edges = ((self.days[1:] + self.days[:-1]) / 2).tolist()
+        self.shape = (len(self.log_moneyness), len(self.days), len(FIELDS))
+
+        self.horizons = horizons if horizons is not None else [1, 5, 15, 60] # minutes
+        self.save_interval = 60 # seconds between writes of the finished minutes
+        self.stop_flow = False
+        self.lock = threading.Lock()
+        self.instruments = dict() # instrument name -> (expiration in unix seconds, log strike)
+        self.finished_minutes = deque(maxlen=1440) # (minute, flow) not written yet
+        self.reset()
+
+        self.engine = None
+        if db_connection is not None:
+            self.c = db_connection["c"]
+            self.conn = db_connection["conn"]
+            self.engine = db_connection["engine"]
+            self.prepare_db()
+
+        self.trades_metric = REGISTRY.counter("option_trades_total", "Option trades aggregated")
+        for horizon in self.horizons:
+            REGISTRY.gauge("option_volume", "Traded option volume (BTC)", ["horizon"]).labels(horizon).set_function(
+                lambda horizon=horizon: self.totals(horizon)["volume"])
+            REGISTRY.gauge("option_signed_volume", "Aggressor buy minus sell option volume (BTC)",
+                           ["horizon"]).labels(horizon).set_function(
+                lambda horizon=horizon: self.totals(horizon)["signed_volume"])
+
+
+    def reset(self):
+        self.capacity = max(self.horizons) # closed minutes kept
+        self.ring = np.zeros((self.capacity,) + self.shape)
+        self.minutes = 0 # closed minutes so far, the next one goes to minutes % capacity
+        self.current = None # open minute (unix seconds)
+        self.flow = [0.0] * int(np.prod(self.shape)) # open minute, flat
+        # per horizon, the sums of its horizon - 1 latest closed minutes
+        self.sums = {horizon:np.zeros(self.shape) for horizon in self.horizons}
+
+
+    def prepare_db(self):
+        self.c.execute("CREATE SCHEMA IF NOT EXISTS {}".format(self.schema))
+        self.c.execute("CREATE TABLE IF NOT EXISTS {}.{}(timestamp TIMESTAMPTZ, moneyness NUMERIC, "
+                       "ttmdays INTEGER, volume NUMERIC, signed_volume NUMERIC, notional NUMERIC, "
+                       "trade_iv NUMERIC, trades INTEGER)".format(self.schema, self.table))
+        self.conn.commit()
+
+
+    def instrument(self, instrument_name):
+        expiration, strike, typ = parse_option(instrument_name)
+        parsed = (expiration.timestamp(), math.log(strike))
+        self.instruments[instrument_name] = parsed
+        return parsed
+
+
+    def on_trades(self, trades):
+        """ trades.option.BTC.raw message data, called by WSClient """
+
+        with self.lock:
+            for trade in trades:
+                minute = trade["timestamp"] // 60000 * 60
+                if self.current is None:
+                    self.current = minute
+                elif minute > self.current:
+                    self.roll(minute)
+
+                name = trade["instrument_name"]
+                parsed = self.instruments.get(name)
+                if parsed is None:
+                    parsed = self.instrument(name)
+                expiration, log_strike = parsed
+                index_price = trade["index_price"]
+                i = bisect_left(self.moneyness_edges, log_strike - math.log(index_price))
+                j = bisect_left(self.day_edges, (expiration - trade["timestamp"] / 1000) / 86400)
+
+                amount = trade["amount"]
+                k = (i * self.shape[1] + j) * self.shape[2]
+                flow = self.flow
+                flow[k] += amount
+                flow[k + 1] += amount if trade["direction"] == "buy" else -amount
+                flow[k + 2] += amount * index_price
+                flow[k + 3] += amount * trade.get("iv", 0) / 100
+                flow[k + 4] += 1
+        self.trades_metric.inc(len(trades))
+
+
+    def roll(self, minute):
+        """ Closes the open minute and empty ones for the minutes without trades, up to minute """
+
+        if (minute - self.current) // 60 > self.capacity:
+            # silent for longer than the longest window
+            self.close_minute()
+            self.reset()
+            self.current = minute
+            return
+        while self.current < minute:
+            self.close_minute()
+            self.current += 60
+
+
+    def close_minute(self):
+        flow = np.array(self.flow).reshape(self.shape)
+        i = self.minutes % self.capacity
+        self.ring[i] = flow
+        for horizon in self.horizons:
+            if horizon == 1:
+                continue
+            sums = self.sums[horizon]
+            sums += flow
+            if self.minutes >= horizon - 1:
+                sums -= self.ring[(self.minutes - horizon + 1) % self.capacity]
+        self.minutes += 1
+        if flow[..., 4].any():
+            self.finished_minutes.append((self.current, flow))
+        self.flow = [0.0] * len(self.flow)
+
+
+    def window(self, horizon):
+        """ Flow of the last horizon minutes (one of self.horizons) per bucket,
+        shape (moneyness, maturities, FIELDS) """
+
+        with self.lock:
+            return self.sums[horizon] + np.array(self.flow).reshape(self.shape)
+
+
+    def totals(self, horizon):
+        flow = self.window(horizon).sum(axis=(0, 1))
+        return dict(zip(FIELDS, flow.tolist()))
+
+
+    def to_frame(self, minute, flow):
+        """ One row per bucket with trades """
+
+        i, j = np.nonzero(flow[..., 4])
+        volume = flow[i, j, 0]
+        return pd.DataFrame({"timestamp":datetime.fromtimestamp(minute, tz=pytz.UTC),
+                             "moneyness":self.moneyness_labels[i], "ttmdays":self.days[j].astype(int),
+                             "volume":volume, "signed_volume":flow[i, j, 1], "notional":flow[i, j, 2],
+                             "trade_iv":flow[i, j, 3] / volume,
+                             "trades":flow[i, j, 4].astype(int)})
+
+
+    def start(self):
+        self.stop_flow = False
+        self.flow_thread = threading.Thread(target=lambda: self.run())
+        self.flow_thread.start()
+
+
+    def run(self):
+        last_save = time.time()
+        while not self.stop_flow:
+            time.sleep(1)
+            # minutes keep closing while no trades arrive
+            with self.lock:
+                now = int(time.time())
+                if self.current is not None and now - now % 60 > self.current:
+                    self.roll(now - now % 60)
+            if time.time() - last_save >= self.save_interval:
+                self.save()
+                last_save = time.time()
+
+
+    def save(self):
+        with self.lock:
+            minutes = list(self.finished_minutes)
+            self.finished_minutes.clear()
+        if len(minutes) == 0 or self.engine is None:
+            return
+        try:
+            df = pd.concat([self.to_frame(minute, flow) for minute, flow in minutes], ignore_index=True)
+            df.to_sql(self.table, con=self.engine, schema=self.schema, if_exists='append', index=False)
+        except Exception as e:
+            self.logger.info("Error writing option trade flow to database: {}".format(e))
+
+
+    def report(self, horizon=60, rows=10):
+        """ Busiest buckets of a window as text, for the CLI """
+
+        flow = self.window(horizon)
+        totals = dict(zip(FIELDS, flow.sum(axis=(0, 1)).tolist()))
+        lines = ["Option trades, last {} minutes: volume {:,.1f}  signed {:+,.1f}  notional {:,.0f}  trades {:,.0f}"
+                 .format(horizon, totals["volume"], totals["signed_volume"], totals["notional"], totals["trades"])]
+        frame = self.to_frame(0, flow).sort_values("volume", ascending=False).head(rows)
+        for row in frame.itertuples():
+            lines.append("  moneyness {:5.3f}  {:>3}d  volume {:8,.1f}  signed {:+9,.1f}  notional {:14,.0f}  "
+                         "iv {:6.1%}  trades {:5}".format(row.moneyness, row.ttmdays, row.volume,
+                                                          row.signed_volume, row.notional, row.trade_iv, row.trades))
+        return "\n".join(lines)
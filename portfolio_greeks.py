@@ -0,0 +1,123 @@
+import time
+import numpy as np
+import logging
+
+import iv_solver
+from black_scholes import greeks
+from instruments import is_option, parse_option
+
+
+GREEKS = ["delta", "gamma", "vega", "theta", "vanna", "charm"]
+
+
+class PortfolioGreeks:
+
+    """
+    Holds the options positions as arrays and computes IV and greeks for the
+    whole book in one vectorized pass. Positions are synced incrementally:
+    only legs whose size or mark price changed are touched, and only those
+    (or all legs, after spot moved) have their IVs re-solved.
+    """
+
+    def __init__(self):
+        self.logger = logging.getLogger("deribit")
+        self.spot_tolerance = 0.0001 # re-solve every IV when spot moved by more than this
+
+        self.names = []
+        self.index = dict()
+        self.expiration = np.empty(0)
+        self.strike = np.empty(0)
+        self.is_call = np.empty(0, dtype=bool)
+        self.size = np.empty(0)
+        self.mark_price = np.empty(0)
+        self.iv = np.empty(0)
+        self.iv_status = np.empty(0, dtype=int)
+        self.stale = np.empty(0, dtype=bool) # IV needs re-solving
+
+        self.solve_spot = np.nan
+        self.leg_greeks = {greek:np.empty(0) for greek in GREEKS} # per unit, per leg
+        self.totals = {greek:0.0 for greek in GREEKS} # size-weighted, whole book
+        self.last_compute_time = 0
+
+
+    def sync(self, positions):
+        """ Applies the current positions dict (instrument_name -> position)
+        to the arrays, touching only legs that changed """
+
+        for name, position in positions.items():
+            if not is_option(name):
+                continue
+            i = self.index.get(name)
+            if i is None:
+                if position["size"] == 0:
+                    continue
+                i = self.add_leg(name)
+            self.set_leg(i, position["size"], position["mark_price"])
+
+        closed = [name for name in self.names if name not in positions or positions[name]["size"] == 0]
+        if len(closed) > 0:
+            self.remove_legs(closed)
+
+
+    def set_leg(self, i, size, mark_price):
+        if self.mark_price[i] != mark_price:
+            self.mark_price[i] = mark_price
+            self.stale[i] = True
+        self.size[i] = size
+
+
+    def add_leg(self, name):
+        expiration, strike, typ = parse_option(name)
+        self.index[name] = len(self.names)
+        self.names.append(name)
+        self.expiration = np.append(self.expiration, expiration.timestamp())
+        self.strike = np.append(self.strike, strike)
+        self.is_call = np.append(self.is_call, typ == "C")
+        self.size = np.append(self.size, 0.0)
+        self.mark_price = np.append(self.mark_price, np.nan)
+        self.iv = np.append(self.iv, np.nan)
+        self.iv_status = np.append(self.iv_status, iv_solver.NOT_CONVERGED)
+        self.stale = np.append(self.stale, True)
+        return self.index[name]
+
+
+    def remove_legs(self, names):
+        keep = np.ones(len(self.names), dtype=bool)
+        keep[[self.index[name] for name in names]] = False
+        self.names = [name for name, k in zip(self.names, keep) if k]
+        self.index = {name:i for i, name in enumerate(self.names)}
+        for attribute in ["expiration", "strike", "is_call", "size", "mark_price", "iv", "iv_status", "stale"]:
+            setattr(self, attribute, getattr(self, attribute)[keep])
+
+
+    def compute(self, spot, now=None):
+        """ Solves stale IVs and recomputes the greeks of every leg. Returns the
+        size-weighted totals of the book (delta in BTC). """
+
+        start = time.perf_counter()
+        now = time.time() if now is None else now
+        ttmyears = (self.expiration - now) / (60*60*24*365)
+
+        if np.isnan(self.solve_spot) or abs(spot / self.solve_spot - 1) > self.spot_tolerance:
+            self.stale[:] = True
+            self.solve_spot = spot
+
+        stale = np.flatnonzero(self.stale)
+        if len(stale) > 0:
+            ivs, status = iv_solver.implied_vol(self.mark_price[stale], spot, self.strike[stale], ttmyears[stale],
+                                                np.where(self.is_call[stale], "c", "p"),
+                                                initial_vol=self.iv[stale], inverse=True)
+            # marks without time value are valued at (almost) zero volatility,
+            # other legs which could not be solved keep their last known IV
+            ivs[status == iv_solver.BELOW_INTRINSIC] = iv_solver.MIN_VOL
+            solved = (status == iv_solver.CONVERGED) | (status == iv_solver.BELOW_INTRINSIC)
+            self.iv[stale[solved]] = ivs[solved]
+            self.iv_status[stale] = status
+            self.stale[stale] = False
+            if not solved.all():
+                self.logger.debug("No implied volatility for {}.".format([self.names[i] for i in stale[~solved]]))
+
+        self.leg_greeks = greeks(spot, self.strike, np.round(self.iv, 4), ttmyears, self.is_call, GREEKS)
+        self.totals = {greek:float(np.sum(values * self.size)) for greek, values in self.leg_greeks.items()}
+        self.last_compute_time = time.perf_counter() - start
+        return self.totals
@@ -0,0 +1,143 @@
+from collections import Counter
+from datetime import datetime
+import functools
+import os
+import signal
+import sys
+import threading
+import time
+import logging
+
+from metrics import REGISTRY
+
+
+""" Runtime diagnostics: a sampling profiler for all threads which writes
+collapsed stacks (the input format of flamegraph.pl / speedscope), and opt-in
+timing decorators for the hot paths which feed the function_seconds
+histogram. Both are switched on and off while the bot runs. """
+
+
+timing_enabled = False
+
+
+def set_timing(enabled):
+    global timing_enabled
+    timing_enabled = enabled
+
+
+def timed(name):
+    """ Records the duration of every call into function_seconds{function=name}
+    while timing is enabled; otherwise only a flag check is added """
+
+    histogram = REGISTRY.histogram("function_seconds", "Duration of the timed hot path functions",
+                                   ["function"]).labels(name)
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not timing_enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler:
+
+    """
+    Samples the stacks of every thread at a fixed interval from its own
+    thread, so the profiled code runs unmodified. Stacks are counted in
+    collapsed form, "thread;outermost;...;innermost count", and written to a
+    .folded file when profiling stops.
+    """
+
+    def __init__(self, interval=0.005, output_dir="."):
+        self.logger = logging.getLogger("deribit")
+        self.interval = interval # seconds between samples
+        self.output_dir = output_dir
+        self.running = False
+        self.samples = Counter()
+        self.sample_count = 0
+        self.started = None
+        self.labels = dict() # code object -> frame label, cached
+        self.profiler_thread = None
+
+
+    def start(self):
+        if self.running:
+            return
+        self.samples = Counter()
+        self.sample_count = 0
+        self.started = datetime.now()
+        self.running = True
+        self.profiler_thread = threading.Thread(target=lambda: self.run(), name="profiler", daemon=True)
+        self.profiler_thread.start()
+        self.logger.info("Sampling profiler started ({:.0f} ms interval).".format(self.interval * 1000))
+
+
+    def stop(self):
+        """ Stops sampling and returns the path of the written profile """
+
+        if not self.running:
+            return None
+        self.running = False
+        self.profiler_thread.join()
+        path = self.dump()
+        self.logger.info("Sampling profiler stopped, {} samples written to {}.".format(self.sample_count, path))
+        return path
+
+
+    def toggle(self):
+        if self.running:
+            return "Profile written to {}.".format(self.stop())
+        self.start()
+        return "Profiling all threads, run the command again to stop and write the profile."
+
+
+    def run(self):
+        own = threading.get_ident()
+        while self.running:
+            names = {thread.ident:thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self.label(frame.f_code))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[";".join(reversed(stack))] += 1
+            self.sample_count += 1
+            time.sleep(self.interval)
+
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = "{}:{}".format(os.path.basename(code.co_filename), code.co_name).replace(";", ":")
+            self.labels[code] = label
+        return label
+
+
+    def dump(self, path=None):
+        if path is None:
+            path = os.path.join(self.output_dir, "profile-{}.folded".format(self.started.strftime("%Y%m%d-%H%M%S")))
+        with open(path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write("{} {}\n".format(stack, count))
+        return path
+
+
+    def install_signal(self, signum=None):
+        """ Toggles profiling on a signal (SIGUSR1 by default), e.g. kill -USR1 <pid>.
+        Must be called from the main thread. """
+
+        signum = signum if signum is not None else getattr(signal, "SIGUSR1", None)
+        if signum is None:
+            self.logger.info("No SIGUSR1 on this platform, profiler only available from the CLI.")
+            return
+        signal.signal(signum, lambda received, frame: self.logger.info(self.toggle()))
@@ -0,0 +1,162 @@
+import threading
+import time
+import numpy as np
+import logging
+
+import iv_solver
+from black_scholes import greeks
+from portfolio_greeks import PortfolioGreeks
+
+
+class ScenarioRisk:
+
+    """
+    Revalues the options and perpetual positions over a spot x vol shift x
+    time grid of scenarios, vectorized in chunks of spot shocks. The grid is
+    refreshed on its own thread whenever positions, marks or spot changed,
+    and replaced as a whole so the CLI can read it without locking.
+    """
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.logger = logging.getLogger("deribit")
+
+        self.spot_shocks = [-0.2, -0.1, -0.05, -0.02, 0.0, 0.02, 0.05, 0.1, 0.2] # relative spot moves
+        self.vol_shifts = [-0.2, -0.1, -0.05, 0.0, 0.05, 0.1, 0.2] # absolute IV shifts (0.1 = 10 vol points)
+        self.time_shifts = [0, 1, 7] # days forward
+        self.chunk_size = 32768 # scenario x leg values revalued at once, bounds the kernel's temporaries
+
+        self.refresh_interval = 1 # seconds between checks for changes
+        self.max_age = 30 # seconds, refresh at least this often as time passes
+        self.spot_tolerance = 0.0005 # refresh when spot moved by more than this
+        self.stop_risk = False
+
+        self.greeks = PortfolioGreeks() # own instance, the hedger's is used from another thread
+        self.state = None # dict with the latest grid, swapped atomically
+        self.last_key = None
+        self.last_spot = np.nan
+        self.last_refresh = 0
+        self.last_refresh_time = 0
+        self.refreshes = 0
+
+
+    def start(self):
+        self.stop_risk = False
+        self.risk_thread = threading.Thread(target=lambda: self.run())
+        self.risk_thread.start()
+
+
+    def run(self):
+        while not self.stop_risk:
+            try:
+                if self.changed():
+                    self.refresh()
+            except Exception as e:
+                self.logger.info("Error refreshing scenario risk grid: {}".format(e))
+            time.sleep(self.refresh_interval)
+
+
+    def changed(self):
+        spot = (self.feed.btcusd_best_ask + self.feed.btcusd_best_bid) / 2
+        if spot <= 0:
+            return False
+        positions = self.feed.positions.copy()
+        key = tuple(sorted((name, p["size"], p.get("mark_price"), p.get("direction"))
+                           for name, p in positions.items()))
+        if (key != self.last_key
+                or np.isnan(self.last_spot) or abs(spot / self.last_spot - 1) > self.spot_tolerance
+                or time.time() - self.last_refresh > self.max_age):
+            self.last_key = key
+            return True
+        return False
+
+
+    def refresh(self, spot=None, positions=None, now=None):
+        """ Recomputes the whole grid from the current (or given) positions and spot """
+
+        start = time.perf_counter()
+        now = time.time() if now is None else now
+        spot = (self.feed.btcusd_best_ask + self.feed.btcusd_best_bid) / 2 if spot is None else spot
+        positions = self.feed.positions.copy() if positions is None else positions
+
+        self.greeks.sync(positions)
+        if len(self.greeks.names) > 0:
+            self.greeks.compute(spot, now)
+        self.state = self.revalue(spot, self.perp_size(positions), now)
+
+        self.last_spot = spot
+        self.last_refresh = now
+        self.last_refresh_time = time.perf_counter() - start
+        self.refreshes += 1
+        return self.state
+
+
+    def perp_size(self, positions):
+        """ Signed BTC-PERPETUAL position in USD """
+
+        if "BTC-PERPETUAL" not in positions:
+            return 0.0
+        perp = positions["BTC-PERPETUAL"]
+        return perp["size"] if perp["direction"] == "buy" else perp["size"] * -1
+
+
+    def revalue(self, spot, perp_size, now):
+        """
+        PnL (USD) and net delta (USD), gamma and vega (BTC) of the book for
+        every scenario, as arrays of shape (spot shocks, vol shifts, time shifts).
+        Options are valued at their mark IVs plus the vol shift.
+        """
+
+        p = self.greeks
+        spots = spot * (1 + np.asarray(self.spot_shocks, dtype=float))
+        shifts = np.asarray(self.vol_shifts, dtype=float)
+        days = np.asarray(self.time_shifts, dtype=float)
+        shape = (len(spots), len(shifts), len(days))
+
+        ttmyears = (p.expiration - now) / (60*60*24*365)
+        valued = np.isfinite(p.iv) & (ttmyears > 0)
+        size = p.size[valued]
+        strike, is_call, iv, ttm = p.strike[valued], p.is_call[valued], p.iv[valued], ttmyears[valued]
+
+        # scenario axes first, legs last: (spot, vol, time, leg), a few spots at a time
+        sigma = np.maximum(iv[None, :] + shifts[:, None], iv_solver.MIN_VOL)[None, :, None, :]
+        t = np.maximum(ttm[None, :] - days[:, None] / 365, 1e-8)[None, None, :, :]
+        base = greeks(spot, strike, iv, ttm, is_call, ["price"], inverse=True)["price"]
+
+        option_pnl, option_delta, gamma, vega = (np.empty(shape) for i in range(4))
+        step = max(self.chunk_size // max(len(shifts) * len(days) * len(size), 1), 1)
+        for i in range(0, len(spots), step):
+            S = spots[i:i + step, None, None, None]
+            shocked = greeks(S, strike, sigma, t, is_call, ["price", "delta", "gamma", "vega"], inverse=True)
+            # option prices are in BTC, the perpetual is an inverse contract sized in USD
+            option_pnl[i:i + step] = np.sum((shocked["price"] * S - base * spot) * size, axis=-1)
+            option_delta[i:i + step] = np.sum(shocked["delta"] * size, axis=-1) * S[..., 0]
+            gamma[i:i + step] = np.sum(shocked["gamma"] * size, axis=-1)
+            vega[i:i + step] = np.sum(shocked["vega"] * size, axis=-1)
+        perp_pnl = perp_size * (spots / spot - 1)[:, None, None]
+
+        return {"timestamp":now, "spot":spot, "spot_shocks":np.asarray(self.spot_shocks, dtype=float),
+                "spots":spots, "vol_shifts":shifts, "time_shifts":days,
+                "legs":int(valued.sum()), "unvalued":[n for n, v in zip(p.names, valued) if not v],
+                "pnl":option_pnl + perp_pnl, "delta":option_delta + perp_size, "gamma":gamma, "vega":vega}
+
+
+    def report(self, time_shift=None):
+        """ PnL (spot x vol shift) and net delta (spot) tables as text, for the CLI """
+
+        state = self.state
+        if state is None:
+            return "No scenario risk grid yet."
+
+        k = 0 if time_shift is None else int(np.argmin(np.abs(state["time_shifts"] - time_shift)))
+        lines = ["Scenario PnL (USD) at spot {:.1f}, {} legs, +{:g} days, {:.1f}s old:".format(
+                 state["spot"], state["legs"], state["time_shifts"][k], time.time() - state["timestamp"])]
+        lines.append("{:>8} ".format("spot") + "".join("{:>11}".format("vol {:+.0f}".format(v * 100))
+                                                      for v in state["vol_shifts"]) + "{:>13}".format("delta USD"))
+        zero_vol = int(np.argmin(np.abs(state["vol_shifts"])))
+        for i, shock in enumerate(state["spot_shocks"]):
+            lines.append("{:>+7.0%}  ".format(shock) + "".join("{:>11.0f}".format(pnl) for pnl in state["pnl"][i, :, k])
+                         + "{:>13.0f}".format(state["delta"][i, zero_vol, k]))
+        if len(state["unvalued"]) > 0:
+            lines.append("Not valued (no IV or expired): {}".format(", ".join(state["unvalued"])))
+        return "\n".join(lines)
@@ -3,25 +3,29 @@ from datetime import datetime, timedelta
 import pytz
 import numpy as np
 import time
-from py_vollib_vectorized import vectorized_implied_volatility as viv
 from volatility_index import BVIX
+from iv_cache import IVCache
+from metrics import REGISTRY
+from profiler import timed
 import logging
 
 class SaveBBO:
     
-    def __init__(self, feed, db_connection):
+    def __init__(self, feed, db_connection=None):
         self.feed = feed
         self.logger = logging.getLogger("deribit")
         self.counter = 0
-        self.c = db_connection["c"]
-        self.conn = db_connection["conn"]
-        self.engine = db_connection["engine"]
         
         self.save_interval = 60
         self.schema = "obot"
         self.table = "derbbo"
         
-        self.prepare_db()
+        self.engine = None
+        if db_connection is not None: # snapshots can be taken without a database, e.g. for benchmarks
+            self.c = db_connection["c"]
+            self.conn = db_connection["conn"]
+            self.engine = db_connection["engine"]
+            self.prepare_db()
         
         self.columns = ["timestamp", "contract", "underlying", 
                         "expiration", "strike", "typ", 
@@ -34,6 +38,31 @@ class SaveBBO:
         
         self.stop_taking_snapshots = False
         self.bvix = BVIX(db_connection)
+        self.iv_cache = IVCache() # only quotes that changed since the last snapshot are re-solved
+        
+        # change-only persistence: only rows whose BBO/OI/IV moved beyond the 
+        # tolerance since they were last written are stored, plus a full 
+        # keyframe every keyframe_interval snapshots
+        self.change_only = False
+        self.keyframe_interval = 60
+        self.change_tolerance = {"bid":0, "bid_size":0, "ask":0, "ask_size":0, 
+                                 "oi":0, "bid_iv":0.001, "ask_iv":0.001}
+        self.last_written = pd.DataFrame(columns=list(self.change_tolerance.keys()))
+        self.snapshot_counter = 0
+        
+        stages = REGISTRY.histogram("snapshot_stage_seconds", "Duration of the snapshot stages", ["stage"])
+        self.collect_duration = stages.labels("collect")
+        self.iv_duration = stages.labels("iv")
+        self.write_duration = stages.labels("derbbo_write")
+        self.volsurf_duration = stages.labels("volsurf")
+        self.snapshot_duration = stages.labels("total")
+        self.rows_written = REGISTRY.counter("rows_written_total", "Rows written to the database", 
+                                             ["table"]).labels(self.table)
+        self.snapshot_errors = REGISTRY.counter("snapshot_errors_total", "Snapshots that could not be written")
+        # registered by the owner, so they follow self.iv_cache rather than the last IVCache created
+        REGISTRY.gauge("iv_cache_hit_rate", "Share of IV cache lookups that were hits").set_function(
+            lambda: self.iv_cache.hit_rate())
+        REGISTRY.gauge("iv_cache_size", "Entries in the IV cache").set_function(lambda: len(self.iv_cache.cache))
         
         
     def prepare_db(self):
@@ -48,6 +77,73 @@ class SaveBBO:
                         "ask_iv NUMERIC)".format(self.schema, self.table))
         self.conn.commit()
         
+        # one-off migration to change-only persistence, done once the snapshots table has its spot column
+        self.c.execute("SELECT 1 FROM information_schema.columns WHERE table_schema = %s AND table_name = %s "
+                       "AND column_name = 'btcusd_price'", (self.schema, self.table + "_snapshots"))
+        if self.c.fetchone() is None:
+            self.migrate_db()
+        
+        """ Dense reader view: for every snapshot timestamp, each contract's 
+        latest row written since the last keyframe, with the snapshot's spot 
+        and time to maturity (and USD prices at that spot). The keyframe comes 
+        from the snapshots table and the scan of derbbo is bounded to 
+        [keyframe, snapshot] by the timestamp index, so the cost per snapshot 
+        does not grow with the history. """
+        
+        self.c.execute("CREATE OR REPLACE VIEW {0}.{1}_dense AS "
+                       "SELECT s.timestamp AS timestamp, "
+                       "coalesce(s.btcusd_price, r.btcusd_price) AS btcusd_price, "
+                       "round((extract(epoch FROM r.expiration - s.timestamp) / (60*60*24*365))::numeric, 6) AS ttmyears, "
+                       "r.expiration, r.strike, r.typ, r.oi, r.bid, "
+                       "round(r.bid * coalesce(s.btcusd_price, r.btcusd_price), 2) AS bid_usd, "
+                       "r.bid_size, r.bid_iv, r.ask, "
+                       "round(r.ask * coalesce(s.btcusd_price, r.btcusd_price), 2) AS ask_usd, "
+                       "r.ask_size, r.ask_iv "
+                       "FROM (SELECT n.timestamp, n.btcusd_price, "
+                       "(SELECT max(k.timestamp) FROM {0}.{1}_snapshots k "
+                       "WHERE k.keyframe AND k.timestamp <= n.timestamp) AS keyframe "
+                       "FROM {0}.{1}_snapshots n) s "
+                       "CROSS JOIN LATERAL ("
+                       "SELECT DISTINCT ON (d.expiration, d.strike, d.typ) d.* "
+                       "FROM {0}.{1} d "
+                       "WHERE d.timestamp >= s.keyframe AND d.timestamp <= s.timestamp "
+                       "AND d.expiration > s.timestamp "
+                       "ORDER BY d.expiration, d.strike, d.typ, d.timestamp DESC) r"
+                       .format(self.schema, self.table))
+        self.conn.commit()
+        
+    
+    def migrate_db(self):
+        """ Schema changes of change-only persistence and the backfill of the 
+        snapshots table, committed together so an interrupted migration reruns """
+        
+        # rows written before change-only persistence existed are full snapshots
+        self.c.execute("ALTER TABLE {}.{} ADD COLUMN IF NOT EXISTS "
+                       "keyframe BOOLEAN DEFAULT TRUE".format(self.schema, self.table))
+        self.c.execute("CREATE TABLE IF NOT EXISTS {}.{}_snapshots("
+                       "timestamp TIMESTAMPTZ, keyframe BOOLEAN, "
+                       "rows_written INTEGER, rows_total INTEGER)".format(self.schema, self.table))
+        # spot once per snapshot, carried-forward rows keep the spot of when they were written
+        self.c.execute("ALTER TABLE {}.{}_snapshots ADD COLUMN IF NOT EXISTS "
+                       "btcusd_price INTEGER".format(self.schema, self.table))
+        self.c.execute("CREATE INDEX IF NOT EXISTS {1}_timestamp_idx ON {0}.{1} (timestamp)"
+                       .format(self.schema, self.table))
+        self.c.execute("CREATE INDEX IF NOT EXISTS {1}_snapshots_timestamp_idx ON {0}.{1}_snapshots (timestamp)"
+                       .format(self.schema, self.table))
+        self.c.execute("CREATE INDEX IF NOT EXISTS {1}_snapshots_keyframe_idx ON {0}.{1}_snapshots "
+                       "(keyframe, timestamp)".format(self.schema, self.table))
+        
+        # snapshots written before the snapshots table existed are keyframes, 
+        # and those written before it had a spot column get the spot of their rows
+        self.c.execute("INSERT INTO {0}.{1}_snapshots (timestamp, keyframe, rows_written, rows_total, btcusd_price) "
+                       "SELECT timestamp, TRUE, count(*), count(*), max(btcusd_price) FROM {0}.{1} "
+                       "WHERE timestamp < (SELECT coalesce(min(timestamp), 'infinity') FROM {0}.{1}_snapshots) "
+                       "GROUP BY timestamp".format(self.schema, self.table))
+        self.c.execute("UPDATE {0}.{1}_snapshots s SET btcusd_price = (SELECT max(d.btcusd_price) "
+                       "FROM {0}.{1} d WHERE d.timestamp = s.timestamp) "
+                       "WHERE s.btcusd_price IS NULL AND s.rows_written > 0".format(self.schema, self.table))
+        self.conn.commit()
+        
     
     def schedule_snapshot(self):
         while True:
@@ -75,12 +171,17 @@ class SaveBBO:
             except Exception:
                 pass
     
+    @timed("take_snapshot")
     def take_snapshot(self, ts):
         
+        start = time.perf_counter()
         self.ob = self.feed.fetch_local_ob()
         self.oi = self.feed.fetch_local_oi()
         ts = ts.replace(microsecond=0)
-        contracts = list(self.ob.keys())
+        stale = self.feed.stale # books restored from a checkpoint are not stored
+        contracts = [c for c in self.ob.keys() if c not in stale]
+        if len(contracts) == 0:
+            return
         data = []
         
         for i in range(len(contracts)):
@@ -107,9 +208,12 @@ class SaveBBO:
                          best_ask, best_ask_size, oi])
         
         df = pd.DataFrame(data, columns=["timestamp", "contract", "bid", "bid_size", "ask", "ask_size", "oi"])
+        self.collect_duration.observe(time.perf_counter() - start)
         self.options_calculations(df)
+        self.snapshot_duration.observe(time.perf_counter() - start)
         
         
+    @timed("options_calculations")
     def options_calculations(self, df):
         
         df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True)
@@ -148,20 +252,22 @@ class SaveBBO:
         df.drop(["month_string", "year", "month", "day", "expiration_date"], axis=1, inplace=True)
         df["ttmyears"] = (((df["expiration"] - df["timestamp"]).dt.total_seconds()) / (60*60*24*365)).round(6)
         
-        btcusd_price = int((self.feed.btcusd_best_ask + self.feed.btcusd_best_bid) / 2)
+        best_bid, best_ask = self.feed.spot()
+        btcusd_price = int((best_ask + best_bid) / 2)
         df["btcusd_price"] = btcusd_price
         df["bid_usd"] = (df["bid"] * df["btcusd_price"]).round(2)
         df["ask_usd"] = (df["ask"] * df["btcusd_price"]).round(2)
         
-        df["bid_iv"] = viv(df["bid_usd"], df["btcusd_price"], df["strike"], 
-                           df["ttmyears"], 0, df["typ"].str.lower(), 0, 
-                           on_error="ignore", model='black_scholes_merton', 
-                           return_as = 'numpy').round(4)
+        contracts = df["contract"].tolist()
+        start = time.perf_counter()
+        df["bid_iv"] = self.iv_cache.implied_vols(contracts, "bid", df["bid_usd"], btcusd_price, 
+                                                  df["strike"], df["ttmyears"], df["typ"]).round(4)
+        
+        df["ask_iv"] = self.iv_cache.implied_vols(contracts, "ask", df["ask_usd"], btcusd_price, 
+                                                  df["strike"], df["ttmyears"], df["typ"]).round(4)
         
-        df["ask_iv"] = viv(df["ask_usd"], df["btcusd_price"], df["strike"], 
-                           df["ttmyears"], 0, df["typ"].str.lower(), 0, 
-                           on_error="ignore", model='black_scholes_merton', 
-                           return_as = 'numpy').round(4)
+        self.iv_duration.observe(time.perf_counter() - start)
+        self.logger.debug("IV cache: {}".format(self.iv_cache.stats()))
         
         df = df.astype({"btcusd_price":float, "contract":str, "ttmyears":float, 
                         "underlying":str, "strike":float, "typ":str, 
@@ -172,17 +278,65 @@ class SaveBBO:
         df["expiration"] = pd.to_datetime(df["expiration"], utc=True)
         
         df = df.replace([np.inf, -np.inf], np.nan)
+        df_to_write, keyframe, last_written = self.select_rows_to_write(df)
         df.drop(["contract", "underlying"], axis=1, inplace=True)
+        df_to_write = df_to_write.drop(["contract", "underlying"], axis=1)
+        df_to_write["keyframe"] = keyframe
         
-        try:
-            df.to_sql("derbbo", con=self.engine, schema="obot", if_exists='append', index=False, chunksize=10000)
-        except Exception as e:
-            self.logger.info("Error writing orderbook snapshot to database: {}".format(e))
+        written = self.engine is None # nothing to lose without a database
+        if self.engine is not None:
+            try:
+                with self.write_duration.time():
+                    df_to_write.to_sql("derbbo", con=self.engine, schema="obot", if_exists='append', index=False, chunksize=10000)
+                    self.c.execute("INSERT INTO {}.{}_snapshots (timestamp, keyframe, rows_written, rows_total, "
+                                   "btcusd_price) VALUES (%s, %s, %s, %s, %s)".format(self.schema, self.table), 
+                                   (df["timestamp"].iloc[0].to_pydatetime(), keyframe, len(df_to_write), len(df), 
+                                    btcusd_price))
+                    self.conn.commit()
+                self.rows_written.inc(len(df_to_write))
+                written = True
+            except Exception as e:
+                self.snapshot_errors.inc()
+                self.logger.info("Error writing orderbook snapshot to database: {}".format(e))
+        if written:
+            # after a failed write, the next snapshot writes those rows again (or is the keyframe instead)
+            self.last_written = last_written
+            self.snapshot_counter += 1
 
-        self.bvix.create_volsurf_snapshot(df)
+        with self.volsurf_duration.time():
+            self.bvix.create_volsurf_snapshot(df)
         self.took_snapshot = True
         
     
+    def select_rows_to_write(self, df):
+        """ Returns the rows of the snapshot that need to be persisted, whether 
+        the snapshot is a keyframe and what will have been written per contract 
+        once they are; the caller keeps the latter only if the write succeeds. """
+        
+        keyframe = ((not self.change_only) or 
+                    self.snapshot_counter % self.keyframe_interval == 0)
+        
+        columns = list(self.change_tolerance.keys())
+        current = df.set_index("contract")[columns].astype(float)
+        
+        if keyframe:
+            changed = pd.Series(True, index=current.index)
+            last_written = current.copy()
+        else:
+            previous = self.last_written.reindex(current.index)
+            tolerance = pd.Series(self.change_tolerance, dtype=float)
+            moved = (current - previous).abs().gt(tolerance, axis=1)
+            appeared_or_vanished = current.isna() != previous.isna()
+            changed = (moved | appeared_or_vanished).any(axis=1)
+            
+            last_written = pd.concat([self.last_written.drop(current.index[changed], errors="ignore"), 
+                                      current[changed]])
+        
+        self.logger.debug("Snapshot rows to write: {}/{} (keyframe: {}).".format(int(changed.sum()), 
+                                                                                len(df), keyframe))
+        return df[changed.values], keyframe, last_written
+        
+    
     def month_translator(self):
         month_numbers = [[self.months[i], i+1] for i in range(len(self.months))]
         return month_numbers 
@@ -0,0 +1,365 @@
+from multiprocessing import shared_memory
+import itertools
+import threading
+import numpy as np
+import logging
+
+from hedger import DeltaHedge
+from execution import DONE_STATES
+
+
+""" Multi-process mode: the ingest process (WSClient + DataFeed) publishes
+top-of-book, open interest, BTC-PERPETUAL quotes and positions into one
+shared-memory segment, which SaveBBO / BVIX and DeltaHedge read from their own
+processes without serialization.
+
+Consistency is seqlock-style. Every book row, the header (spot and the
+instrument registry) and the positions table carry a sequence number which
+the single writer makes odd before and even after a write. Readers copy the
+data and retry whatever had an odd or changed sequence number, so the writer
+never waits for a reader. This relies on stores becoming visible in program
+order, as on x86. """
+
+
+HEADER = np.dtype([("max_instruments", "i8"), ("max_positions", "i8"), ("seq", "u8"), ("n_instruments", "i8"),
+                   ("btcusd_best_bid", "f8"), ("btcusd_best_ask", "f8"), ("positions_seq", "u8"), ("n_positions", "i8")])
+TOP = np.dtype([("seq", "u8"), ("version", "u8"), ("bid", "f8"), ("bid_size", "f8"),
+                ("ask", "f8"), ("ask_size", "f8"), ("oi", "f8")])
+POSITION = np.dtype([("instrument_name", "S48"), ("size", "f8"), ("direction", "S4"),
+                     ("mark_price", "f8"), ("average_price", "f8")])
+NAME = np.dtype("S48")
+
+
+class SharedBook:
+
+    """
+    Fixed layout in one segment: header, instrument names, one top-of-book
+    row per instrument, positions. Created by the ingest process, attached
+    by name from the others.
+    """
+
+    def __init__(self, name=None, create=False, max_instruments=4096, max_positions=1024):
+        self.logger = logging.getLogger("deribit")
+        size = HEADER.itemsize + (NAME.itemsize + TOP.itemsize) * max_instruments + POSITION.itemsize * max_positions
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size if create else 0)
+        self.created = create
+
+        # the capacities are part of the header, so readers attach by name only
+        self.header = np.ndarray(1, dtype=HEADER, buffer=self.shm.buf)
+        if create:
+            self.header[0] = (max_instruments, max_positions, 0, 0, np.nan, np.nan, 0, 0)
+        self.max_instruments = int(self.header["max_instruments"][0])
+        self.max_positions = int(self.header["max_positions"][0])
+
+        offset = HEADER.itemsize
+        self.names = np.ndarray(self.max_instruments, dtype=NAME, buffer=self.shm.buf, offset=offset)
+        offset += NAME.itemsize * self.max_instruments
+        self.top = np.ndarray(self.max_instruments, dtype=TOP, buffer=self.shm.buf, offset=offset)
+        offset += TOP.itemsize * self.max_instruments
+        self.positions = np.ndarray(self.max_positions, dtype=POSITION, buffer=self.shm.buf, offset=offset)
+
+        self.row_seq = self.top["seq"]
+        self.oi = self.top["oi"]
+        self.index = dict() # writer side: instrument name -> row
+        self.cached_names = [] # reader side: decoded names, valid while the instrument count is unchanged
+
+
+    @property
+    def name(self):
+        return self.shm.name
+
+
+    def close(self):
+        self.header = self.names = self.top = self.positions = self.row_seq = self.oi = None
+        self.shm.close()
+        if self.created:
+            self.shm.unlink()
+
+
+    # writer, called from the ingest process only
+
+    def begin(self, field="seq"):
+        self.header[field] += 1
+
+    def end(self, field="seq"):
+        self.header[field] += 1
+
+
+    def register(self, instrument_name):
+        i = len(self.index)
+        if i >= self.max_instruments:
+            raise ValueError("Shared book full ({} instruments).".format(self.max_instruments))
+        self.begin()
+        self.names[i] = instrument_name.encode()
+        self.top[i] = (0, 0, np.nan, np.nan, np.nan, np.nan, np.nan)
+        self.header["n_instruments"] = i + 1
+        self.end()
+        self.index[instrument_name] = i
+        return i
+
+
+    def publish_top(self, instrument_name, book, version):
+        """ Best bid / ask of one book dict ({"bids":{price:size}, "asks":{...}}) """
+
+        i = self.index.get(instrument_name)
+        if i is None:
+            i = self.register(instrument_name)
+        bids, asks = book["bids"], book["asks"]
+        bid = max(bids) if len(bids) > 0 else np.nan
+        ask = min(asks) if len(asks) > 0 else np.nan
+        seq = self.row_seq[i] + 1
+        self.row_seq[i] = seq
+        self.top[i] = (seq, version, bid, bids[bid] if len(bids) > 0 else np.nan,
+                       ask, asks[ask] if len(asks) > 0 else np.nan, self.oi[i])
+        self.row_seq[i] = seq + 1
+
+
+    def publish_oi(self, instrument_name, oi):
+        i = self.index.get(instrument_name)
+        if i is None:
+            i = self.register(instrument_name)
+        self.row_seq[i] += 1
+        self.oi[i] = oi
+        self.row_seq[i] += 1
+
+
+    def publish_spot(self, best_bid, best_ask):
+        self.begin()
+        self.header["btcusd_best_bid"] = best_bid
+        self.header["btcusd_best_ask"] = best_ask
+        self.end()
+
+
+    def publish_positions(self, positions):
+        rows = [(name.encode(), p["size"], p.get("direction", "buy").encode(), p.get("mark_price", np.nan),
+                 p.get("average_price", np.nan)) for name, p in list(positions.items())][:self.max_positions]
+        self.begin("positions_seq")
+        if len(rows) > 0:
+            self.positions[:len(rows)] = rows
+        self.header["n_positions"] = len(rows)
+        self.end("positions_seq")
+
+
+    # readers, any process
+
+    def read_header(self):
+        while True:
+            seq = self.header["seq"][0]
+            header = self.header[0].copy()
+            if seq % 2 == 0 and self.header["seq"][0] == seq:
+                return header
+
+
+    def read_names(self):
+        """ Instrument names in row order, decoded once per registry change """
+
+        n = int(self.read_header()["n_instruments"])
+        if len(self.cached_names) != n:
+            self.cached_names = [name.decode() for name in self.names[:n]]
+        return self.cached_names
+
+
+    def read_top(self):
+        """ Consistent copy of every instrument's row, (names, rows) """
+
+        names = self.read_names()
+        n = len(names)
+        before = self.row_seq[:n].copy()
+        rows = self.top[:n].copy()
+        torn = (before % 2 == 1) | (self.row_seq[:n] != before)
+        while torn.any():
+            retry = np.flatnonzero(torn)
+            before = self.row_seq[retry].copy()
+            rows[retry] = self.top[retry]
+            torn[retry] = (before % 2 == 1) | (self.row_seq[retry] != before)
+        return names, rows
+
+
+    def read_positions(self):
+        while True:
+            seq = self.header["positions_seq"][0]
+            n = int(self.header["n_positions"][0])
+            rows = self.positions[:n].copy()
+            if seq % 2 == 0 and self.header["positions_seq"][0] == seq:
+                return rows
+
+
+class SharedFeed:
+
+    """
+    The DataFeed attributes SaveBBO, BVIX and DeltaHedge read, served from a
+    SharedBook. Books hold the top level only, which is all they use.
+    """
+
+    def __init__(self, book):
+        self.book = book
+        self.contracts = []
+        self.stale = set() # restored books are never published
+
+    @property
+    def ob(self):
+        names, rows = self.book.read_top()
+        ob = dict()
+        for name, bid, bid_size, ask, ask_size in zip(names, rows["bid"].tolist(), rows["bid_size"].tolist(),
+                                                       rows["ask"].tolist(), rows["ask_size"].tolist()):
+            ob[name] = {"bids":{bid:bid_size} if bid == bid else {}, "asks":{ask:ask_size} if ask == ask else {}}
+        return ob
+
+    @property
+    def oi(self):
+        names, rows = self.book.read_top()
+        return {name:oi for name, oi in zip(names, rows["oi"].tolist()) if oi == oi}
+
+    @property
+    def book_version(self):
+        names, rows = self.book.read_top()
+        return dict(zip(names, rows["version"].tolist()))
+
+    @property
+    def btcusd_best_bid(self):
+        return float(self.book.read_header()["btcusd_best_bid"])
+
+    @property
+    def btcusd_best_ask(self):
+        return float(self.book.read_header()["btcusd_best_ask"])
+
+    def spot(self):
+        """ (best bid, best ask) of BTC-PERPETUAL from one consistent header read """
+        header = self.book.read_header()
+        return float(header["btcusd_best_bid"]), float(header["btcusd_best_ask"])
+
+    @property
+    def positions(self):
+        positions = dict()
+        for row in self.book.read_positions():
+            name = row["instrument_name"].decode()
+            positions[name] = {"instrument_name":name, "size":float(row["size"]),
+                               "direction":row["direction"].decode(), "mark_price":float(row["mark_price"]),
+                               "average_price":float(row["average_price"])}
+        return positions
+
+    def fetch_local_ob(self):
+        return self.ob
+
+    def fetch_local_oi(self):
+        names, rows = self.book.read_top()
+        # contracts without a ticker yet count as 0, SaveBBO reads every contract's OI
+        return dict(zip(names, np.nan_to_num(rows["oi"]).tolist()))
+
+
+ORDER_KEYS = ["order_id", "order_state", "filled_amount", "average_price", "amount", "price",
+              "direction", "label", "instrument_name", "error"]
+
+
+class OrderChannel:
+
+    """
+    Stands in for the ExecutionManager in the hedger process: submits go to
+    the ingest process, which owns the websocket, and order state changes
+    come back to the callbacks.
+    """
+
+    def __init__(self, requests, updates):
+        self.logger = logging.getLogger("deribit")
+        self.requests = requests
+        self.updates = updates
+        self.orders = dict() # request id -> order
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.update_thread = threading.Thread(target=lambda: self.run(), daemon=True)
+        self.update_thread.start()
+
+    def submit(self, method, params, callback=None):
+        order = {"method":method, "params":params, "label":params.get("label"),
+                 "instrument_name":params.get("instrument_name"), "order_id":None, "order_state":"queued",
+                 "callback":callback}
+        request_id = next(self.ids)
+        with self.lock:
+            self.orders[request_id] = order
+        self.requests.put((request_id, method, params))
+        return order
+
+    def run(self):
+        while True:
+            request_id, state = self.updates.get()
+            with self.lock:
+                order = self.orders.get(request_id)
+                if order is None:
+                    continue
+                order.update(state)
+                if order["order_state"] in DONE_STATES:
+                    del self.orders[request_id]
+            if order["callback"] is not None:
+                try:
+                    order["callback"](order)
+                except Exception as e:
+                    self.logger.info("Error in order callback: {}".format(e))
+
+    def open_orders(self, label=None, instrument_name=None):
+        with self.lock:
+            orders = list(self.orders.values())
+        return [o for o in orders if o["order_state"] not in DONE_STATES
+                and (label is None or o["label"] == label)
+                and (instrument_name is None or o["instrument_name"] == instrument_name)]
+
+
+def serve_orders(execution, requests, updates):
+    """ Ingest process side of the OrderChannel, run on its own thread """
+
+    while True:
+        message = requests.get()
+        if message is None:
+            break
+        request_id, method, params = message
+        execution.submit(method, params, callback=lambda order, request_id=request_id: updates.put(
+            (request_id, {key:order.get(key) for key in ORDER_KEYS if key in order})))
+
+
+class RemoteHedger(DeltaHedge):
+
+    """
+    The CLI and the websocket's evaluation requests in the ingest process,
+    forwarded to the DeltaHedge running in the hedger process
+    """
+
+    evaluates = False # the deltas are computed and exported by the hedger process
+
+    def __init__(self, feed, control):
+        self.control = control
+        super().__init__(feed, run_threads=False)
+        self.hedging_thread = threading.Thread(target=lambda: self.wait_for_input())
+        self.hedging_thread.start()
+
+    @property
+    def delta_hedging_activated(self):
+        return self.__dict__.get("activated", False)
+
+    @delta_hedging_activated.setter
+    def delta_hedging_activated(self, value):
+        self.__dict__["activated"] = value
+        self.control.put(("activate", value))
+
+    def request_evaluation(self, send_method):
+        self.evaluation_requests += 1
+        self.evaluation_requests_metric.inc()
+        self.control.put(("evaluate", None))
+
+    def stop(self):
+        self.stop_hedger = True
+        self.control.put(("stop", None))
+
+
+def run_hedger(hedger, control):
+    """ Applies the RemoteHedger's messages in the hedger process until stopped """
+
+    while not hedger.stop_hedger:
+        command, value = control.get()
+        if command == "activate":
+            hedger.delta_hedging_activated = value
+            hedger.logger.info("Dynamic delta-hedging activated: {}".format(value))
+            if value:
+                hedger.request_evaluation(None)
+        elif command == "evaluate":
+            hedger.request_evaluation(None)
+        elif command == "stop":
+            hedger.stop_hedger = True
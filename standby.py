@@ -0,0 +1,218 @@
+from collections import deque
+import websocket
+import json
+import threading
+import time
+import logging
+
+from metrics import REGISTRY
+
+
+CRITICAL_CHANNELS = ["book.BTC-PERPETUAL.none.1.100ms", "user.orders.any.any.raw", "user.portfolio.btc",
+                     "user.trades.any.any.raw"]
+
+
+class StandbyClient:
+
+    """
+    Hot-standby second websocket connection, subscribed to the channels the
+    hedger cannot be without: the BTC-PERPETUAL book, the user channels and
+    the raw books of held options. Both connections' messages on those
+    channels go through deliver(), which passes each one to the primary
+    WSClient's distribute() once, whichever connection received it first:
+
+    - books by change_id, which increases along every book's stream: a
+      message is new if its change_id is above the last delivered one, and
+      a raw change is only applied if its prev_change_id is that one, so
+      the delivered stream has no gaps (after a reconnect, a connection
+      resumes with a snapshot). The first message of a book, from either
+      connection, starts its stream.
+    - user.orders by order id, update time, state and filled amount
+    - user.trades by trade id, trades already seen are left out of the list
+    - user.portfolio by content
+
+    Feed writes from both connections' threads are serialized by WSClient's
+    feed_lock, so the feed and the SharedBook keep a single writer at a time.
+    While the primary reconnects, the standby's messages keep the feed and
+    the hedger current, and WSClient.send_to_ws sends through the standby.
+    The standby reconnects on its own, without the primary's backoff.
+    """
+
+    def __init__(self, primary):
+        self.primary = primary
+        self.logger = logging.getLogger("deribit")
+        self.ws_url = primary.ws_url
+        self.ping_interval = primary.ping_interval
+        self.ping_timeout = primary.ping_timeout
+        self.reconnect_wait = 1 # seconds
+        self.held_interval = 5 # seconds between checks for newly held instruments
+        self.max_seen = 10000 # keys remembered per non-book channel
+        self.stop_standby = False
+
+        self.ws = None
+        self.connected = False
+        self.authenticated = False
+        self.call_ids = iter(range(10**9, 2 * 10**9)) # away from the primary's call IDs
+        self.auth_ids = set()
+
+        self.lock = threading.Lock()
+        self.channels = set(CRITICAL_CHANNELS) # deduplicated channels, read by WSClient on every message
+        self.subscribed = set() # channels subscribed on the standby connection
+        self.last_change_id = dict() # book channel -> last delivered change_id
+        self.seen = {channel:(set(), deque()) for channel in CRITICAL_CHANNELS[1:]}
+
+        delivered = REGISTRY.counter("standby_delivered_total", "Critical channel messages delivered, by the "
+                                     "connection that received them first", ["connection"])
+        self.delivered = {connection:delivered.labels(connection) for connection in ["primary", "standby"]}
+        self.duplicates = REGISTRY.counter("standby_duplicates_total", "Critical channel messages dropped as "
+                                           "duplicates").labels()
+        self.connects = REGISTRY.counter("standby_connects_total", "Standby websocket connection attempts")
+        REGISTRY.gauge("standby_connected", "Standby websocket connected and authenticated").set_function(
+            lambda: int(self.authenticated))
+
+
+    def start(self):
+        self.stop_standby = False
+        self.standby_thread = threading.Thread(target=lambda: self.run(), name="standby")
+        self.standby_thread.start()
+        self.held_thread = threading.Thread(target=lambda: self.watch_held(), name="standby-held")
+        self.held_thread.start()
+
+
+    def stop(self):
+        self.stop_standby = True
+        if self.ws is not None:
+            self.ws.close()
+
+
+    def run(self):
+        while not self.stop_standby:
+            self.connects.inc()
+            self.ws = websocket.WebSocketApp(self.ws_url, on_open=self.on_open, on_message=self.on_message,
+                                             on_error=self.on_error, on_close=self.on_close)
+            self.ws.run_forever(skip_utf8_validation=True, ping_interval=self.ping_interval,
+                                ping_timeout=self.ping_timeout)
+            self.connected = self.authenticated = False
+            self.subscribed = set()
+            if not self.stop_standby:
+                self.logger.info("Standby websocket closed, reconnecting in {}s.".format(self.reconnect_wait))
+                time.sleep(self.reconnect_wait)
+
+
+    def on_open(self, placeholder):
+        self.connected = True
+        self.send(self.primary.auth_message(), "public/auth", auth=True)
+
+
+    def on_error(self, placeholder, error):
+        self.logger.info("Standby websocket error: {}".format(error))
+
+
+    def on_close(self, placeholder, status, message):
+        self.connected = self.authenticated = False
+
+
+    def send(self, params, method, auth=False):
+        call_id = next(self.call_ids)
+        if auth:
+            self.auth_ids.add(call_id)
+        self.ws.send(json.dumps({"jsonrpc":"2.0", "id":call_id, "method":method, "params":params}))
+
+
+    def subscribe(self, channels):
+        """ Adds channels to the deduplicated set and subscribes them on the standby """
+
+        channels = [channel for channel in channels if channel not in self.subscribed]
+        if len(channels) == 0 or not self.authenticated:
+            return
+        with self.lock:
+            self.channels.update(channels)
+        self.subscribed.update(channels)
+        public = [channel for channel in channels if not channel.startswith("user.")]
+        private = [channel for channel in channels if channel.startswith("user.")]
+        if len(public) > 0:
+            self.send({"channels":public}, "public/subscribe")
+        if len(private) > 0:
+            self.send({"channels":private}, "private/subscribe")
+
+
+    def held_channels(self):
+        feed = self.primary.feed
+        held = {name for name, position in list(feed.positions.items()) if position.get("size", 0) != 0}
+        held.update(name for name, orders in list(feed.orders.items()) if len(orders) > 0)
+        return ["book.{}.raw".format(name) for name in held if name[-2:] in ("-C", "-P")]
+
+
+    def watch_held(self):
+        while not self.stop_standby:
+            time.sleep(self.held_interval)
+            try:
+                self.subscribe(self.held_channels())
+            except Exception as e:
+                self.logger.info("Error subscribing held instruments on the standby: {}".format(e))
+
+
+    def on_message(self, placeholder, message):
+        try:
+            reply = json.loads(message)
+            if "id" in reply:
+                if reply["id"] in self.auth_ids:
+                    self.auth_ids.discard(reply["id"])
+                    if "result" in reply:
+                        self.authenticated = True
+                        self.logger.info("Standby websocket authenticated.")
+                        self.subscribe(CRITICAL_CHANNELS + self.held_channels())
+                elif self.primary.execution is not None and self.primary.execution.owns(reply["id"]):
+                    # sent through the standby while the primary was down
+                    self.primary.execution.on_response(reply)
+            elif reply.get("method") == "subscription":
+                channel = reply["params"]["channel"]
+                if channel in self.channels:
+                    self.deliver(channel, reply["params"]["data"], "standby")
+        except Exception as e:
+            self.logger.info("Error processing standby message: {}".format(e))
+
+
+    def deliver(self, channel, data, connection):
+        """ Passes a critical channel message to the primary's distribute()
+        unless the other connection delivered it already """
+
+        with self.lock:
+            if channel[:5] == "book.":
+                last = self.last_change_id.get(channel)
+                # raw changes must continue the delivered stream, snapshots and grouped books only be newer;
+                # the first message seeds it (e.g. the primary's changes of a book just subscribed on the standby)
+                if last is not None and (data["change_id"] <= last or data.get("prev_change_id", last) != last):
+                    self.duplicates.inc()
+                    return
+                self.last_change_id[channel] = data["change_id"]
+            elif channel == "user.trades.any.any.raw":
+                data = [trade for trade in data if self.first(channel, trade["trade_id"])]
+                if len(data) == 0:
+                    self.duplicates.inc()
+                    return
+            elif channel == "user.orders.any.any.raw":
+                if not self.first(channel, (data["order_id"], data.get("last_update_timestamp"),
+                                            data.get("order_state"), data.get("filled_amount"))):
+                    self.duplicates.inc()
+                    return
+            elif channel == "user.portfolio.btc":
+                if not self.first(channel, json.dumps(data, sort_keys=True)):
+                    self.duplicates.inc()
+                    return
+            self.delivered[connection].inc()
+            # under the lock, so the two connections' messages are applied in delivery order
+            self.primary.distribute(channel, data)
+
+
+    def first(self, channel, key):
+        """ Records key, returns False if it was seen before """
+
+        keys, order = self.seen[channel]
+        if key in keys:
+            return False
+        keys.add(key)
+        order.append(key)
+        if len(order) > self.max_seen:
+            keys.discard(order.popleft())
+        return True
@@ -0,0 +1,216 @@
+from datetime import datetime
+import math
+import threading
+import time
+import pytz
+import logging
+
+from instruments import parse_option
+from metrics import REGISTRY
+
+
+class SubscriptionTiers:
+
+    """
+    Assigns every option to a subscription tier. "raw" instruments get the
+    full-depth book.<instrument>.raw and ticker.<instrument>.raw channels;
+    all others get the grouped book.<instrument>.none.<depth>.<interval> and
+    ticker.<instrument>.<interval>, which is all SaveBBO needs. Raw are held
+    instruments (positions or open orders), instruments with OI of at least
+    raw_min_oi, and those within raw_moneyness (absolute log moneyness) of
+    spot that expire within raw_max_days. Tiers are re-evaluated every
+    interval as spot moves, with hysteresis on the moneyness band, and only
+    instruments changing tier are re-subscribed.
+
+    The saving is measured from the feed's message counts: the rate an
+    instrument had while raw, minus its rate since it was grouped. To have
+    those rates, the first subscription is all raw and tiers apply from the
+    first evaluation on.
+    """
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.send_to_ws = None # set by Bot, WSClient.send_to_ws
+        self.logger = logging.getLogger("deribit")
+
+        self.raw_moneyness = 0.1 # absolute log moneyness
+        self.raw_max_days = 60
+        self.raw_min_oi = 0 # 0 switches the OI criterion off
+        self.hysteresis = 0.02 # raw instruments are only grouped beyond raw_moneyness + hysteresis
+        self.depth = 1
+        self.interval = "100ms" # of the grouped book and ticker channels
+        self.evaluation_interval = 60 # seconds
+        self.chunk_size = 500 # channels per (un)subscribe request
+        self.stop_tiers = False
+
+        self.tiers = dict() # instrument -> "raw" / "grouped"
+        self.parsed = dict() # instrument -> (expiration in unix seconds, log strike)
+        self.spot_known = False
+        self.last_evaluation = 0
+        self.last_counts = (time.time(), dict())
+        self.rates = dict() # instrument -> messages per second in the last evaluation interval
+        self.raw_rates = dict() # instrument -> messages per second when it was last raw
+        self.switches = 0
+
+        switches = REGISTRY.counter("tier_switches_total", "Instruments re-subscribed in another tier", ["tier"])
+        self.switches_metric = {tier:switches.labels(tier) for tier in ["raw", "grouped"]}
+        instruments = REGISTRY.gauge("tier_instruments", "Options per subscription tier", ["tier"])
+        rates = REGISTRY.gauge("tier_messages_per_second", "Book and ticker messages per tier", ["tier"])
+        for tier in ["raw", "grouped"]:
+            instruments.labels(tier).set_function(lambda tier=tier: self.summary()[tier]["instruments"])
+            rates.labels(tier).set_function(lambda tier=tier: self.summary()[tier]["rate"])
+        REGISTRY.gauge("tier_saving_messages_per_second", "Messages per second saved by the grouped tier").set_function(
+            lambda: self.summary()["saving"])
+
+
+    def channels(self, instrument_name, tier):
+        """ Book and ticker channel of an instrument in a tier """
+
+        if tier == "raw":
+            return ["book.{}.raw".format(instrument_name), "ticker.{}.raw".format(instrument_name)]
+        return ["book.{}.none.{}.{}".format(instrument_name, self.depth, self.interval),
+                "ticker.{}.{}".format(instrument_name, self.interval)]
+
+
+    def spot(self):
+        bid, ask = self.feed.btcusd_best_bid, self.feed.btcusd_best_ask
+        return (bid + ask) / 2 if bid > 0 and ask > 0 else None
+
+
+    def held(self):
+        held = {name for name, position in list(self.feed.positions.items()) if position.get("size", 0) != 0}
+        held.update(name for name, orders in list(self.feed.orders.items()) if len(orders) > 0)
+        return held
+
+
+    def tier(self, instrument_name, spot, now, held, oi):
+        if instrument_name in held:
+            return "raw"
+        if self.raw_min_oi > 0 and oi.get(instrument_name, 0) >= self.raw_min_oi:
+            return "raw"
+        if spot is None:
+            return "grouped"
+        parsed = self.parsed.get(instrument_name)
+        if parsed is None:
+            expiration, strike, typ = parse_option(instrument_name)
+            parsed = self.parsed[instrument_name] = (expiration.timestamp(), math.log(strike))
+        expiration, log_strike = parsed
+        band = self.raw_moneyness + (self.hysteresis if self.tiers.get(instrument_name) == "raw" else 0)
+        if abs(log_strike - math.log(spot)) <= band and (expiration - now) / 86400 <= self.raw_max_days:
+            return "raw"
+        return "grouped"
+
+
+    def evaluate(self, contracts):
+        """ Tier of every contract at the current spot, positions and OI """
+
+        spot, now, held, oi = self.spot(), time.time(), self.held(), dict(self.feed.oi)
+        self.spot_known = spot is not None
+        return {name:self.tier(name, spot, now, held, oi) for name in contracts}
+
+
+    def assign(self, contracts):
+        """ Tiers for a fresh subscription (WSClient.build_subscriptions). Until
+        the raw rates have been measured once, everything starts raw. """
+
+        if len(self.raw_rates) == 0:
+            self.tiers = {name:"raw" for name in contracts}
+            self.spot_known = True # first evaluation after a full interval
+        else:
+            self.tiers = self.evaluate(contracts)
+        self.feed.grouped = {name for name, tier in self.tiers.items() if tier == "grouped"}
+        self.last_evaluation = time.time()
+        self.last_counts = (time.time(), self.feed.message_counts())
+        return self.tiers
+
+
+    def reevaluate(self):
+        """ Re-subscribes the instruments whose tier changed, returns how many """
+
+        self.measure()
+        tiers = self.evaluate(list(self.tiers))
+        changed = [name for name, tier in tiers.items() if tier != self.tiers[name]]
+        self.last_evaluation = time.time()
+        if len(changed) == 0:
+            return 0
+
+        unsubscribe, subscribe = [], []
+        for name in changed:
+            unsubscribe += self.channels(name, self.tiers[name])
+            subscribe += self.channels(name, tiers[name])
+            # messages of the old channels still in flight are ignored by the feed from here on
+            if tiers[name] == "grouped":
+                self.feed.grouped.add(name)
+            else:
+                self.feed.grouped.discard(name)
+            self.tiers[name] = tiers[name]
+            self.switches_metric[tiers[name]].inc()
+        for i in range(0, len(unsubscribe), self.chunk_size):
+            self.send_to_ws({"channels":unsubscribe[i:i + self.chunk_size]}, "public/unsubscribe")
+        for i in range(0, len(subscribe), self.chunk_size):
+            self.send_to_ws({"channels":subscribe[i:i + self.chunk_size]}, "public/subscribe")
+        self.switches += len(changed)
+        self.logger.info("Subscription tiers: {} instruments raw, {} grouped after re-subscribing {}.".format(
+            sum(tier == "raw" for tier in self.tiers.values()), len(self.feed.grouped), len(changed)))
+        return len(changed)
+
+
+    def measure(self):
+        """ Messages per second of every instrument since the last call """
+
+        now = time.time()
+        counts = self.feed.message_counts()
+        start, previous = self.last_counts
+        elapsed = now - start
+        if elapsed > 0:
+            self.rates = {name:(counts.get(name, 0) - previous.get(name, 0)) / elapsed for name in self.tiers}
+            self.raw_rates.update({name:rate for name, rate in self.rates.items() if self.tiers[name] == "raw"})
+        self.last_counts = (now, counts)
+
+
+    def summary(self):
+        summary = {tier:{"instruments":0, "rate":0.0} for tier in ["raw", "grouped"]}
+        saving = 0.0
+        for name, tier in list(self.tiers.items()):
+            rate = self.rates.get(name, 0.0)
+            summary[tier]["instruments"] += 1
+            summary[tier]["rate"] += rate
+            if tier == "grouped" and name in self.raw_rates:
+                saving += self.raw_rates[name] - rate
+        summary["saving"] = saving
+        return summary
+
+
+    def start(self):
+        self.stop_tiers = False
+        self.tiers_thread = threading.Thread(target=lambda: self.run())
+        self.tiers_thread.start()
+
+
+    def run(self):
+        while not self.stop_tiers:
+            time.sleep(1)
+            if len(self.tiers) == 0:
+                continue
+            try:
+                # right away once spot is known, when the first subscription was made without it
+                if (time.time() - self.last_evaluation >= self.evaluation_interval or
+                        (not self.spot_known and self.spot() is not None)):
+                    self.reevaluate()
+            except Exception as e:
+                self.logger.info("Error re-evaluating subscription tiers: {}".format(e))
+
+
+    def report(self):
+        """ Tiers and message rates as text, for the CLI """
+
+        summary = self.summary()
+        lines = ["Subscription tiers, {} re-subscribed so far:".format(self.switches)]
+        for tier in ["raw", "grouped"]:
+            lines.append("  {:<8} {:5} instruments  {:9,.1f} messages/s".format(
+                tier, summary[tier]["instruments"], summary[tier]["rate"]))
+        measured = sum(1 for name, tier in self.tiers.items() if tier == "grouped" and name in self.raw_rates)
+        lines.append("  saving   {:9,.1f} messages/s, measured on {} of {} grouped instruments (last evaluation "
+                     "{})".format(summary["saving"], measured, summary["grouped"]["instruments"],
+                                  datetime.fromtimestamp(self.last_evaluation, tz=pytz.UTC).strftime("%H:%M:%S")))
+        return "\n".join(lines)
@@ -0,0 +1,214 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import time
+import numpy as np
+import pandas as pd
+from scipy.optimize import least_squares
+import logging
+
+
+""" Parametric volatility surface fitting. Every expiry is fitted with raw SVI
+in a process pool, then the whole surface is calibrated with a power-law SSVI
+whose parameters satisfy the Gatheral-Jacquier conditions for no static
+arbitrage. Both fits warm-start from the previous snapshot's parameters. """
+
+
+SVI_BOUNDS = ([-1.0, 0.0, -0.999, -2.0, 1e-4], [1.0, 5.0, 0.999, 2.0, 5.0]) # a, b, rho, m, sigma
+SSVI_BOUNDS = ([-0.999, 1e-4, 0.0], [0.999, 1.0, 0.5]) # rho, eta / eta_max(rho, gamma), gamma
+
+
+def svi_total_variance(params, k):
+    a, b, rho, m, sigma = params
+    return a + b * (rho * (k - m) + np.sqrt((k - m)**2 + sigma**2))
+
+
+def ssvi_total_variance(params, k, theta):
+    rho, eta, gamma = ssvi_natural_params(params)
+    phi = eta / (theta**gamma * (1 + theta)**(1 - gamma))
+    return theta / 2 * (1 + rho * phi * k + np.sqrt((phi * k + rho)**2 + 1 - rho**2))
+
+
+def ssvi_natural_params(params):
+    """ eta is fitted as a fraction of the largest eta for which the power-law
+    SSVI is free of butterfly arbitrage (Gatheral-Jacquier, theorem 4.2):
+    theta * phi * (1 + |rho|) < 4 and theta * phi^2 * (1 + |rho|) <= 4 for
+    every theta. With gamma <= 0.5, the supremum of theta * phi^2 / eta^2 is
+    (1 - 2 gamma)^(1 - 2 gamma) / (2 - 2 gamma)^(2 - 2 gamma), reached at
+    theta = 1 - 2 gamma, and that of theta * phi / eta is 1. """
+
+    rho, eta_fraction, gamma = params
+    peak = (1 - 2 * gamma)**(1 - 2 * gamma) / (2 - 2 * gamma)**(2 - 2 * gamma)
+    eta_max = min(0.999 * 4 / (1 + abs(rho)), 2 / np.sqrt((1 + abs(rho)) * peak))
+    return rho, eta_fraction * eta_max, gamma
+
+
+def fit_svi_slice(task):
+    """ Fits raw SVI to one expiry. Runs in the worker processes, so it only
+    takes and returns plain arrays. """
+
+    ttmyears, moneyness, ivs, initial = task
+    total_variance = ivs**2 * ttmyears
+    if initial is None:
+        initial = [total_variance.min() / 2, 0.1, -0.3, 0.0, 0.1]
+    initial = np.clip(initial, SVI_BOUNDS[0], SVI_BOUNDS[1])
+
+    def residuals(params):
+        a, b, rho, m, sigma = params
+        # total variance must stay positive at its minimum
+        floor = min(a + b * sigma * np.sqrt(1 - rho**2), 0)
+        return np.append(svi_total_variance(params, moneyness) - total_variance, 10 * floor)
+
+    fit = least_squares(residuals, initial, bounds=SVI_BOUNDS, method="trf")
+    fitted = svi_total_variance(fit.x, moneyness)
+    rmse = np.sqrt(np.mean((np.sqrt(np.maximum(fitted, 0) / ttmyears) - ivs)**2))
+    return fit.x, rmse, fit.success
+
+
+class SVIFitter:
+
+    def __init__(self, db_connection=None):
+        self.logger = logging.getLogger("deribit")
+        self.schema = "obot"
+        self.slice_table = "bvix_svi"
+        self.surface_table = "bvix_ssvi"
+
+        self.min_points = 5 # expiries with fewer quoted strikes are not fitted
+        self.max_workers = None # defaults to the number of CPUs
+        self.pool = None
+        self.max_fit_time = 30 # seconds, warn when a fit takes longer than this
+        self.ssvi_max_std = 3 # SSVI is fitted to nodes within this many ATM standard deviations (sqrt(theta))
+        self.max_ssvi_rmse = 0.05 # vol points, SSVI fits with a larger error are not stored
+
+        self.previous_slices = [] # [(ttmdays, params)] of the last fit, for warm starts
+        self.previous_ssvi = None
+        self.last_fit_time = 0
+
+        self.engine = None
+        if db_connection is not None:
+            self.c = db_connection["c"]
+            self.conn = db_connection["conn"]
+            self.engine = db_connection["engine"]
+            self.prepare_db()
+
+
+    def prepare_db(self):
+        self.c.execute("CREATE SCHEMA IF NOT EXISTS {}".format(self.schema))
+        self.c.execute("CREATE TABLE IF NOT EXISTS {}.{}("
+                       "timestamp TIMESTAMPTZ, ttmdays NUMERIC, a NUMERIC, b NUMERIC, "
+                       "rho NUMERIC, m NUMERIC, sigma NUMERIC, theta NUMERIC, "
+                       "rmse NUMERIC, converged BOOLEAN)".format(self.schema, self.slice_table))
+        self.c.execute("CREATE TABLE IF NOT EXISTS {}.{}("
+                       "timestamp TIMESTAMPTZ, rho NUMERIC, eta NUMERIC, gamma NUMERIC, "
+                       "rmse NUMERIC, converged BOOLEAN)".format(self.schema, self.surface_table))
+        self.conn.commit()
+
+
+    def fit_and_save(self, ttmdays, moneyness, mid_iv, ts):
+        try:
+            slices, ssvi = self.fit(ttmdays, moneyness, mid_iv)
+            if len(slices) == 0 or self.engine is None:
+                return
+            slices["timestamp"] = pd.to_datetime(ts, utc=True)
+            ssvi["timestamp"] = pd.to_datetime(ts, utc=True)
+            slices.to_sql(self.slice_table, con=self.engine, schema=self.schema,
+                          if_exists='append', index=False)
+            if not ssvi["converged"] or not ssvi["rmse"] <= self.max_ssvi_rmse:
+                self.logger.info("SSVI fit not stored (rmse {:.4f}, converged {}).".format(ssvi["rmse"],
+                                                                                          ssvi["converged"]))
+                return
+            pd.DataFrame([ssvi]).to_sql(self.surface_table, con=self.engine, schema=self.schema,
+                                        if_exists='append', index=False)
+        except Exception as e:
+            self.logger.info("Error writing SVI parameters to database: {}".format(e))
+
+
+    def fit(self, ttmdays, moneyness, mid_iv):
+        """ Fits every expiry and the SSVI surface to the BVIX surface nodes.
+        Returns the slice parameters as a DataFrame and the SSVI parameters. """
+
+        start = time.perf_counter()
+        quoted = np.isfinite(mid_iv) & (mid_iv > 0)
+        ttmdays, moneyness, mid_iv = ttmdays[quoted], moneyness[quoted], mid_iv[quoted]
+
+        tasks = []
+        expiries = []
+        for ttm in np.unique(ttmdays):
+            in_slice = ttmdays == ttm
+            if in_slice.sum() < self.min_points or ttm <= 0:
+                continue
+            expiries.append(ttm)
+            tasks.append((ttm / 365, moneyness[in_slice], mid_iv[in_slice], self.warm_start(ttm)))
+
+        if len(tasks) == 0:
+            return pd.DataFrame(), {}
+
+        results = self.map(tasks)
+        slices = pd.DataFrame([list(params) + [rmse, success] for params, rmse, success in results],
+                              columns=["a", "b", "rho", "m", "sigma", "rmse", "converged"])
+        slices.insert(0, "ttmdays", expiries)
+        self.previous_slices = [(ttm, params) for ttm, (params, rmse, success) in zip(expiries, results)]
+
+        # ATM total variance per expiry, made non-decreasing to avoid calendar arbitrage
+        thetas = np.maximum.accumulate([max(svi_total_variance(params, 0.0), 1e-8) for params, r, s in results])
+        slices["theta"] = thetas
+
+        ssvi = self.fit_ssvi(tasks, thetas)
+
+        self.last_fit_time = time.perf_counter() - start
+        if self.last_fit_time > self.max_fit_time:
+            self.logger.info("SVI fit took {:.1f}s.".format(self.last_fit_time))
+        return slices, ssvi
+
+
+    def fit_ssvi(self, tasks, thetas):
+        """ Fits the SSVI parameters in implied vol, so short expiries (small
+        total variances) weigh as much as long ones, to the nodes within
+        ssvi_max_std ATM standard deviations: the far wings of the quoted
+        smile grow faster than any arbitrage-free SSVI can """
+
+        k = np.concatenate([task[1] for task in tasks])
+        ivs = np.concatenate([task[2] for task in tasks])
+        ttmyears = np.concatenate([np.full(len(task[1]), task[0]) for task in tasks])
+        theta = np.concatenate([np.full(len(task[1]), t) for task, t in zip(tasks, thetas)])
+        fitted_range = np.abs(k) <= self.ssvi_max_std * np.sqrt(theta)
+        k, ivs, ttmyears, theta = k[fitted_range], ivs[fitted_range], ttmyears[fitted_range], theta[fitted_range]
+
+        def residuals(params):
+            return np.sqrt(np.maximum(ssvi_total_variance(params, k, theta), 0) / ttmyears) - ivs
+
+        initial = self.previous_ssvi if self.previous_ssvi is not None else [-0.3, 0.5, 0.3]
+        fit = least_squares(residuals, np.clip(initial, SSVI_BOUNDS[0], SSVI_BOUNDS[1]),
+                            bounds=SSVI_BOUNDS, method="trf")
+        self.previous_ssvi = fit.x
+
+        rmse = np.sqrt(np.mean(residuals(fit.x)**2))
+        rho, eta, gamma = ssvi_natural_params(fit.x)
+        return {"rho":rho, "eta":eta, "gamma":gamma, "rmse":rmse, "converged":fit.success}
+
+
+    def warm_start(self, ttmdays):
+        """ Parameters of the previous fit of the same expiry, matched by time to maturity """
+
+        for previous_ttm, params in self.previous_slices:
+            if abs(previous_ttm - ttmdays) < 0.5:
+                return params
+        return None
+
+
+    def map(self, tasks):
+        if self.pool is None:
+            # spawned, not forked: the bot process runs websocket, hedger and metrics threads
+            self.pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                            mp_context=multiprocessing.get_context("spawn"))
+        try:
+            return list(self.pool.map(fit_svi_slice, tasks))
+        except Exception as e:
+            self.logger.info("SVI process pool failed ({}), fitting in this process.".format(e))
+            self.pool = None
+            return [fit_svi_slice(task) for task in tasks]
+
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
+            self.pool = None
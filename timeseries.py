@@ -0,0 +1,300 @@
+import threading
+import time
+import numpy as np
+import logging
+
+from instruments import parse_option
+from portfolio_greeks import GREEKS
+from metrics import REGISTRY
+
+
+""" In-process history of the live surface, per-instrument mid IVs and the
+portfolio greeks, so lookbacks such as "ATM 7d vol over the last hour" need
+no database. Every series is kept at several resolutions (1s, 1m, 1h by
+default) in fixed-capacity ring buffers, so memory is allocated once and
+bounded by width x capacities x itemsize. """
+
+
+RESOLUTIONS = {1:3600, 60:1440, 3600:720} # seconds per row -> rows kept (1h of seconds, 1d of minutes, 30d of hours)
+
+
+class RingBuffer:
+
+    """ Rows of a fixed width with their timestamps, the oldest overwritten first """
+
+    def __init__(self, capacity, width, dtype=np.float32):
+        self.capacity = capacity
+        self.timestamps = np.full(capacity, np.nan)
+        self.values = np.full((capacity, width), np.nan, dtype=dtype)
+        self.count = 0 # rows written so far, the next one goes to count % capacity
+
+    def append(self, timestamp, row):
+        i = self.count % self.capacity
+        self.timestamps[i] = timestamp
+        self.values[i] = row
+        self.count += 1
+
+    def order(self):
+        """ Row indices, oldest first """
+        n = min(self.count, self.capacity)
+        return (self.count - n + np.arange(n)) % self.capacity
+
+    def oldest(self):
+        if self.count == 0:
+            return np.nan
+        return self.timestamps[(self.count - min(self.count, self.capacity)) % self.capacity]
+
+    def range(self, start, end, columns=None):
+        """ (timestamps, values) of the rows with start <= timestamp <= end """
+
+        order = self.order()
+        timestamps = self.timestamps[order]
+        lo = np.searchsorted(timestamps, start, side="left")
+        hi = np.searchsorted(timestamps, end, side="right")
+        rows = order[lo:hi]
+        values = self.values[rows] if columns is None else self.values[rows[:, None], np.asarray(columns)[None, :]]
+        return timestamps[lo:hi], values
+
+    @property
+    def nbytes(self):
+        return self.timestamps.nbytes + self.values.nbytes
+
+
+class TimeSeries:
+
+    """
+    One multi-resolution series. Samples are averaged (per column, NaNs
+    left out) into the bucket of the finest resolution; a closed bucket is
+    written to that resolution's ring and averaged into the next coarser
+    one, so coarser rows are time-weighted means. Queries see closed buckets
+    only, i.e. lag by at most one bucket.
+    """
+
+    def __init__(self, width, resolutions=None, dtype=np.float32):
+        self.width = width
+        self.resolutions = sorted((resolutions if resolutions is not None else RESOLUTIONS).items())
+        self.levels = {resolution:RingBuffer(capacity, width, dtype) for resolution, capacity in self.resolutions}
+        # open bucket per resolution: [start, sums, counts]
+        self.buckets = {resolution:[None, np.zeros(width), np.zeros(width)] for resolution, capacity in self.resolutions}
+        self.lock = threading.Lock()
+
+    def append(self, timestamp, row):
+        with self.lock:
+            self.add(0, timestamp, np.asarray(row, dtype=float))
+
+    def add(self, level, timestamp, row):
+        resolution = self.resolutions[level][0]
+        bucket = self.buckets[resolution]
+        start = timestamp - timestamp % resolution
+        if bucket[0] is not None and start != bucket[0]:
+            self.close(level)
+        bucket[0] = start
+        valid = ~np.isnan(row)
+        bucket[1][valid] += row[valid]
+        bucket[2] += valid
+
+    def close(self, level):
+        resolution = self.resolutions[level][0]
+        start, sums, counts = self.buckets[resolution]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(counts > 0, sums / counts, np.nan)
+        self.levels[resolution].append(start, mean)
+        sums[:] = 0
+        counts[:] = 0
+        if level + 1 < len(self.resolutions):
+            self.add(level + 1, start, mean)
+
+    def clear_columns(self, columns):
+        """ Forgets the history of columns, before they are reused """
+        with self.lock:
+            for resolution, ring in self.levels.items():
+                ring.values[:, columns] = np.nan
+                self.buckets[resolution][1][columns] = 0
+                self.buckets[resolution][2][columns] = 0
+
+    def range(self, start, end=None, resolution=None, columns=None):
+        """ (timestamps, values) between start and end (unix seconds); by
+        default at the finest resolution which still reaches back to start """
+
+        end = time.time() if end is None else end
+        if resolution is None:
+            resolution = self.resolutions[-1][0]
+            for candidate, capacity in self.resolutions:
+                ring = self.levels[candidate]
+                # a ring which has not wrapped yet holds everything since startup
+                if ring.count <= ring.capacity or ring.oldest() <= start:
+                    resolution = candidate
+                    break
+        with self.lock:
+            return self.levels[resolution].range(start, end, columns)
+
+    @property
+    def nbytes(self):
+        return sum(ring.nbytes for ring in self.levels.values()) + sum(
+            bucket[1].nbytes + bucket[2].nbytes for bucket in self.buckets.values())
+
+
+class TimeSeriesStore:
+
+    """
+    Samples the live surface grid, the mid IV of every option and the
+    portfolio greeks every interval on its own thread. Instruments get a
+    column each, up to max_instruments; the columns of expired instruments
+    are cleared and reused.
+    """
+
+    def __init__(self, live_surface, risk=None, resolutions=None, max_instruments=2500, dtype=np.float32):
+        self.live_surface = live_surface
+        self.risk = risk
+        self.logger = logging.getLogger("deribit")
+
+        self.interval = 0.25 # seconds between samples
+        self.stop_store = False
+
+        self.log_moneyness = live_surface.log_moneyness
+        self.days = live_surface.days
+        self.greek_names = GREEKS + ["net_delta_usd", "spot"]
+        self.surface = TimeSeries(len(self.log_moneyness) * len(self.days), resolutions, dtype)
+        self.iv = TimeSeries(max_instruments, resolutions, dtype)
+        self.greeks = TimeSeries(len(self.greek_names), resolutions, dtype)
+
+        self.max_instruments = max_instruments
+        self.columns = dict() # instrument -> column of self.iv
+        self.free_columns = list(range(max_instruments))[::-1]
+        self.registered_contracts = None
+        self.contract_columns = np.empty(0, dtype=int)
+        self.last_surface_update = None
+        self.last_record_time = 0
+
+        REGISTRY.gauge("timeseries_bytes", "Memory allocated by the time-series store").set_function(
+            lambda: self.nbytes)
+        self.record_duration = REGISTRY.histogram("timeseries_record_seconds",
+                                                  "Duration of one time-series store sample").labels()
+
+
+    @property
+    def nbytes(self):
+        return self.surface.nbytes + self.iv.nbytes + self.greeks.nbytes
+
+
+    def start(self):
+        self.stop_store = False
+        self.store_thread = threading.Thread(target=lambda: self.run())
+        self.store_thread.start()
+
+
+    def run(self):
+        while not self.stop_store:
+            start = time.perf_counter()
+            try:
+                with self.record_duration.time():
+                    self.record()
+            except Exception as e:
+                self.logger.info("Error recording time series: {}".format(e))
+            self.last_record_time = time.perf_counter() - start
+            time.sleep(max(self.interval - self.last_record_time, 0))
+
+
+    def record(self, now=None):
+        now = time.time() if now is None else now
+        surface, refreshed, updated = self.live_surface.state
+        if updated == updated and updated != self.last_surface_update:
+            self.surface.append(updated, surface.ravel())
+            self.last_surface_update = updated
+
+        registered_contracts, contracts, bid_iv, ask_iv = self.live_surface.options
+        if registered_contracts is not self.registered_contracts:
+            self.register(contracts, now)
+            self.registered_contracts = registered_contracts
+        if len(self.contract_columns) > 0:
+            bid_iv, ask_iv = bid_iv.copy(), ask_iv.copy()
+            if len(bid_iv) == len(self.contract_columns):
+                bid_iv[bid_iv <= 0] = np.nan
+                ask_iv[ask_iv <= 0] = np.nan
+                mid_iv = np.where(np.isnan(bid_iv), ask_iv, np.where(np.isnan(ask_iv), bid_iv, (bid_iv + ask_iv) / 2))
+                row = np.full(self.max_instruments, np.nan)
+                known = self.contract_columns >= 0
+                row[self.contract_columns[known]] = mid_iv[known]
+                self.iv.append(now, row)
+
+        if self.risk is not None and self.risk.state is not None:
+            state = self.risk.state
+            totals = self.risk.greeks.totals
+            base = (int(np.argmin(np.abs(state["spot_shocks"]))), int(np.argmin(np.abs(state["vol_shifts"]))),
+                    int(np.argmin(np.abs(state["time_shifts"]))))
+            self.greeks.append(now, [totals.get(greek, np.nan) for greek in GREEKS] +
+                               [float(state["delta"][base]), state["spot"]])
+
+
+    def register(self, contracts, now):
+        """ Columns for the live surface's contracts; expired instruments give theirs back """
+
+        expired = [name for name in self.columns if parse_option(name)[0].timestamp() <= now]
+        if len(expired) > 0:
+            columns = [self.columns.pop(name) for name in expired]
+            self.iv.clear_columns(columns)
+            self.free_columns += columns
+        contract_columns = []
+        for name in contracts:
+            if name not in self.columns and len(self.free_columns) > 0:
+                self.columns[name] = self.free_columns.pop()
+            contract_columns.append(self.columns.get(name, -1))
+        if -1 in contract_columns:
+            self.logger.info("Time-series store full, {} instruments not recorded.".format(contract_columns.count(-1)))
+        self.contract_columns = np.array(contract_columns, dtype=int)
+
+
+    # queries, start and end in unix seconds
+
+    def surface_history(self, start, end=None, resolution=None):
+        """ (timestamps, surfaces of shape (n, moneyness, maturities)) """
+
+        timestamps, values = self.surface.range(start, end, resolution)
+        return timestamps, values.reshape(len(timestamps), len(self.log_moneyness), len(self.days))
+
+
+    def node_history(self, moneyness, days, start, end=None, resolution=None):
+        """ IV of the grid node nearest to moneyness (strike / spot) and days to
+        maturity, e.g. node_history(1, 7, time.time() - 3600) for ATM 7d vol
+        over the last hour """
+
+        i = int(np.argmin(np.abs(self.log_moneyness - np.log(moneyness))))
+        j = int(np.argmin(np.abs(self.days - days)))
+        timestamps, values = self.surface.range(start, end, resolution, [i * len(self.days) + j])
+        return timestamps, values[:, 0]
+
+
+    def iv_history(self, instrument_names, start, end=None, resolution=None):
+        """ (timestamps, {instrument:mid IVs}) """
+
+        names = [name for name in instrument_names if name in self.columns]
+        timestamps, values = self.iv.range(start, end, resolution, [self.columns[name] for name in names])
+        return timestamps, {name:values[:, k] for k, name in enumerate(names)}
+
+
+    def greeks_history(self, start, end=None, resolution=None, greeks=None):
+        """ (timestamps, {greek:values}), the greeks of PortfolioGreeks plus
+        net_delta_usd (perpetual included) and spot """
+
+        greeks = self.greek_names if greeks is None else greeks
+        timestamps, values = self.greeks.range(start, end, resolution,
+                                               [self.greek_names.index(greek) for greek in greeks])
+        return timestamps, {greek:values[:, k] for k, greek in enumerate(greeks)}
+
+
+    def report(self):
+        """ ATM 7d vol over the last hour and net delta over the day, for the CLI """
+
+        now = time.time()
+        timestamps, atm = self.node_history(1, 7, now - 3600)
+        delta_timestamps, greeks = self.greeks_history(now - 86400, greeks=["net_delta_usd"])
+        lines = ["Time series, {:.1f} MB allocated:".format(self.nbytes / 1e6)]
+        for label, values, fmt in [("ATM 7d vol, last hour", atm, "{:.1%}"),
+                                   ("net delta USD, last day", greeks["net_delta_usd"], "{:,.0f}")]:
+            values = values[~np.isnan(values)]
+            if len(values) == 0:
+                lines.append("  {:<24} no data".format(label))
+                continue
+            lines.append("  {:<24} now {}  min {}  max {}  first {}  ({} rows)".format(
+                label, *[fmt.format(v) for v in [values[-1], values.min(), values.max(), values[0]]], len(values)))
+        return "\n".join(lines)
@@ -0,0 +1,257 @@
+from collections import deque
+from datetime import datetime
+import threading
+import time
+import numpy as np
+import pandas as pd
+import pytz
+import logging
+
+from metrics import REGISTRY
+
+
+SECONDS_PER_YEAR = 60*60*24*365
+
+
+class TradeBars:
+
+    """
+    Rolling statistics of the BTC-PERPETUAL trade stream. Trades are
+    aggregated into one-second bars kept in ring buffers; every window
+    (horizon) holds running sums of volume, notional, trade count and squared
+    log returns, plus monotonic deques for its high and low, so closing a bar
+    costs O(number of horizons) whatever the window length. Windows cover
+    closed bars only, i.e. lag by at most one second. Minute bars with the
+    window statistics are stored in obot.perp_bars, next to bvix.
+    """
+
+    def __init__(self, db_connection=None):
+        self.logger = logging.getLogger("deribit")
+        self.schema = "obot"
+        self.table = "perp_bars"
+
+        self.horizons = [60, 300, 900, 3600] # seconds
+        self.save_interval = 60 # seconds between writes of the finished minute bars
+        self.stop_bars = False
+        self.lock = threading.Lock()
+        self.reset()
+        self.minute = None # start of the minute being aggregated (unix seconds)
+        self.minute_bar = None
+        self.finished_minutes = deque(maxlen=1440) # rows not written yet
+
+        self.engine = None
+        if db_connection is not None:
+            self.c = db_connection["c"]
+            self.conn = db_connection["conn"]
+            self.engine = db_connection["engine"]
+            self.prepare_db()
+
+        self.trades_metric = REGISTRY.counter("perp_trades_total", "BTC-PERPETUAL trades aggregated")
+        for horizon in self.horizons:
+            REGISTRY.gauge("perp_realized_vol", "Annualized realized volatility of BTC-PERPETUAL",
+                           ["horizon"]).labels(horizon).set_function(
+                lambda horizon=horizon: self.window(horizon)["realized_vol"])
+            REGISTRY.gauge("perp_vwap", "Volume-weighted average price of BTC-PERPETUAL",
+                           ["horizon"]).labels(horizon).set_function(lambda horizon=horizon: self.window(horizon)["vwap"])
+
+
+    def reset(self):
+        self.capacity = max(self.horizons) + 1 # one-second bars
+        self.open = np.zeros(self.capacity)
+        self.high = np.zeros(self.capacity)
+        self.low = np.zeros(self.capacity)
+        self.close = np.zeros(self.capacity)
+        self.volume = np.zeros(self.capacity)
+        self.notional = np.zeros(self.capacity)
+        self.trades = np.zeros(self.capacity, dtype=int)
+        self.squared_return = np.zeros(self.capacity)
+
+        self.bars = 0 # closed bars so far, the next one goes to bars % capacity
+        self.current = None # second of the open bar
+        self.bar = None # open bar: [open, high, low, close, volume, notional, trades]
+        self.last_close = np.nan
+        # per horizon: [volume, notional, trades, sum of squared log returns], and deques of (bar, high / low)
+        self.sums = {horizon:[0.0, 0.0, 0, 0.0] for horizon in self.horizons}
+        self.highs = {horizon:deque() for horizon in self.horizons}
+        self.lows = {horizon:deque() for horizon in self.horizons}
+
+
+    def prepare_db(self):
+        self.c.execute("CREATE SCHEMA IF NOT EXISTS {}".format(self.schema))
+        string = ("CREATE TABLE IF NOT EXISTS {}.{}(timestamp TIMESTAMPTZ, open NUMERIC, high NUMERIC, "
+                  "low NUMERIC, close NUMERIC, volume NUMERIC, vwap NUMERIC, trades INTEGER, "
+                  .format(self.schema, self.table))
+        for horizon in self.horizons:
+            string += "vwap_{0}s NUMERIC, rv_{0}s NUMERIC, ".format(horizon)
+        self.c.execute(string[:-2] + ")")
+        self.conn.commit()
+
+
+    def on_trades(self, trades):
+        """ trades.BTC-PERPETUAL.raw message data, called by WSClient """
+
+        with self.lock:
+            for trade in trades:
+                second = trade["timestamp"] // 1000
+                if self.current is None:
+                    self.start_bar(second, trade["price"])
+                elif second > self.current:
+                    self.roll(second)
+                price, amount = trade["price"], trade["amount"]
+                bar = self.bar
+                if bar[6] == 0:
+                    bar[0] = bar[1] = bar[2] = price
+                bar[1] = max(bar[1], price)
+                bar[2] = min(bar[2], price)
+                bar[3] = price
+                bar[4] += amount
+                bar[5] += price * amount
+                bar[6] += 1
+        self.trades_metric.inc(len(trades))
+
+
+    def start_bar(self, second, price):
+        self.current = second
+        self.bar = [price, price, price, price, 0.0, 0.0, 0]
+
+
+    def roll(self, second):
+        """ Closes the open bar and empty bars for the seconds without trades, up to second """
+
+        if second - self.current > self.capacity:
+            # silent for longer than the longest window
+            price = self.bar[3]
+            self.close_bar()
+            self.finish_minute()
+            self.minute_bar = self.minute = None
+            self.reset()
+            self.start_bar(second, price)
+            return
+        while self.current < second:
+            self.close_bar()
+            price = self.bar[3]
+            self.start_bar(self.current + 1, price)
+
+
+    def close_bar(self):
+        o, h, l, c, volume, notional, trades = self.bar
+        i = self.bars % self.capacity
+        squared_return = np.log(c / self.last_close)**2 if self.last_close > 0 else 0.0
+        self.open[i], self.high[i], self.low[i], self.close[i] = o, h, l, c
+        self.volume[i], self.notional[i], self.trades[i], self.squared_return[i] = volume, notional, trades, squared_return
+        self.last_close = c
+
+        for horizon in self.horizons:
+            sums = self.sums[horizon]
+            sums[0] += volume
+            sums[1] += notional
+            sums[2] += trades
+            sums[3] += squared_return
+            if self.bars >= horizon:
+                j = (self.bars - horizon) % self.capacity
+                sums[0] -= self.volume[j]
+                sums[1] -= self.notional[j]
+                sums[2] -= self.trades[j]
+                sums[3] -= self.squared_return[j]
+            highs, lows = self.highs[horizon], self.lows[horizon]
+            while len(highs) > 0 and highs[-1][1] <= h:
+                highs.pop()
+            highs.append((self.bars, h))
+            while len(lows) > 0 and lows[-1][1] >= l:
+                lows.pop()
+            lows.append((self.bars, l))
+            while highs[0][0] <= self.bars - horizon:
+                highs.popleft()
+            while lows[0][0] <= self.bars - horizon:
+                lows.popleft()
+        self.bars += 1
+        self.add_to_minute(self.current, o, h, l, c, volume, notional, trades)
+
+
+    def add_to_minute(self, second, o, h, l, c, volume, notional, trades):
+        minute = second - second % 60
+        if self.minute != minute:
+            if self.minute_bar is not None:
+                self.finish_minute()
+            self.minute = minute
+            self.minute_bar = [o, h, l, c, 0.0, 0.0, 0]
+        bar = self.minute_bar
+        bar[1] = max(bar[1], h)
+        bar[2] = min(bar[2], l)
+        bar[3] = c
+        bar[4] += volume
+        bar[5] += notional
+        bar[6] += trades
+
+
+    def finish_minute(self):
+        o, h, l, c, volume, notional, trades = self.minute_bar
+        row = {"timestamp":datetime.fromtimestamp(self.minute, tz=pytz.UTC), "open":o, "high":h, "low":l,
+               "close":c, "volume":volume, "vwap":notional / volume if volume > 0 else np.nan, "trades":trades}
+        for horizon in self.horizons:
+            window = self.window(horizon)
+            row["vwap_{}s".format(horizon)] = window["vwap"]
+            row["rv_{}s".format(horizon)] = window["realized_vol"]
+        self.finished_minutes.append(row)
+
+
+    def window(self, horizon):
+        """ Statistics of the last horizon seconds (one of self.horizons) """
+
+        volume, notional, trades, squared_returns = self.sums[horizon]
+        bars = min(self.bars, horizon)
+        if bars == 0:
+            return {"bars":0, "open":np.nan, "high":np.nan, "low":np.nan, "close":np.nan, "volume":0.0,
+                    "vwap":np.nan, "trades":0, "realized_vol":np.nan}
+        highs, lows = self.highs[horizon], self.lows[horizon]
+        return {"bars":bars, "open":self.open[(self.bars - bars) % self.capacity],
+                "high":highs[0][1] if len(highs) > 0 else np.nan, "low":lows[0][1] if len(lows) > 0 else np.nan,
+                "close":self.last_close, "volume":volume, "vwap":notional / volume if volume > 0 else np.nan,
+                "trades":int(trades), "realized_vol":np.sqrt(max(squared_returns, 0) * SECONDS_PER_YEAR / bars)}
+
+
+    def windows(self):
+        return {horizon:self.window(horizon) for horizon in self.horizons}
+
+
+    def start(self):
+        self.stop_bars = False
+        self.bars_thread = threading.Thread(target=lambda: self.run())
+        self.bars_thread.start()
+
+
+    def run(self):
+        last_save = time.time()
+        while not self.stop_bars:
+            time.sleep(1)
+            # bars keep closing while no trades arrive
+            with self.lock:
+                if self.current is not None:
+                    self.roll(int(time.time()) - 1)
+            if time.time() - last_save >= self.save_interval:
+                self.save()
+                last_save = time.time()
+
+
+    def save(self):
+        with self.lock:
+            rows = list(self.finished_minutes)
+            self.finished_minutes.clear()
+        if len(rows) == 0 or self.engine is None:
+            return
+        try:
+            pd.DataFrame(rows).to_sql(self.table, con=self.engine, schema=self.schema,
+                                      if_exists='append', index=False)
+        except Exception as e:
+            self.logger.info("Error writing perpetual bars to database: {}".format(e))
+
+
+    def report(self):
+        """ Rolling windows as text, for the CLI """
+
+        lines = ["BTC-PERPETUAL trades:"]
+        for horizon, window in self.windows().items():
+            lines.append("  {:>5}s  vwap {:10.2f}  high {:10.2f}  low {:10.2f}  volume {:14,.0f}  trades {:6}  "
+                         "realized vol {:6.1%}".format(horizon, window["vwap"], window["high"], window["low"],
+                                                       window["volume"], window["trades"], window["realized_vol"]))
+        return "\n".join(lines)
@@ -4,19 +4,20 @@ from datetime import datetime
 import pytz
 import warnings
 import logging
+
+from svi import SVIFitter
+from metrics import REGISTRY
+from profiler import timed
 warnings.filterwarnings("ignore")
 
 
 class BVIX:
     
-    def __init__(self, db_connection):
+    def __init__(self, db_connection=None):
         
         self.logger = logging.getLogger("deribit")
         self.schema = "obot"
         self.table = "bvix"
-        self.c = db_connection["c"]
-        self.conn = db_connection["conn"]
-        self.engine = db_connection["engine"]
         
         self.days_til_maturity = [3, 7, 10, 14, 17, 21, 24, 28, 31, 35, 38, 
                                   42, 45, 49, 52, 56, 84]
@@ -27,7 +28,24 @@ class BVIX:
                                     1.3, 1.4, 1.5, 1.6, 1.7]
         
         self.log_moneyness_intervals = [i-1 for i in self.moneyness_intervals]
-        self.prepare_db()
+        
+        self.engine = None
+        if db_connection is not None: # surfaces can be built without a database, e.g. for benchmarks
+            self.c = db_connection["c"]
+            self.conn = db_connection["conn"]
+            self.engine = db_connection["engine"]
+            self.prepare_db()
+        
+        # parametric SVI / SSVI fits of the same nodes, stored next to the grid
+        self.fit_svi = True
+        self.svi = SVIFitter(db_connection)
+        
+        stages = REGISTRY.histogram("snapshot_stage_seconds", "Duration of the snapshot stages", ["stage"])
+        self.surface_duration = stages.labels("surface")
+        self.surface_write_duration = stages.labels("bvix_write")
+        self.svi_duration = stages.labels("svi")
+        self.rows_written = REGISTRY.counter("rows_written_total", "Rows written to the database", 
+                                             ["table"]).labels(self.table)
         
     def prepare_db(self):
         self.c.execute("CREATE SCHEMA IF NOT EXISTS {}".format(self.schema))
@@ -42,116 +60,174 @@ class BVIX:
         self.conn.commit()
         
         
+    @timed("create_volsurf_snapshot")
     def create_volsurf_snapshot(self, df):
         try:
-            df = df.astype({"btcusd_price":float, "strike":float, "ttmyears":float, 
-                            "bid":float, "bid_size":float, "bid_usd":float, "bid_iv":float, 
-                            "ask":float, "ask_size":float, "ask_usd":float, "ask_iv":float, 
-                            "typ":str})
-            
-            df["timestamp"] = pd.to_datetime(df["timestamp"], utc=True)
-            df["expiration"] = pd.to_datetime(df["expiration"], utc=True)
-            df["ttmdays"] = df["ttmyears"] * 365
-        
-            df["moneyness"] = (np.log(df["strike"] / df["btcusd_price"]))
-            df["mid_iv"] = (df["bid_iv"] + df["ask_iv"]) / 2
-        
-            df["ask"].loc[df["ask"] >= 0.6] = 0
-            df["bid"].loc[df["bid"] >= 0.6] = 0
-            df = df[df["ask"] != 0.0005]
-            
-            df["bid"].fillna(0, inplace=True)
-            df["ask"].fillna(0, inplace=True)
-            
-            df["bid_usd"].loc[df["bid"] == 0] = 0
-            df["ask_usd"].loc[df["ask"] == 0] = 0
-            df["bid_iv"].loc[df["bid"] == 0] = 0
-            df["ask_iv"].loc[df["ask"] == 0] = 0
-            df["bid_size"].loc[df["bid"] == 0] = 0
-            df["ask_size"].loc[df["ask"] == 0] = 0
-            
-            df = df[(df["bid"] > 0) | (df["ask"] > 0)]
-            df = df[(df["bid_iv"] > 0) | (df["ask_iv"] > 0)]
-            
-            itm_max = np.log(1.1)
-            
-            df = df[((df["moneyness"] < itm_max) & (df["typ"] == "P")) | 
-                    ((df["moneyness"] > -1*itm_max) & (df["typ"] == "C"))]
-            
-            df["mid_iv"].loc[(df["ask_iv"] > 0) & (df["bid_iv"] == 0)] = df["ask_iv"]
-            df["mid_iv"].loc[(df["bid_iv"] > 0) & (df["ask_iv"] == 0)] = df["bid_iv"]
-            
-            df["contract"] = df["expiration"].dt.date.astype(str) + df["strike"].astype(str) + df["typ"]
-            
-            df_grouped = df.groupby(["strike", "expiration"], 
-                                    as_index=False).agg({"ttmdays":"first", 
-                                                         "moneyness":"first", 
-                                                         "mid_iv":"mean"})
-            
-            df_grouped.sort_values(by=["ttmdays", "moneyness"], ascending=True, inplace=True)
-            df_grouped.drop(["strike", "expiration"], axis=1, inplace=True)
-            
-            
-            unique_ttms = df_grouped["ttmdays"].unique()
-            
-            df_atm_intervals = pd.DataFrame()
-            
-            for ttm in unique_ttms:
-                df2 = df_grouped[df_grouped["ttmdays"] == ttm]
-                df_moneyness = pd.DataFrame(self.log_moneyness_intervals, columns=["moneyness"])
-                df2 = df2.merge(df_moneyness, on="moneyness", how="outer").replace([np.inf, -np.inf], 0)
-                df2["ttmdays"].fillna(method="ffill", inplace=True)
-                df2["ttmdays"].fillna(method="bfill", inplace=True)
-                df2 = df2.sort_values(by="moneyness", ascending=True).set_index("moneyness")
-                df2 = df2.interpolate(method='slinear', limit_direction='forward', axis=0).reset_index()
-                df_atm_intervals = df_atm_intervals.append(df2)
-            
-            
-            ttm_atm_combinations = []
-            
-            for i in self.days_til_maturity:
-                for m in self.log_moneyness_intervals:
-                    ttm_atm_combinations.append([i, m])
-            
-            dfy = pd.DataFrame(ttm_atm_combinations, columns=["ttmdays", "moneyness"])
-            
-            df_atm_intervals = df_atm_intervals[df_atm_intervals["moneyness"].isin(self.log_moneyness_intervals)]
-            df_atm_intervals = df_atm_intervals.append(dfy)
-            
-            
-            unique_atms = df_atm_intervals["moneyness"].unique()
-            
-            df_ttm_intervals = pd.DataFrame()
-            
-            for m in unique_atms:
-                df2 = df_atm_intervals[df_atm_intervals["moneyness"] == m]
-                df2.set_index("ttmdays", inplace=True)
-                df2 = df2.interpolate(method='slinear', limit_direction='forward', axis=0)
-                df2.reset_index(inplace=True)
-                df_ttm_intervals = df_ttm_intervals.append(df2)
-                
-            df_ttm_intervals = df_ttm_intervals[df_ttm_intervals["ttmdays"].isin(self.days_til_maturity)]
-            df_ttm_intervals["moneyness"] = round(np.exp(df_ttm_intervals["moneyness"]), 3)
-            df_ttm_intervals["ttmdays"] = df_ttm_intervals["ttmdays"].astype(int)
-            
-            
-            df_atm_ttm = df_ttm_intervals.pivot(index="moneyness", columns="ttmdays", values="mid_iv")
-            df_atm_ttm.reset_index(inplace=True)
-            df_atm_ttm = df_atm_ttm.round(decimals=4)
-            
-            db_columns = ["moneyness"]
-            for i in self.days_til_maturity:
-                db_columns.append("d" + str(i))
-            df_atm_ttm.columns = db_columns
             ts = datetime.now(pytz.UTC)
             ts = ts.replace(microsecond=0)
-            df_atm_ttm["timestamp"] = ts
-            df_atm_ttm["timestamp"] = pd.to_datetime(df_atm_ttm["timestamp"], utc=True)
+            with self.surface_duration.time():
+                nodes = self.prepare_surface_nodes(df)
+                surface = self.interpolate_surface(*nodes)
+                df_atm_ttm = self.surface_to_frame(surface, ts)
         
-            df_atm_ttm.to_sql("bvix", con=self.engine, schema="obot", 
-                              if_exists='append', index=False, chunksize=10000)            
+            if self.engine is not None:
+                with self.surface_write_duration.time():
+                    df_atm_ttm.to_sql("bvix", con=self.engine, schema="obot", 
+                                      if_exists='append', index=False, chunksize=10000)            
+                self.rows_written.inc(len(df_atm_ttm))
         except Exception as e:
             self.logger.info("Error writing volatility surface to database: {}".format(e))
+            return
+        
+        if self.fit_svi:
+            with self.svi_duration.time():
+                self.svi.fit_and_save(*nodes, ts)
+            
+            
+    def build_surface(self, df):
+        """ Returns the mid IV surface as an array of shape 
+        (len(log_moneyness_intervals), len(days_til_maturity)) """
+        
+        ttmdays, moneyness, mid_iv = self.prepare_surface_nodes(df)
+        return self.interpolate_surface(ttmdays, moneyness, mid_iv)
+        
+        
+    def prepare_surface_nodes(self, df):
+        """ Cleans the top-of-book snapshot and returns one mid IV node per 
+        strike and expiration, sorted by ttmdays and moneyness """
+        
+        return self.surface_nodes(df["btcusd_price"].to_numpy(dtype=float), 
+                                  df["strike"].to_numpy(dtype=float), 
+                                  df["ttmyears"].to_numpy(dtype=float), 
+                                  df["typ"].astype(str).to_numpy(), 
+                                  df["bid"].to_numpy(dtype=float), 
+                                  df["ask"].to_numpy(dtype=float), 
+                                  df["bid_iv"].to_numpy(dtype=float), 
+                                  df["ask_iv"].to_numpy(dtype=float))
+        
+        
+    def surface_nodes(self, spot, strike, ttmyears, typ, bid, ask, bid_iv, ask_iv):
+        """ Array version of prepare_surface_nodes, so quotes kept in memory can 
+        be turned into surface nodes without building a DataFrame """
+        
+        moneyness = np.log(strike / spot)
+        is_call = typ == "C"
+        is_put = typ == "P"
+    
+        ask = np.where(ask >= 0.6, 0, ask)
+        bid = np.where(bid >= 0.6, 0, bid)
+        keep = ask != 0.0005
+        
+        bid = np.nan_to_num(bid, nan=0)
+        ask = np.nan_to_num(ask, nan=0)
+        bid_iv = np.where(bid == 0, 0, bid_iv)
+        ask_iv = np.where(ask == 0, 0, ask_iv)
+        
+        keep &= (bid > 0) | (ask > 0)
+        keep &= (bid_iv > 0) | (ask_iv > 0)
+        
+        itm_max = np.log(1.1)
+        
+        keep &= (((moneyness < itm_max) & is_put) | 
+                 ((moneyness > -1*itm_max) & is_call))
+        
+        mid_iv = (bid_iv + ask_iv) / 2
+        mid_iv = np.where((ask_iv > 0) & (bid_iv == 0), ask_iv, mid_iv)
+        mid_iv = np.where((bid_iv > 0) & (ask_iv == 0), bid_iv, mid_iv)
+        
+        # one node per strike and expiration, averaging calls and puts
+        ttmdays = (ttmyears * 365)[keep]
+        strike = strike[keep]
+        moneyness = moneyness[keep]
+        mid_iv = mid_iv[keep]
+        
+        order = np.lexsort((strike, ttmdays))
+        ttmdays, strike, moneyness, mid_iv = ttmdays[order], strike[order], moneyness[order], mid_iv[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (ttmdays[1:] != ttmdays[:-1]) | (strike[1:] != strike[:-1])
+        node = np.cumsum(first) - 1
+        
+        quoted = ~np.isnan(mid_iv)
+        iv_sum = np.bincount(node, weights=np.where(quoted, mid_iv, 0), minlength=first.sum())
+        iv_count = np.bincount(node, weights=quoted, minlength=first.sum())
+        with np.errstate(invalid="ignore"):
+            node_iv = iv_sum / iv_count
+        node_iv[np.isinf(node_iv)] = 0
+        
+        return ttmdays[first], moneyness[first], node_iv
+    
+    
+    def interpolate_surface(self, ttmdays, moneyness, mid_iv):
+        """ Linearly interpolates every expiry's smile onto the log moneyness 
+        grid, then every moneyness row onto the maturity grid. Grid nodes 
+        outside the range of available quotes are NaN. """
+        
+        # pad the smiles into one row per expiry, strikes ascending
+        unique_ttms, expiry_index, strike_counts = np.unique(ttmdays, return_inverse=True, 
+                                                             return_counts=True)
+        n_expiries = len(unique_ttms)
+        if n_expiries == 0:
+            return np.full((len(self.log_moneyness_intervals), len(self.days_til_maturity)), np.nan)
+        
+        order = np.lexsort((moneyness, expiry_index))
+        expiry_index = expiry_index[order]
+        position = np.arange(len(order)) - np.repeat(np.cumsum(strike_counts) - strike_counts, strike_counts)
+        
+        x = np.full((n_expiries, strike_counts.max()), np.nan)
+        y = np.full((n_expiries, strike_counts.max()), np.nan)
+        x[expiry_index, position] = moneyness[order]
+        y[expiry_index, position] = mid_iv[order]
+        
+        log_moneyness = np.asarray(self.log_moneyness_intervals, dtype=float)
+        smiles = interpolate_rows(x, y, log_moneyness) # expiries x moneyness
+        
+        ttm_rows = np.broadcast_to(unique_ttms, (len(log_moneyness), n_expiries))
+        days = np.asarray(self.days_til_maturity, dtype=float)
+        return interpolate_rows(ttm_rows, smiles.T, days) # moneyness x maturities
+    
+    
+    def surface_to_frame(self, surface, ts):
+        df_atm_ttm = pd.DataFrame(surface, columns=["d" + str(i) for i in self.days_til_maturity])
+        df_atm_ttm.insert(0, "moneyness", np.round(np.exp(self.log_moneyness_intervals), 3))
+        df_atm_ttm = df_atm_ttm.round(decimals=4)
+        df_atm_ttm["timestamp"] = ts
+        df_atm_ttm["timestamp"] = pd.to_datetime(df_atm_ttm["timestamp"], utc=True)
+        return df_atm_ttm
+    
+    
 
+def interpolate_rows(x, y, x_new):
+    """ Piecewise linear interpolation of every row of y over the matching row 
+    of x, evaluated at the points x_new. Rows of x must be ascending, NaNs in 
+    y are treated as missing, and points outside a row's valid range are NaN. """
+    
+    n_rows, n_points = x.shape
+    rows = np.arange(n_rows)[:, None]
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    columns = np.arange(n_points)
+    
+    # last valid column at or before, and next valid column at or after, each column
+    last_valid = np.maximum.accumulate(np.where(valid, columns, -1), axis=1)
+    next_valid = np.minimum.accumulate(np.where(valid, columns, n_points)[:, ::-1], axis=1)[:, ::-1]
+    last_valid = np.hstack([np.full((n_rows, 1), -1), last_valid])
+    next_valid = np.hstack([next_valid, np.full((n_rows, 1), n_points)])
+    
+    right = (x[:, :, None] < x_new[None, None, :]).sum(axis=1) # first column with x >= x_new
+    hi = next_valid[rows, right]
+    lo = last_valid[rows, right]
+    
+    hi_clipped = np.minimum(hi, n_points - 1)
+    lo_clipped = np.maximum(lo, 0)
+    x_hi = x[rows, hi_clipped]
+    x_lo = x[rows, lo_clipped]
+    y_hi = y[rows, hi_clipped]
+    y_lo = y[rows, lo_clipped]
     
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weight = (x_new[None, :] - x_lo) / (x_hi - x_lo)
+        result = y_lo + weight * (y_hi - y_lo)
     
+    exact = (hi < n_points) & (x_hi == x_new[None, :])
+    inside = (lo >= 0) & (hi < n_points)
+    result = np.where(exact, y_hi, np.where(inside, result, np.nan))
+    return result
@@ -11,6 +11,9 @@ import sys
 import pytz
 import logging
 
+from metrics import REGISTRY
+from profiler import timed
+
 class WSClient:
     
     """
@@ -26,6 +29,11 @@ class WSClient:
         
         self.feed = feed
         self.delta_hedger = delta_hedger
+        self.execution = None # ExecutionManager, set by Bot; order requests and their responses go through it
+        self.trade_bars = None # TradeBars, set by Bot; aggregates the BTC-PERPETUAL trades
+        self.option_flow = None # OptionFlow, set by Bot when enabled; the option trades are only subscribed to then
+        self.tiers = None # SubscriptionTiers, set by Bot when enabled; otherwise every option gets raw books
+        self.standby = None # StandbyClient, set by Bot when enabled; second connection for the critical channels
         self.logger = logging.getLogger("deribit")
         self.api_key = api_key
         self.api_secret = api_secret
@@ -38,15 +46,19 @@ class WSClient:
         self.ping_timeout = 2
         
         self.api_call_id_counter = 0 # unique, ascending ID to match response with received message
+        self.call_id_lock = threading.Lock()
+        self.feed_lock = threading.Lock() # serializes feed writes of the primary and the standby connection
         self.api_call_types = ["public/get_instruments", "public/subscribe", 
-                               "public/auth", "private/subscribe", 
-                               "private/get_positions", "private/buy", 
+                               "public/unsubscribe", "public/auth", "private/subscribe", 
+                               "private/get_positions", "private/buy", "private/sell", 
+                               "private/edit", "private/cancel", "private/cancel_by_label", 
                                "private/get_open_orders_by_currency"] # different types of requests that need to be handled differently
         
         self.api_call_ids = dict() # will contain all IDs per call type in order to distribute incoming message efficiently to correct function
         
         self.build_api_call_ids() # build the previous dictionary (just above)
         self.active_contracts_list = [] # will contain all active options contracts once they have been received
+        self.position_kinds = dict() # call ID of a positions request -> instrument kind
         
         self.connected = False        
         self.authenticated = False # True as soon as authentication confirmation is received
@@ -59,10 +71,23 @@ class WSClient:
         
         self.connection_age = datetime.now(pytz.UTC)
         
+        # per channel type, not per instrument, to keep the number of series small
+        messages = REGISTRY.counter("ws_messages_total", "Websocket messages received", ["channel"])
+        self.messages = {channel:messages.labels(channel) for channel in 
+                         ["book", "ticker", "perp_book", "perp_trades", "option_trades", "user.orders", "user.portfolio", 
+                          "user.trades", "other", "response"]}
+        self.message_duration = REGISTRY.histogram("ws_message_seconds", 
+                                                   "Time spent processing one websocket message").labels()
+        self.connects = REGISTRY.counter("ws_connects_total", "Websocket connection attempts")
+        self.errors = REGISTRY.counter("ws_errors_total", "Websocket errors (each followed by a reconnect)")
+        REGISTRY.gauge("ws_error_counter", "Consecutive websocket errors").set_function(lambda: self.error_counter)
+        REGISTRY.gauge("ws_connected", "Websocket connected").set_function(lambda: int(self.connected))
+        
         
         
     def create_ws_connection(self):
         self.logger.info("Connecting to Websocket.")
+        self.connects.inc()
         self.ws = websocket.WebSocketApp(self.ws_url, 
                                          on_open=self.on_open, 
                                          on_message=self.on_message, 
@@ -90,7 +115,8 @@ class WSClient:
         
     def on_message(self, placeholder, data):
         try:
-            self.message_distribution(data)
+            with self.message_duration.time():
+                self.message_distribution(data)
         except KeyboardInterrupt:
             self.shutdown()
         
@@ -98,6 +124,7 @@ class WSClient:
     def on_error(self, placeholder, error):
         self.connected = False
         self.error_counter += 1
+        self.errors.inc()
         self.logger.info("({}) - Error: {}. Closing Websocket connection and "
                          "reconnecting shortly.".format(self.error_counter, 
                                                         error))
@@ -160,24 +187,41 @@ class WSClient:
         self.private_subscription_count = 0
         
     
-    def send_to_ws(self, data, call_type):        
-        call_id = self.api_call_id_counter
+    def send_to_ws(self, data, call_type, register=None):
+        """ Sends a request and returns its call ID. Several threads send (hedger,
+        execution manager, subscription tiers), so IDs are allocated and registered
+        under a lock, and register(call_id) is called before the request goes out:
+        a fast response always finds what the caller keeps for its ID. """
+        
+        with self.call_id_lock:
+            call_id = self.api_call_id_counter
+            self.add_api_call_id(call_type, call_id)
+        if register is not None:
+            register(call_id)
         message_to_send = {"jsonrpc" : "2.0", 
                            "id" : call_id, 
                            "method" : call_type, 
                            "params" : data}
         
         json_message_to_send = json.dumps(message_to_send)
-        self.ws.send(json_message_to_send)
-        self.add_api_call_id(call_type, call_id)
+        ws = self.ws
+        if not self.connected and self.standby is not None and self.standby.authenticated:
+            ws = self.standby.ws # e.g. hedge orders while the primary reconnects, answered on the standby
+        ws.send(json_message_to_send)
+        return call_id
         
     
     def authenticate(self):
+        call_type = "public/auth"
+        self.send_to_ws(self.auth_message(), call_type)
+        
+        
+    def auth_message(self):
+        """ public/auth parameters, signed with a fresh nonce """
         
         clientId = self.api_key
         clientSecret = self.api_secret
 
-        call_type = "public/auth"
         timestamp = round(datetime.now().timestamp() * 1000)
         nonce = secrets.token_hex(32)
         data = ""
@@ -190,8 +234,7 @@ class WSClient:
         message = {"grant_type": "client_signature", "client_id": clientId, 
                    "timestamp": timestamp, "nonce": nonce, "data": data, 
                    "signature": signature}
-        
-        self.send_to_ws(message, call_type)
+        return message
         
         
     def get_instruments(self):
@@ -202,14 +245,26 @@ class WSClient:
     
     def build_subscriptions(self, contracts):
         mid = round(len(contracts) / 2)
-        ob_channels_1 = ["book." + str(contract) + ".raw" for contract in contracts[:mid]]
-        ob_channels_2 = ["book." + str(contract) + ".raw" for contract in contracts[mid:]]
-        oi_channels_1 = ["ticker." + str(contract) + ".raw" for contract in contracts[:mid]]
-        oi_channels_2 = ["ticker." + str(contract) + ".raw" for contract in contracts[mid:]]
+        if self.tiers is not None:
+            # raw or grouped book and ticker channels, per instrument
+            tiers = self.tiers.assign(contracts)
+            channels = {contract:self.tiers.channels(contract, tiers[contract]) for contract in contracts}
+            ob_channels_1 = [channels[contract][0] for contract in contracts[:mid]]
+            ob_channels_2 = [channels[contract][0] for contract in contracts[mid:]]
+            oi_channels_1 = [channels[contract][1] for contract in contracts[:mid]]
+            oi_channels_2 = [channels[contract][1] for contract in contracts[mid:]]
+        else:
+            ob_channels_1 = ["book." + str(contract) + ".raw" for contract in contracts[:mid]]
+            ob_channels_2 = ["book." + str(contract) + ".raw" for contract in contracts[mid:]]
+            oi_channels_1 = ["ticker." + str(contract) + ".raw" for contract in contracts[:mid]]
+            oi_channels_2 = ["ticker." + str(contract) + ".raw" for contract in contracts[mid:]]
         
         private_channels = ["user.orders.any.any.raw", "user.portfolio.btc", 
                           "user.trades.any.any.raw"]
         public_channels = ["book.BTC-PERPETUAL.none.1.100ms", "trades.BTC-PERPETUAL.raw"]
+        if self.option_flow is not None:
+            # one channel for the trades of every BTC option
+            public_channels.append("trades.option.BTC.raw")
         
         channels = [ob_channels_1, ob_channels_2, oi_channels_1, oi_channels_2, 
                     private_channels, public_channels]
@@ -230,7 +285,7 @@ class WSClient:
         kind = ["future", "option"]
         for k in kind:
             message = {"currency":currency, "kind":k}
-            self.send_to_ws(message, call_type)
+            self.send_to_ws(message, call_type, register=lambda call_id, k=k: self.position_kinds.update({call_id:k}))
     
     
     def get_open_orders(self):
@@ -298,11 +353,16 @@ class WSClient:
             self.shutdown()
             
         
+    @timed("message_distribution")
     def message_distribution(self, reply):
         reply = json.loads(reply)
         
         if "id" in reply:
-            if "result" in reply:
+            self.messages["response"].inc()
+            if self.execution is not None and self.execution.owns(reply["id"]):
+                self.execution.on_response(reply)
+                
+            elif "result" in reply:
                 # Ensures that messages from channel subscriptions do not use up time to check for IDs, since they just need to be processed in the book build
                 # Except for own account channel !!!!!!!!!!
                 if reply["id"] in self.api_call_ids["public/get_instruments"]:
@@ -320,16 +380,21 @@ class WSClient:
                     if self.public_subscription_count == 5:
                         self.subscribed_public = True
                         
+                elif reply["id"] in self.api_call_ids["public/unsubscribe"]:
+                    pass
+                    
                 elif reply["id"] in self.api_call_ids["private/subscribe"]:
                     self.private_subscription_count += 1
                     if self.private_subscription_count == 1:
                         self.subscribed_private = True
                     
                 elif reply["id"] in self.api_call_ids["private/get_positions"]:
-                    self.feed.initial_positions(reply["result"])
+                    with self.feed_lock:
+                        self.feed.initial_positions(reply["result"], self.position_kinds.get(reply["id"]))
                     
                 elif reply["id"] in self.api_call_ids["private/get_open_orders_by_currency"]:
-                    self.feed.initial_open_orders(reply["result"])
+                    with self.feed_lock:
+                        self.feed.initial_open_orders(reply["result"])
                 
                 else:
                     self.logger.info("Unhandled reply: {}".format(reply))
@@ -345,44 +410,88 @@ class WSClient:
                 if "params" in reply:
                     if "channel" in reply["params"]:
                         if "data" in reply["params"]:
-                            if reply["params"]["channel"] == "book.BTC-PERPETUAL.none.1.100ms":
-                                self.feed.btcusd_best_bid = reply["params"]["data"]["bids"][0][0]
-                                self.feed.btcusd_best_ask = reply["params"]["data"]["asks"][0][0]
-                                
-                            elif reply["params"]["channel"][:9] == "book.BTC-":
-                                if "type" in reply["params"]["data"]:
-                                    if reply["params"]["data"]["type"] == "snapshot":
-                                        self.feed.build_ob_from_snapshots(reply["params"]["data"])
-                                    
-                                    elif reply["params"]["data"]["type"] == "change":
-                                        self.feed.update_ob(reply["params"]["data"])
-                            
-                            elif reply["params"]["channel"][:11] == "ticker.BTC-":
-                                self.feed.manage_option_oi(reply["params"]["data"])                            
-                            
-                            elif reply["params"]["channel"] == "user.orders.any.any.raw":
-                                self.feed.manage_orders(reply["params"]["data"])
-                                
-                            elif reply["params"]["channel"] == "user.portfolio.btc":
-                                self.feed.manage_portfolio(reply["params"]["data"])
-                                self.delta_hedger.check_deltas(self.send_to_ws)
-                                
-                                
-                            elif reply["params"]["channel"] == "user.trades.any.any.raw":
-                                self.feed.update_positions(reply["params"]["data"])
-                                self.delta_hedger.check_deltas(self.send_to_ws)
+                            channel = reply["params"]["channel"]
+                            if self.standby is not None and channel in self.standby.channels:
+                                # received on both connections, delivered once
+                                self.standby.deliver(channel, reply["params"]["data"], "primary")
+                            else:
+                                self.distribute(channel, reply["params"]["data"])
                                 
                                 
                             # if "timestamp" in reply["params"]["data"]:
                             #     self.convert_ts(reply["params"]["data"]["timestamp"])
         
     
+    def distribute(self, channel, data):
+        """ Subscription message data to the DataFeed and the modules listening to its channel """
+        
+        # called from the standby's thread as well; the feed and its SharedBook have a single writer
+        with self.feed_lock:
+            self.dispatch(channel, data)
+            
+            
+    def dispatch(self, channel, data):
+        if channel == "book.BTC-PERPETUAL.none.1.100ms":
+            self.messages["perp_book"].inc()
+            self.feed.btcusd_best_bid = data["bids"][0][0]
+            self.feed.btcusd_best_ask = data["asks"][0][0]
+            if self.feed.shared is not None:
+                self.feed.shared.publish_spot(self.feed.btcusd_best_bid, self.feed.btcusd_best_ask)
+
+        elif channel[:9] == "book.BTC-":
+            self.messages["book"].inc()
+            if "type" in data:
+                if data["type"] == "snapshot":
+                    self.feed.build_ob_from_snapshots(data)
+
+                elif data["type"] == "change":
+                    self.feed.update_ob(data)
+
+            else: # grouped channel, see SubscriptionTiers
+                self.feed.update_ob_grouped(data)
+
+        elif channel == "trades.BTC-PERPETUAL.raw":
+            self.messages["perp_trades"].inc()
+            if self.trade_bars is not None:
+                self.trade_bars.on_trades(data)
+
+        elif channel == "trades.option.BTC.raw":
+            self.messages["option_trades"].inc()
+            if self.option_flow is not None:
+                self.option_flow.on_trades(data)
+
+        elif channel[:11] == "ticker.BTC-":
+            self.messages["ticker"].inc()
+            self.feed.manage_option_oi(data)                            
+
+        elif channel == "user.orders.any.any.raw":
+            self.messages["user.orders"].inc()
+            self.feed.manage_orders(data)
+            if self.execution is not None:
+                self.execution.on_order_update(data)
+
+        elif channel == "user.portfolio.btc":
+            self.messages["user.portfolio"].inc()
+            self.feed.manage_portfolio(data)
+            self.delta_hedger.request_evaluation(self.send_to_ws)
+
+
+        elif channel == "user.trades.any.any.raw":
+            self.messages["user.trades"].inc()
+            self.feed.update_positions(data)
+            self.delta_hedger.request_evaluation(self.send_to_ws)
+
+        else:
+            self.messages["other"].inc()
+                
+    
     def build_api_call_ids(self):
         for i in self.api_call_types:
             self.api_call_ids[i] = []
             
                     
     def add_api_call_id(self, call_type, call_id):
+        # called with call_id_lock held
         self.api_call_ids[call_type].append(call_id)
         self.api_call_id_counter += 1
     